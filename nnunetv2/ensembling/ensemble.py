@@ -1,14 +1,15 @@
 import argparse
 import multiprocessing
 import shutil
-from copy import deepcopy
 from typing import List, Union, Tuple
 
 import numpy as np
-from batchgenerators.utilities.file_and_folder_operations import load_json, join, subfiles, \
+from batchgenerators.utilities.file_and_folder_operations import load_json, join, \
     maybe_mkdir_p, isdir, save_pickle, load_pickle, isfile
 from nnunetv2.configuration import default_num_processes
 from nnunetv2.imageio.base_reader_writer import BaseReaderWriter
+from nnunetv2.inference.probability_store import load_probabilities, probabilities_formats, \
+    save_probabilities as save_probabilities_to_file, strip_probabilities_file_ending, get_probabilities_files_per_case
 from nnunetv2.utilities.label_handling.label_handling import LabelManager
 from nnunetv2.utilities.plans_handling.plans_handler import PlansManager
 
@@ -18,12 +19,12 @@ def average_probabilities(list_of_files: List[str]) -> np.ndarray:
     avg = None
     for f in list_of_files:
         if avg is None:
-            avg = np.load(f)['probabilities']
+            avg = load_probabilities(f)
             # maybe increase precision to prevent rounding errors
             if avg.dtype != np.float32:
                 avg = avg.astype(np.float32)
         else:
-            avg += np.load(f)['probabilities']
+            avg += load_probabilities(f)
     avg /= len(list_of_files)
     return avg
 
@@ -33,16 +34,17 @@ def merge_files(list_of_files,
                 output_file_ending: str,
                 image_reader_writer: BaseReaderWriter,
                 label_manager: LabelManager,
-                save_probabilities: bool = False):
+                save_probabilities: bool = False,
+                probabilities_format: str = 'npz'):
     # load the pkl file associated with the first file in list_of_files
-    properties = load_pickle(list_of_files[0][:-4] + '.pkl')
+    properties = load_pickle(strip_probabilities_file_ending(list_of_files[0]) + '.pkl')
     # load and average predictions
     probabilities = average_probabilities(list_of_files)
     segmentation = label_manager.convert_logits_to_segmentation(probabilities)
     image_reader_writer.write_seg(segmentation, output_filename_truncated + output_file_ending, properties)
     if save_probabilities:
-        np.savez_compressed(output_filename_truncated + '.npz', probabilities=probabilities)
-        save_pickle(probabilities, output_filename_truncated + '.pkl')
+        save_probabilities_to_file(probabilities, output_filename_truncated, probabilities_format)
+        save_pickle(properties, output_filename_truncated + '.pkl')
 
 
 def ensemble_folders(list_of_input_folders: List[str],
@@ -50,7 +52,8 @@ def ensemble_folders(list_of_input_folders: List[str],
                      save_merged_probabilities: bool = False,
                      num_processes: int = default_num_processes,
                      dataset_json_file_or_dict: str = None,
-                     plans_json_file_or_dict: str = None):
+                     plans_json_file_or_dict: str = None,
+                     probabilities_format: str = 'npz'):
     """we need too much shit for this function. Problem is that we now have to support region-based training plus
     multiple input/output formats so there isn't really a way around this.
 
@@ -77,17 +80,19 @@ def ensemble_folders(list_of_input_folders: List[str],
 
     plans_manager = PlansManager(plans)
 
-    # now collect the files in each of the folders and enforce that all files are present in all folders
-    files_per_folder = [set(subfiles(i, suffix='.npz', join=False)) for i in list_of_input_folders]
-    # first build a set with all files
-    s = deepcopy(files_per_folder[0])
+    # now collect the files in each of the folders and enforce that all files are present in all folders. The folders
+    # may use different probability file formats (see nnunetv2.inference.probability_store)
+    files_per_folder = [get_probabilities_files_per_case(i, join=False) for i in list_of_input_folders]
+    # first build a set with all cases
+    s = set(files_per_folder[0].keys())
     for f in files_per_folder[1:]:
-        s.update(f)
+        s.update(f.keys())
     for f in files_per_folder:
-        assert len(s.difference(f)) == 0, "Not all folders contain the same files for ensembling. Please only " \
-                                          "provide folders that contain the predictions"
-    lists_of_lists_of_files = [[join(fl, fi) for fl in list_of_input_folders] for fi in s]
-    output_files_truncated = [join(output_folder, fi[:-4]) for fi in s]
+        assert len(s.difference(f.keys())) == 0, "Not all folders contain the same files for ensembling. Please " \
+                                                 "only provide folders that contain the predictions"
+    lists_of_lists_of_files = [[join(fl, f[c]) for fl, f in zip(list_of_input_folders, files_per_folder)]
+                               for c in s]
+    output_files_truncated = [join(output_folder, c) for c in s]
 
     image_reader_writer = plans_manager.image_reader_writer_class()
     label_manager = plans_manager.get_label_manager(dataset_json)
@@ -105,7 +110,8 @@ def ensemble_folders(list_of_input_folders: List[str],
                 [dataset_json['file_ending']] * num_preds,
                 [image_reader_writer] * num_preds,
                 [label_manager] * num_preds,
-                [save_merged_probabilities] * num_preds
+                [save_merged_probabilities] * num_preds,
+                [probabilities_format] * num_preds
             )
         )
 
@@ -119,9 +125,12 @@ def entry_point_ensemble_folders():
                         help=f"Numbers of processes used for ensembling. Default: {default_num_processes}")
     parser.add_argument('--save_npz', action='store_true', required=False, help='Set this flag to store output '
                                                                                 'probabilities in separate .npz files')
+    parser.add_argument('-prob_format', type=str, required=False, default='npz', choices=probabilities_formats,
+                        help='File format of the probabilities stored with --save_npz, see nnUNetv2_predict. '
+                             'Default: npz')
 
     args = parser.parse_args()
-    ensemble_folders(args.i, args.o, args.save_npz, args.np)
+    ensemble_folders(args.i, args.o, args.save_npz, args.np, probabilities_format=args.prob_format)
 
 
 def ensemble_crossvalidations(list_of_trained_model_folders: List[str],
@@ -144,12 +153,12 @@ def ensemble_crossvalidations(list_of_trained_model_folders: List[str],
             if not isdir(join(tr, f'fold_{f}', 'validation')):
                 raise RuntimeError(f'Expected model output directory does not exist. You must train all requested '
                                    f'folds of the specified model.\nModel: {tr}\nFold: {f}')
-            files_here = subfiles(join(tr, f'fold_{f}', 'validation'), suffix='.npz', join=False)
+            files_here = get_probabilities_files_per_case(join(tr, f'fold_{f}', 'validation'), join=False)
             if len(files_here) == 0:
                 raise RuntimeError(f"No .npz files found in folder {join(tr, f'fold_{f}', 'validation')}. Rerun your "
                                    f"validation with the --npz flag. Use nnUNetv2_train [...] --val --npz.")
-            files_per_folder[tr][f] = subfiles(join(tr, f'fold_{f}', 'validation'), suffix='.npz', join=False)
-            unique_filenames.update(files_per_folder[tr][f])
+            files_per_folder[tr][f] = files_here
+            unique_filenames.update(files_per_folder[tr][f].keys())
 
     # verify that all trained_model_folders have all predictions
     ok = True
@@ -169,14 +178,14 @@ def ensemble_crossvalidations(list_of_trained_model_folders: List[str],
     for tr in list_of_trained_model_folders:
         file_mapping.append({})
         for f in folds:
-            for fi in files_per_folder[tr][f]:
+            for fi, filename in files_per_folder[tr][f].items():
                 # check for duplicates
                 assert fi not in file_mapping[-1].keys(), f"Duplicate detected. Case {fi} is present in more than " \
                                                           f"one fold of model {tr}."
-                file_mapping[-1][fi] = join(tr, f'fold_{f}', 'validation', fi)
+                file_mapping[-1][fi] = join(tr, f'fold_{f}', 'validation', filename)
 
     lists_of_lists_of_files = [[fm[i] for fm in file_mapping] for i in unique_filenames]
-    output_files_truncated = [join(output_folder, fi[:-4]) for fi in unique_filenames]
+    output_files_truncated = [join(output_folder, fi) for fi in unique_filenames]
 
     image_reader_writer = plans_manager.image_reader_writer_class()
     maybe_mkdir_p(output_folder)
@@ -12,7 +12,7 @@ from batchgenerators.utilities.file_and_folder_operations import load_json, save
 from nnunetv2.configuration import default_num_processes
 from nnunetv2.inference.export_prediction import convert_predicted_logits_to_segmentation_with_correct_shape
 from nnunetv2.inference.predict_from_raw_data import nnUNetPredictor
-from nnunetv2.inference.sliding_window_prediction import compute_gaussian
+from nnunetv2.inference.sliding_window_prediction import compute_gaussian, compute_normalized_tile_weights
 from nnunetv2.utilities.file_path_utilities import check_workers_alive_and_busy
 from nnunetv2.utilities.helpers import empty_cache
 from nnunetv2.utilities.plans_handling.plans_handler import ConfigurationManager, PlansManager
@@ -142,6 +142,7 @@ class JHUPredictor(nnUNetPredictor):
 
         # clear lru cache
         compute_gaussian.cache_clear()
+        compute_normalized_tile_weights.cache_clear()
         # clear device cache
         empty_cache(self.device)
         return ret
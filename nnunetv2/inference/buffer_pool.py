@@ -0,0 +1,43 @@
+import threading
+from typing import Tuple, Dict, List
+
+import torch
+
+
+class BufferPool(object):
+    """
+    Keeps released CPU tensors so that they can be reused for arrays of the same shape and dtype. Allocating (and
+    page faulting) image-sized arrays anew for every case is a noticeable part of the latency when predicting one
+    image at a time. Device memory does not need this, the caching allocator of torch already reuses it.
+
+    Only release tensors that are no longer used anywhere! Thread safe.
+    """
+    def __init__(self, max_buffers_per_shape: int = 2):
+        self.max_buffers_per_shape = max_buffers_per_shape
+        self._free: Dict[Tuple, List[torch.Tensor]] = {}
+        self._lock = threading.Lock()
+
+    def zeros(self, shape: Tuple[int, ...], dtype: torch.dtype = torch.half) -> torch.Tensor:
+        key = (tuple(shape), dtype)
+        with self._lock:
+            free = self._free.get(key)
+            buffer = free.pop() if free else None
+        if buffer is None:
+            return torch.zeros(shape, dtype=dtype)
+        return buffer.zero_()
+
+    def release(self, tensor: torch.Tensor):
+        # views (for example the prediction with the padding removed) give back the buffer they were taken from
+        while tensor._base is not None:
+            tensor = tensor._base
+        if tensor.device.type != 'cpu':
+            return
+        key = (tuple(tensor.shape), tensor.dtype)
+        with self._lock:
+            free = self._free.setdefault(key, [])
+            if len(free) < self.max_buffers_per_shape and not any([i is tensor for i in free]):
+                free.append(tensor)
+
+    def clear(self):
+        with self._lock:
+            self._free = {}
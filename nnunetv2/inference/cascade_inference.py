@@ -0,0 +1,172 @@
+import argparse
+import hashlib
+from typing import List
+
+import numpy as np
+import torch
+
+from nnunetv2.inference.export_prediction import resample_logits_and_convert_to_segmentation
+from nnunetv2.inference.predict_from_raw_data import nnUNetPredictor
+from nnunetv2.inference.roi_inference import resample_preprocessed_data_to_configuration
+from nnunetv2.utilities.file_path_utilities import get_output_folder
+from nnunetv2.utilities.label_handling.label_handling import determine_num_input_channels
+
+
+class nnUNetCascadePredictor(nnUNetPredictor):
+    """
+    Runs the cascade (3d_lowres followed by 3d_cascade_fullres) in a single invocation. This predictor holds the
+    3d_cascade_fullres model, the lowres model is set with set_lowres_predictor.
+
+    The regular cascade writes the lowres segmentations to disk, reads them again when preprocessing for the next
+    stage, resamples them there and stacks their one-hot encoding onto the image. Here, the image is only preprocessed
+    for the fullres configuration. The lowres model predicts a resampled copy of it and its logits are resampled
+    straight to the grid of the fullres image (channel by channel, see resample_logits_and_convert_to_segmentation).
+    The one-hot encoding of the resulting segmentation is created on the compute device and stacked onto the image
+    there. Because the lowres segmentation is not taken to the original image geometry and back, results can differ
+    from the regular cascade in a few voxels along the borders of structures.
+
+    Usage:
+        predictor = nnUNetCascadePredictor(...)
+        predictor.initialize_from_trained_model_folder(cascade_fullres_model_folder, use_folds)
+        lowres_predictor = nnUNetPredictor(...)
+        lowres_predictor.initialize_from_trained_model_folder(lowres_model_folder, use_folds)
+        predictor.set_lowres_predictor(lowres_predictor)
+        predictor.predict_from_files(...)
+    """
+    lowres_predictor: nnUNetPredictor = None
+
+    def set_lowres_predictor(self, lowres_predictor: nnUNetPredictor, check_previous_stage: bool = True):
+        """
+        lowres_predictor must already be initialized. If check_previous_stage, it must have been trained with the
+        configuration that our configuration names as its previous stage.
+        """
+        assert self.configuration_manager is not None and lowres_predictor.configuration_manager is not None, \
+            'Both predictors must be initialized before calling set_lowres_predictor'
+        previous_stage_name = self.configuration_manager.previous_stage_name
+        assert previous_stage_name is not None, \
+            'nnUNetCascadePredictor must be initialized with a cascade configuration (3d_cascade_fullres)'
+        assert self.label_manager.num_segmentation_heads == lowres_predictor.label_manager.num_segmentation_heads, \
+            'lowres and fullres models must predict the same labels/regions'
+        if check_previous_stage:
+            assert previous_stage_name in self.plans_manager.available_configurations and \
+                   self.plans_manager.get_configuration(previous_stage_name).configuration == \
+                   lowres_predictor.configuration_manager.configuration, \
+                f'The configuration of the lowres predictor does not match the previous stage of our configuration ' \
+                f'({previous_stage_name}). Set check_previous_stage=False if you know what you are doing.'
+        self.lowres_predictor = lowres_predictor
+
+    def _internal_requires_segs_from_prev_stage(self) -> bool:
+        return False
+
+    def _internal_get_model_fingerprint(self) -> str:
+        h = hashlib.sha256(super()._internal_get_model_fingerprint().encode())
+        h.update(self.lowres_predictor._internal_get_model_fingerprint().encode())
+        return h.hexdigest()
+
+    @torch.inference_mode()
+    def add_previous_stage_prediction(self, data: torch.Tensor) -> torch.Tensor:
+        """
+        data is the image preprocessed for our configuration. Predicts it with the lowres model and returns data with
+        the one-hot encoded lowres segmentation stacked on top, on the compute device if perform_everything_on_device.
+        """
+        lowres_data = resample_preprocessed_data_to_configuration(data, self, self.lowres_predictor)
+        if self.verbose:
+            print(f'running lowres prediction on shape {lowres_data.shape}')
+        lowres_logits = self.lowres_predictor.predict_logits_from_preprocessed_data(lowres_data)
+        del lowres_data
+
+        segmentation = resample_logits_and_convert_to_segmentation(
+            lowres_logits, self.lowres_predictor.label_manager,
+            self.lowres_predictor.configuration_manager.resampling_fn_probabilities, data.shape[1:],
+            self.lowres_predictor.configuration_manager.spacing, self.configuration_manager.spacing)
+        if self.lowres_predictor.out_of_core_arrays.get_file(lowres_logits) is not None:
+            self.lowres_predictor.out_of_core_arrays.release(lowres_logits)
+        del lowres_logits
+
+        device = self.device if self.perform_everything_on_device else torch.device('cpu')
+        # uint16 does not support comparisons on all devices
+        segmentation = torch.from_numpy(segmentation.astype(np.int32, copy=False)).to(device)
+        foreground_labels = self.label_manager.foreground_labels
+        result = torch.empty((data.shape[0] + len(foreground_labels), *data.shape[1:]), dtype=torch.float32,
+                             device=device)
+        result[:data.shape[0]] = data
+        for i, l in enumerate(foreground_labels):
+            result[data.shape[0] + i] = segmentation == l
+        return result
+
+    @torch.inference_mode()
+    def predict_logits_from_preprocessed_data(self, data: torch.Tensor) -> torch.Tensor:
+        assert self.lowres_predictor is not None, 'Call set_lowres_predictor first'
+        # data that already contains the previous stage (see nnUNetPredictor.predict_single_npy_array) is used as is
+        if data.shape[0] != determine_num_input_channels(self.plans_manager, self.configuration_manager,
+                                                         self.dataset_json):
+            data = self.add_previous_stage_prediction(data)
+        return super().predict_logits_from_preprocessed_data(data)
+
+
+def predict_entry_point_cascade():
+    parser = argparse.ArgumentParser(description='Runs 3d_lowres and 3d_cascade_fullres in a single invocation. The '
+                                                 'lowres predictions are kept in memory instead of being written to '
+                                                 'disk and read again.')
+    parser.add_argument('-i', type=str, required=True,
+                        help='input folder. Remember to use the correct channel numberings for your files (_0000 etc). '
+                             'File endings must be the same as the training dataset!')
+    parser.add_argument('-o', type=str, required=True,
+                        help='Output folder. If it does not exist it will be created.')
+    parser.add_argument('-d', type=str, required=True,
+                        help='Dataset with which you would like to predict. You can specify either dataset name or id')
+    parser.add_argument('-p', type=str, required=False, default='nnUNetPlans',
+                        help='Plans identifier. Default: nnUNetPlans')
+    parser.add_argument('-tr', type=str, required=False, default='nnUNetTrainer',
+                        help='What nnU-Net trainer class was used for training? Default: nnUNetTrainer')
+    parser.add_argument('-f', nargs='+', type=str, required=False, default=(0, 1, 2, 3, 4),
+                        help='Folds used for both stages. Default: (0, 1, 2, 3, 4)')
+    parser.add_argument('-c', type=str, required=False, default='3d_cascade_fullres',
+                        help='Cascade configuration. Its previous stage is used for the lowres prediction. Default: '
+                             '3d_cascade_fullres')
+    parser.add_argument('-step_size', type=float, required=False, default=0.5,
+                        help='Step size for sliding window prediction. Default: 0.5')
+    parser.add_argument('--disable_tta', action='store_true', required=False, default=False,
+                        help='Set this flag to disable test time data augmentation in the form of mirroring.')
+    parser.add_argument('--save_probabilities', action='store_true',
+                        help='Set this to export predicted class "probabilities".')
+    parser.add_argument('--continue_prediction', action='store_true',
+                        help='Continue an aborted previous prediction (will not overwrite existing files)')
+    parser.add_argument('-chk', type=str, required=False, default='checkpoint_final.pth',
+                        help='Name of the checkpoint you want to use. Default: checkpoint_final.pth')
+    parser.add_argument('-npp', type=int, required=False, default=3,
+                        help='Number of processes used for preprocessing. Default: 3')
+    parser.add_argument('-nps', type=int, required=False, default=3,
+                        help='Number of processes used for segmentation export. Default: 3')
+    parser.add_argument('-device', type=str, default='cuda', required=False,
+                        help="Use this to set the device the inference should run with. Available options are 'cuda' "
+                             "(GPU), 'cpu' (CPU) and 'mps' (Apple M1/M2).")
+    args = parser.parse_args()
+    args.f = [i if i == 'all' else int(i) for i in args.f]
+
+    device = torch.device(args.device)
+    predictors: List[nnUNetPredictor] = []
+    for predictor_class in (nnUNetCascadePredictor, nnUNetPredictor):
+        predictors.append(predictor_class(tile_step_size=args.step_size,
+                                          use_gaussian=True,
+                                          use_mirroring=not args.disable_tta,
+                                          perform_everything_on_device=True,
+                                          device=device,
+                                          verbose=False,
+                                          verbose_preprocessing=False,
+                                          allow_tqdm=True))
+    cascade_predictor, lowres_predictor = predictors
+    cascade_predictor.initialize_from_trained_model_folder(get_output_folder(args.d, args.tr, args.p, args.c),
+                                                           args.f, checkpoint_name=args.chk)
+    lowres_predictor.initialize_from_trained_model_folder(
+        get_output_folder(args.d, args.tr, args.p, cascade_predictor.configuration_manager.previous_stage_name),
+        args.f, checkpoint_name=args.chk)
+    cascade_predictor.set_lowres_predictor(lowres_predictor)
+    cascade_predictor.predict_from_files(args.i, args.o, save_probabilities=args.save_probabilities,
+                                         overwrite=not args.continue_prediction,
+                                         num_processes_preprocessing=args.npp,
+                                         num_processes_segmentation_export=args.nps)
+
+
+if __name__ == '__main__':
+    predict_entry_point_cascade()
@@ -0,0 +1,139 @@
+"""
+Optional CPU inference engine for nnUNetPredictor (cpu_engine='fp32' or 'bf16'). By default, CPU inference runs the
+network eagerly in channels first fp32 (autocast is only used with cuda, see predict_sliding_window_return_logits).
+The engine instead
+- converts the network and its inputs to channels_last(_3d), the memory format the oneDNN convolutions are fastest with
+- traces the network once per input shape (torch.jit.trace) and freezes the graph, so the weights become constants and
+  conv/norm/activation fusions can be applied. Tracing takes seconds and every graph holds its own copy of the
+  weights, so batches are zero padded to the next power of two (partial last batches, subsets of tiles in progressive
+  ensembling) and only the max_cached_graphs most recently used graphs are kept
+- with 'bf16', additionally runs the graph with bf16 autocast. Only worth it on CPUs with native bf16 support
+  (AVX512_BF16, AMX), otherwise we fall back to 'fp32'
+Dynamic int8 quantization (torch.ao.quantization.quantize_dynamic) only covers Linear and recurrent layers, which
+nnU-Net networks do not have, so it is not offered. Static int8 quantization of the convolutions would need calibration
+data and is out of scope here.
+
+Each variant is gated: before it is used, its prediction of the first batch is compared with the eager fp32 prediction
+of the same network. If more than tolerance (fraction of voxels) of the predicted labels differ, the next more
+conservative variant is tried (bf16 graph -> fp32 graph -> eager fp32).
+"""
+
+import warnings
+from collections import OrderedDict
+from copy import deepcopy
+from typing import Tuple
+
+import torch
+from torch import nn
+from torch._dynamo import OptimizedModule
+
+
+cpu_engine_precisions = ('fp32', 'bf16')
+
+
+def cpu_supports_bf16() -> bool:
+    try:
+        return torch.backends.mkldnn.is_available() and torch.ops.mkldnn._is_mkldnn_bf16_supported()
+    except (AttributeError, RuntimeError):
+        return False
+
+
+class CPUInferenceEngine(object):
+    def __init__(self, network: nn.Module, precision: str = 'fp32', has_regions: bool = False,
+                 tolerance: float = 1e-3, max_cached_graphs: int = 4):
+        assert precision in cpu_engine_precisions, f'precision must be one of {cpu_engine_precisions}'
+        if isinstance(network, OptimizedModule):
+            network = network._orig_mod
+        self.network = network
+        self.has_regions = has_regions
+        self.tolerance = tolerance
+        if precision == 'bf16' and not cpu_supports_bf16():
+            print('cpu_engine: this CPU has no native bf16 support, using fp32')
+            precision = 'fp32'
+        # candidates, most aggressive first. The first one that passes the accuracy check is used
+        self.variants = ['bf16', 'fp32'] if precision == 'bf16' else ['fp32']
+        self.variant = None
+        # (variant, input shape) -> traced graph, least recently used first
+        self.graphs = OrderedDict()
+        self.max_cached_graphs = max_cached_graphs
+        self._channels_last_network = None
+
+    @staticmethod
+    def _get_memory_format(ndim: int) -> torch.memory_format:
+        return torch.channels_last_3d if ndim == 5 else torch.channels_last
+
+    @staticmethod
+    def _pad_batch(x: torch.Tensor) -> torch.Tensor:
+        """
+        Zero pads the batch dimension of x to the next power of two, so that batches of any size only need a few
+        graphs. The samples of a batch are predicted independently (instance norm), padding does not change the result
+        """
+        padded_batch_size = 1 << (x.shape[0] - 1).bit_length()
+        if padded_batch_size == x.shape[0]:
+            return x
+        return torch.cat((x, x.new_zeros((padded_batch_size - x.shape[0], *x.shape[1:]))))
+
+    def _get_graph(self, variant: str, x: torch.Tensor) -> torch.jit.ScriptModule:
+        key = (variant, tuple(x.shape))
+        if key in self.graphs.keys():
+            self.graphs.move_to_end(key)
+        else:
+            memory_format = self._get_memory_format(x.ndim)
+            if self._channels_last_network is None:
+                # a copy, so that the eager network (fallback and reference) keeps working as it did
+                self._channels_last_network = deepcopy(self.network).eval().to(memory_format=memory_format)
+            with warnings.catch_warnings():
+                # torch.jit is deprecated in recent versions but still the only graph capture that freezes weights and
+                # fuses for oneDNN without a compiler toolchain
+                warnings.simplefilter('ignore', FutureWarning)
+                with torch.no_grad():
+                    if variant == 'bf16':
+                        # record the casts in the graph instead of relying on autocast at runtime
+                        previous_jit_autocast = torch._C._jit_set_autocast_mode(False)
+                        try:
+                            with torch.autocast('cpu', dtype=torch.bfloat16):
+                                graph = torch.jit.trace(self._channels_last_network, x, check_trace=False)
+                        finally:
+                            torch._C._jit_set_autocast_mode(previous_jit_autocast)
+                        graph = torch.jit.freeze(graph)
+                    else:
+                        graph = torch.jit.optimize_for_inference(
+                            torch.jit.freeze(torch.jit.trace(self._channels_last_network, x)))
+            self.graphs[key] = graph
+            if len(self.graphs) > self.max_cached_graphs:
+                self.graphs.popitem(last=False)
+        return self.graphs[key]
+
+    def _run(self, variant: str, x: torch.Tensor) -> torch.Tensor:
+        if variant == 'eager':
+            return self.network(x)
+        batch_size = x.shape[0]
+        x = self._pad_batch(x).contiguous(memory_format=self._get_memory_format(x.ndim))
+        return self._get_graph(variant, x)(x)[:batch_size].float()
+
+    def _get_labels(self, logits: torch.Tensor) -> torch.Tensor:
+        return logits > 0 if self.has_regions else logits.argmax(1)
+
+    def _select_variant(self, x: torch.Tensor) -> Tuple[str, torch.Tensor]:
+        reference = self.network(x)
+        reference_labels = self._get_labels(reference)
+        for variant in self.variants:
+            prediction = self._run(variant, x)
+            disagreement = (self._get_labels(prediction) != reference_labels).float().mean().item()
+            if disagreement <= self.tolerance:
+                print(f'cpu_engine: using {variant} graph (labels differ from eager fp32 in '
+                      f'{disagreement * 100:.3f}% of the voxels)')
+                return variant, prediction
+            print(f'cpu_engine: {variant} graph rejected, labels differ from eager fp32 in {disagreement * 100:.3f}% '
+                  f'of the voxels (tolerance {self.tolerance * 100:.3f}%)')
+            self.graphs = OrderedDict([(k, v) for k, v in self.graphs.items() if k[0] != variant])
+        print('cpu_engine: using the eager fp32 network')
+        self._channels_last_network = None
+        return 'eager', reference
+
+    @torch.inference_mode()
+    def __call__(self, x: torch.Tensor) -> torch.Tensor:
+        if self.variant is None:
+            self.variant, prediction = self._select_variant(x)
+            return prediction
+        return self._run(self.variant, x)
@@ -0,0 +1,157 @@
+from typing import List, Tuple, Any
+
+import torch
+from acvl_utils.cropping_and_padding.padding import pad_nd_image
+from torch._dynamo import OptimizedModule
+
+from nnunetv2.inference.sliding_window_prediction import compute_gaussian
+from nnunetv2.utilities.helpers import dummy_context, empty_cache
+from nnunetv2.utilities.label_handling.label_handling import determine_num_input_channels
+
+
+class CrossCaseTileBatcher(object):
+    """
+    Throughput mode for datasets of many small images (2d natural images, cell crops, ...) where each case consists of
+    only a handful of sliding window tiles. Instead of one tiny forward pass per case, the tiles of all queued cases
+    are pooled and predicted in shared batches of tile_batch_size. Each tile remembers the case it belongs to and a
+    case is handed back (see add_case and flush) as soon as all of its tiles are predicted.
+
+    Cases with more tiles than fit into one batch gain nothing from pooling and are not accepted (see accepts), use
+    predictor.predict_logits_from_preprocessed_data for them. Pooled cases keep their results arrays on the device
+    (if predictor.perform_everything_on_device) until they are complete, so memory planning and out-of-core
+    accumulation do not apply. analytic_weight_normalization is not used either.
+
+    Fold ensembles are only supported with resident_fold_networks, see can_batch_across_cases. Pooled tiles go through
+    predictor._internal_predict_tile_batch directly, so predictors that override predict_logits_from_preprocessed_data
+    (nnUNetROIPredictor, nnUNetCascadePredictor) must not use this. With progressive ensembling, the statistics of
+    all pooled cases are reported together in flush.
+    """
+    def __init__(self, predictor, tile_batch_size: int):
+        assert self.can_batch_across_cases(predictor), \
+            'cross case batching of fold ensembles requires resident_fold_networks'
+        self.predictor = predictor
+        self.tile_batch_size = tile_batch_size
+        self.results_device = predictor.device if predictor.perform_everything_on_device else torch.device('cpu')
+        self.num_input_channels = determine_num_input_channels(predictor.plans_manager,
+                                                               predictor.configuration_manager,
+                                                               predictor.dataset_json)
+        if predictor.use_gaussian:
+            self.gaussian = compute_gaussian(tuple(predictor.configuration_manager.patch_size), sigma_scale=1. / 8,
+                                             value_scaling_factor=10, device=self.results_device)
+        else:
+            self.gaussian = 1
+        # case id -> (predicted_logits, n_predictions, slicer_revert_padding, number of tiles not yet predicted,
+        # fill_not_predicted, context)
+        self.cases = {}
+        # (case id, padded data, slicer) of the tiles that are not predicted yet, in the order they were added
+        self.tiles = []
+        self.next_case_id = 0
+        # number of tiles predicted and number of tiles that got the full ensemble, see
+        # predictor._internal_predict_tile_batch_progressively. Cases predicted without us reset the counts of the
+        # predictor, so we keep our own
+        self.progressive_num_tiles = [0, 0]
+
+        predictor.network = predictor.network.to(predictor.device)
+        predictor.network.eval()
+        if predictor.fold_networks is not None:
+            predictor.fold_networks = [i.to(predictor.device) for i in predictor.fold_networks]
+        else:
+            # a single fold. Its weights are loaded once instead of once per case
+            network = predictor.network
+            if isinstance(network, OptimizedModule):
+                network = network._orig_mod
+            network.load_state_dict(predictor.list_of_parameters[0])
+
+    @staticmethod
+    def can_batch_across_cases(predictor) -> bool:
+        # without resident fold networks the weights of each fold would have to be loaded for every batch
+        return predictor.fold_networks is not None or len(predictor.list_of_parameters) == 1
+
+    def accepts(self, data: torch.Tensor) -> bool:
+        # data without the previous stage (cascade) must go through predictor.predict_logits_from_preprocessed_data
+        if data.shape[0] != self.num_input_channels:
+            return False
+        padded_shape = [max(i, j) for i, j in zip(data.shape[-len(self.predictor.configuration_manager.patch_size):],
+                                                  self.predictor.configuration_manager.patch_size)]
+        padded_shape = [*data.shape[1:len(data.shape) - len(padded_shape)], *padded_shape]
+        return len(self.predictor._internal_get_sliding_window_slicers(padded_shape)) <= self.tile_batch_size
+
+    @torch.inference_mode()
+    def add_case(self, data: torch.Tensor, context: Any) -> List[Tuple[torch.Tensor, Any]]:
+        """
+        Queues the tiles of data (preprocessed image, must be accepted by accepts) and predicts all full batches.
+        context is handed back together with the logits once the case is complete. Returns the list of
+        (logits, context) of all cases that were completed by this call.
+        """
+        case_id = self.next_case_id
+        self.next_case_id += 1
+        data, slicer_revert_padding = pad_nd_image(data, self.predictor.configuration_manager.patch_size,
+                                                   'constant', {'value': 0}, True, None)
+        data = data.to(self.results_device)
+        slicers = self.predictor._internal_get_sliding_window_slicers(data.shape[1:])
+        num_tiles_total = len(slicers)
+        slicers = self.predictor._internal_select_tiles_to_predict(data, slicers)
+        predicted_logits = self.predictor._internal_allocate_results_array(
+            (self.predictor.label_manager.num_segmentation_heads, *data.shape[1:]), self.results_device, True)
+        n_predictions = self.predictor._internal_allocate_results_array(data.shape[1:], self.results_device)
+        self.cases[case_id] = [predicted_logits, n_predictions, slicer_revert_padding, len(slicers),
+                               len(slicers) < num_tiles_total, context]
+        self.tiles += [(case_id, data, sl) for sl in slicers]
+
+        finished = []
+        if len(slicers) == 0:
+            # everything was skipped
+            finished.append(self._internal_finish_case(case_id))
+        while len(self.tiles) >= self.tile_batch_size:
+            finished += self._internal_predict_batch()
+        return finished
+
+    @torch.inference_mode()
+    def flush(self) -> List[Tuple[torch.Tensor, Any]]:
+        """
+        Predicts the remaining tiles (the last batch may not be full) and returns (logits, context) of all remaining
+        cases
+        """
+        finished = []
+        while len(self.tiles) > 0:
+            finished += self._internal_predict_batch()
+        assert len(self.cases) == 0
+        if self.progressive_num_tiles[0] > 0:
+            self.predictor._progressive_num_tiles = self.progressive_num_tiles
+            self.predictor._internal_report_progressive_ensembling()
+            self.progressive_num_tiles = [0, 0]
+        empty_cache(self.predictor.device)
+        return finished
+
+    def _internal_predict_batch(self) -> List[Tuple[torch.Tensor, Any]]:
+        batch = self.tiles[:self.tile_batch_size]
+        self.tiles = self.tiles[self.tile_batch_size:]
+        workon = torch.stack([data[sl] for _, data, sl in batch]).to(self.predictor.device)
+        # see predict_sliding_window_return_logits for why autocast is only used with cuda
+        with torch.autocast(self.predictor.device.type, enabled=True) if self.predictor.device.type == 'cuda' \
+                else dummy_context():
+            num_tiles_before = list(self.predictor._progressive_num_tiles)
+            prediction = self.predictor._internal_predict_tile_batch(workon).to(self.results_device)
+            self.progressive_num_tiles = [i + j - k for i, j, k in zip(self.progressive_num_tiles,
+                                                                        self.predictor._progressive_num_tiles,
+                                                                        num_tiles_before)]
+
+        finished = []
+        for p, (case_id, _, sl) in zip(prediction, batch):
+            case = self.cases[case_id]
+            p *= self.gaussian
+            case[0][sl] += p
+            case[1][sl[1:]] += self.gaussian
+            case[3] -= 1
+            if case[3] == 0:
+                finished.append(self._internal_finish_case(case_id))
+        return finished
+
+    def _internal_finish_case(self, case_id: int) -> Tuple[torch.Tensor, Any]:
+        predicted_logits, n_predictions, slicer_revert_padding, _, fill_not_predicted, context = \
+            self.cases.pop(case_id)
+        self.predictor._internal_normalize_logits(predicted_logits, n_predictions, fill_not_predicted)
+        if self.predictor.buffer_pool is not None:
+            self.predictor.buffer_pool.release(n_predictions)
+        predicted_logits = predicted_logits[(slice(None), *slicer_revert_padding[1:])]
+        return self.predictor._internal_to_host(predicted_logits), context
@@ -1,4 +1,5 @@
 import multiprocessing
+import os
 import queue
 from torch.multiprocessing import Event, Queue, Manager
 
@@ -9,6 +10,9 @@ import numpy as np
 import torch
 from batchgenerators.dataloading.data_loader import DataLoader
 
+from nnunetv2.inference.prediction_journal import PredictionJournal
+from nnunetv2.inference.shared_arrays import SharedArray, SharedArrayHandle, shared_array_nbytes, \
+    shared_memory_available, take_shared_array, discard_shared_array
 from nnunetv2.preprocessing.preprocessors.default_preprocessor import DefaultPreprocessor
 from nnunetv2.utilities.label_handling.label_handling import convert_labelmap_to_one_hot
 from nnunetv2.utilities.plans_handling.plans_handler import PlansManager, ConfigurationManager
@@ -23,29 +27,43 @@ def preprocess_fromfiles_save_to_queue(list_of_lists: List[List[str]],
                                        target_queue: Queue,
                                        done_event: Event,
                                        abort_event: Event,
-                                       verbose: bool = False):
+                                       verbose: bool = False,
+                                       journal: PredictionJournal = None):
     try:
         label_manager = plans_manager.get_label_manager(dataset_json)
         preprocessor = configuration_manager.preprocessor_class(verbose=verbose)
         for idx in range(len(list_of_lists)):
-            data, seg, data_properties = preprocessor.run_case(list_of_lists[idx],
-                                                               list_of_segs_from_prev_stage_files[
-                                                                   idx] if list_of_segs_from_prev_stage_files is not None else None,
-                                                               plans_manager,
-                                                               configuration_manager,
-                                                               dataset_json)
-            if list_of_segs_from_prev_stage_files is not None and list_of_segs_from_prev_stage_files[idx] is not None:
-                seg_onehot = convert_labelmap_to_one_hot(seg[0], label_manager.foreground_labels, data.dtype)
-                data = np.vstack((data, seg_onehot))
-
-            data = torch.from_numpy(data).to(dtype=torch.float32, memory_format=torch.contiguous_format)
-
-            item = {'data': data, 'data_properties': data_properties,
-                    'ofile': output_filenames_truncated[idx] if output_filenames_truncated is not None else None}
+            # with a journal, cases are only preprocessed if no other part has taken them yet. Skipped cases are
+            # announced with None: the consumer reads the queues round robin and expects one item per case
+            if journal is not None and not journal.claim(os.path.basename(output_filenames_truncated[idx])):
+                item = None
+            else:
+                data, seg, data_properties = preprocessor.run_case(list_of_lists[idx],
+                                                                   list_of_segs_from_prev_stage_files[
+                                                                       idx] if list_of_segs_from_prev_stage_files is not None else None,
+                                                                   plans_manager,
+                                                                   configuration_manager,
+                                                                   dataset_json)
+                if list_of_segs_from_prev_stage_files is not None and \
+                        list_of_segs_from_prev_stage_files[idx] is not None:
+                    seg_onehot = convert_labelmap_to_one_hot(seg[0], label_manager.foreground_labels, data.dtype)
+                    data = np.vstack((data, seg_onehot))
+
+                data = torch.from_numpy(data).to(dtype=torch.float32, memory_format=torch.contiguous_format)
+                if shared_memory_available(shared_array_nbytes(data)):
+                    # only a handle goes through the queue (and the manager process), the consumer takes it from there
+                    data = SharedArray(data).transfer()
+                if journal is not None:
+                    journal.set_state(os.path.basename(output_filenames_truncated[idx]), 'preprocessed')
+
+                item = {'data': data, 'data_properties': data_properties,
+                        'ofile': output_filenames_truncated[idx] if output_filenames_truncated is not None else None}
             success = False
             while not success:
                 try:
                     if abort_event.is_set():
+                        if item is not None and isinstance(item['data'], SharedArrayHandle):
+                            discard_shared_array(item['data'])
                         return
                     target_queue.put(item, timeout=0.01)
                     success = True
@@ -58,6 +76,63 @@ def preprocess_fromfiles_save_to_queue(list_of_lists: List[List[str]],
         raise e
 
 
+def preprocess_case_fromfiles(input_files: List[str],
+                              seg_from_prev_stage_file: Union[None, str],
+                              plans_manager: PlansManager,
+                              dataset_json: dict,
+                              configuration_manager: ConfigurationManager,
+                              verbose: bool = False):
+    """
+    Preprocesses a single case, for example in a worker pool. If seg_from_prev_stage_file is given (cascade), its
+    one-hot encoding is stacked onto the image just like in preprocess_fromfiles_save_to_queue.
+    Returns data (float32 np.ndarray) and data_properties.
+    """
+    preprocessor = configuration_manager.preprocessor_class(verbose=verbose)
+    data, seg, data_properties = preprocessor.run_case(input_files, seg_from_prev_stage_file, plans_manager,
+                                                       configuration_manager, dataset_json)
+    if seg_from_prev_stage_file is not None:
+        label_manager = plans_manager.get_label_manager(dataset_json)
+        seg_onehot = convert_labelmap_to_one_hot(seg[0], label_manager.foreground_labels, data.dtype)
+        data = np.vstack((data, seg_onehot))
+    return np.ascontiguousarray(data, dtype=np.float32), data_properties
+
+
+def preprocess_case_fromnpy(image: np.ndarray,
+                            seg_from_prev_stage: Union[None, np.ndarray],
+                            image_properties: dict,
+                            plans_manager: PlansManager,
+                            dataset_json: dict,
+                            configuration_manager: ConfigurationManager,
+                            verbose: bool = False):
+    """
+    Same as preprocess_case_fromfiles, but for an image that is already loaded (see PreprocessAdapterFromNpy).
+    Returns data (float32 np.ndarray) and data_properties.
+    """
+    preprocessor = configuration_manager.preprocessor_class(verbose=verbose)
+    data, seg, data_properties = preprocessor.run_case_npy(image, seg_from_prev_stage, image_properties,
+                                                           plans_manager, configuration_manager, dataset_json)
+    if seg_from_prev_stage is not None:
+        label_manager = plans_manager.get_label_manager(dataset_json)
+        seg_onehot = convert_labelmap_to_one_hot(seg[0], label_manager.foreground_labels, data.dtype)
+        data = np.vstack((data, seg_onehot))
+    return np.ascontiguousarray(data, dtype=np.float32), data_properties
+
+
+def _abort_workers(abort_event: Event, processes: list, target_queues: List[Queue]):
+    """
+    Stops the preprocessing workers and unlinks the shared memory of the cases that are still in their queues. Those
+    were handed over to us (see SharedArray.transfer) and nobody else would free them.
+    """
+    abort_event.set()
+    # workers discard what they hold once they see the abort_event, after that nothing is added to the queues anymore
+    [p.join() for p in processes]
+    for q in target_queues:
+        while not q.empty():
+            item = q.get()
+            if item is not None and isinstance(item['data'], SharedArrayHandle):
+                discard_shared_array(item['data'])
+
+
 def preprocessing_iterator_fromfiles(list_of_lists: List[List[str]],
                                      list_of_segs_from_prev_stage_files: Union[None, List[str]],
                                      output_filenames_truncated: Union[None, List[str]],
@@ -66,7 +141,12 @@ def preprocessing_iterator_fromfiles(list_of_lists: List[List[str]],
                                      configuration_manager: ConfigurationManager,
                                      num_processes: int,
                                      pin_memory: bool = False,
-                                     verbose: bool = False):
+                                     verbose: bool = False,
+                                     journal: PredictionJournal = None):
+    """
+    If journal is given, the workers claim each case before preprocessing it and skip the ones that are done or
+    claimed by somebody else, see PredictionJournal. Skipped cases are not yielded.
+    """
     context = multiprocessing.get_context('spawn')
     manager = Manager()
     num_processes = min(len(list_of_lists), num_processes)
@@ -91,7 +171,8 @@ def preprocessing_iterator_fromfiles(list_of_lists: List[List[str]],
                          queue,
                          event,
                          abort_event,
-                         verbose
+                         verbose,
+                         journal
                      ), daemon=True)
         pr.start()
         target_queues.append(queue)
@@ -99,23 +180,33 @@ def preprocessing_iterator_fromfiles(list_of_lists: List[List[str]],
         processes.append(pr)
 
     worker_ctr = 0
-    while (not done_events[worker_ctr].is_set()) or (not target_queues[worker_ctr].empty()):
-        # import IPython;IPython.embed()
-        if not target_queues[worker_ctr].empty():
-            item = target_queues[worker_ctr].get()
-            worker_ctr = (worker_ctr + 1) % num_processes
-        else:
-            all_ok = all(
-                [i.is_alive() or j.is_set() for i, j in zip(processes, done_events)]) and not abort_event.is_set()
-            if not all_ok:
-                raise RuntimeError('Background workers died. Look for the error message further up! If there is '
-                                   'none then your RAM was full and the worker was killed by the OS. Use fewer '
-                                   'workers or get more RAM in that case!')
-            sleep(0.01)
-            continue
-        if pin_memory:
-            [i.pin_memory() for i in item.values() if isinstance(i, torch.Tensor)]
-        yield item
+    try:
+        while (not done_events[worker_ctr].is_set()) or (not target_queues[worker_ctr].empty()):
+            # import IPython;IPython.embed()
+            if not target_queues[worker_ctr].empty():
+                item = target_queues[worker_ctr].get()
+                worker_ctr = (worker_ctr + 1) % num_processes
+            else:
+                all_ok = all(
+                    [i.is_alive() or j.is_set() for i, j in zip(processes, done_events)]) and not abort_event.is_set()
+                if not all_ok:
+                    raise RuntimeError('Background workers died. Look for the error message further up! If there is '
+                                       'none then your RAM was full and the worker was killed by the OS. Use fewer '
+                                       'workers or get more RAM in that case!')
+                sleep(0.01)
+                continue
+            if item is None:
+                # the worker skipped a case that is done or claimed by somebody else
+                continue
+            if isinstance(item['data'], SharedArrayHandle):
+                item['data'] = take_shared_array(item['data'], pin_memory)
+            elif pin_memory:
+                item['data'] = item['data'].pin_memory()
+            yield item
+    except BaseException:
+        # the consumer failed or stopped early (GeneratorExit), or the workers died
+        _abort_workers(abort_event, processes, target_queues)
+        raise
     [p.join() for p in processes]
 
 
@@ -236,6 +327,9 @@ def preprocess_fromnpy_save_to_queue(list_of_images: List[np.ndarray],
                 data = np.vstack((data, seg_onehot))
 
             data = torch.from_numpy(data).to(dtype=torch.float32, memory_format=torch.contiguous_format)
+            if shared_memory_available(shared_array_nbytes(data)):
+                # only a handle goes through the queue (and the manager process), the consumer takes it from there
+                data = SharedArray(data).transfer()
 
             item = {'data': data, 'data_properties': list_of_image_properties[idx],
                     'ofile': truncated_ofnames[idx] if truncated_ofnames is not None else None}
@@ -243,6 +337,8 @@ def preprocess_fromnpy_save_to_queue(list_of_images: List[np.ndarray],
             while not success:
                 try:
                     if abort_event.is_set():
+                        if isinstance(item['data'], SharedArrayHandle):
+                            discard_shared_array(item['data'])
                         return
                     target_queue.put(item, timeout=0.01)
                     success = True
@@ -296,20 +392,27 @@ def preprocessing_iterator_fromnpy(list_of_images: List[np.ndarray],
         target_queues.append(queue)
 
     worker_ctr = 0
-    while (not done_events[worker_ctr].is_set()) or (not target_queues[worker_ctr].empty()):
-        if not target_queues[worker_ctr].empty():
-            item = target_queues[worker_ctr].get()
-            worker_ctr = (worker_ctr + 1) % num_processes
-        else:
-            all_ok = all(
-                [i.is_alive() or j.is_set() for i, j in zip(processes, done_events)]) and not abort_event.is_set()
-            if not all_ok:
-                raise RuntimeError('Background workers died. Look for the error message further up! If there is '
-                                   'none then your RAM was full and the worker was killed by the OS. Use fewer '
-                                   'workers or get more RAM in that case!')
-            sleep(0.01)
-            continue
-        if pin_memory:
-            [i.pin_memory() for i in item.values() if isinstance(i, torch.Tensor)]
-        yield item
+    try:
+        while (not done_events[worker_ctr].is_set()) or (not target_queues[worker_ctr].empty()):
+            if not target_queues[worker_ctr].empty():
+                item = target_queues[worker_ctr].get()
+                worker_ctr = (worker_ctr + 1) % num_processes
+            else:
+                all_ok = all(
+                    [i.is_alive() or j.is_set() for i, j in zip(processes, done_events)]) and not abort_event.is_set()
+                if not all_ok:
+                    raise RuntimeError('Background workers died. Look for the error message further up! If there is '
+                                       'none then your RAM was full and the worker was killed by the OS. Use fewer '
+                                       'workers or get more RAM in that case!')
+                sleep(0.01)
+                continue
+            if isinstance(item['data'], SharedArrayHandle):
+                item['data'] = take_shared_array(item['data'], pin_memory)
+            elif pin_memory:
+                item['data'] = item['data'].pin_memory()
+            yield item
+    except BaseException:
+        # the consumer failed or stopped early (GeneratorExit), or the workers died
+        _abort_workers(abort_event, processes, target_queues)
+        raise
     [p.join() for p in processes]
@@ -1,45 +1,108 @@
-from typing import Union, List
+import os
+import shutil
+from typing import Union, List, Callable, Tuple
 
 import numpy as np
 import torch
 from acvl_utils.cropping_and_padding.bounding_boxes import insert_crop_into_image
-from batchgenerators.utilities.file_and_folder_operations import load_json, save_pickle
+from batchgenerators.utilities.file_and_folder_operations import load_json, save_pickle, join, maybe_mkdir_p
 
 from nnunetv2.configuration import default_num_processes
+from nnunetv2.inference.out_of_core import load_out_of_core_array, OutOfCoreArrayHandle
+from nnunetv2.inference.probability_store import save_probabilities as save_probabilities_to_file
+from nnunetv2.inference.shared_arrays import SharedArrayHandle, open_shared_array, close_shared_array
 from nnunetv2.training.dataloading.nnunet_dataset import nnUNetDatasetBlosc2
 from nnunetv2.utilities.label_handling.label_handling import LabelManager
 from nnunetv2.utilities.plans_handling.plans_handler import PlansManager, ConfigurationManager
 
 
-def convert_predicted_logits_to_segmentation_with_correct_shape(predicted_logits: Union[torch.Tensor, np.ndarray],
+def resample_logits_and_convert_to_segmentation(predicted_logits: Union[torch.Tensor, np.ndarray],
+                                                label_manager: LabelManager,
+                                                resampling_fn: Callable,
+                                                new_shape: Union[Tuple[int, ...], List[int]],
+                                                current_spacing: Union[Tuple[float, ...], List[float]],
+                                                new_spacing: Union[Tuple[float, ...], List[float]]) -> np.ndarray:
+    """
+    Same result as resampling predicted_logits with resampling_fn and then running
+    label_manager.convert_logits_to_segmentation, but we only ever resample one channel at a time. All our resampling
+    functions treat channels independently, so this is exact. Only a running argmax (or the label map for regions)
+    is kept at the target resolution, so the resampled logits of all channels never exist at the same time. For
+    models with many classes that is the largest memory peak of the entire inference.
+    """
+    segmentation = best_logits = None
+    for c in range(predicted_logits.shape[0]):
+        resampled = resampling_fn(predicted_logits[c:c + 1], new_shape, current_spacing, new_spacing)
+        if isinstance(resampled, torch.Tensor):
+            resampled = resampled.cpu().numpy()
+        if segmentation is None:
+            segmentation = np.zeros(resampled.shape[1:], dtype=np.uint16)
+        if label_manager.has_regions:
+            probabilities = label_manager.apply_inference_nonlin(resampled)
+            # regions later in regions_class_order overwrite earlier ones, just like in
+            # convert_probabilities_to_segmentation
+            segmentation[probabilities[0].numpy() > 0.5] = label_manager.regions_class_order[c]
+        elif best_logits is None:
+            # copy because resampled may be a view of predicted_logits if no resampling was necessary
+            best_logits = np.array(resampled[0])
+        else:
+            # strictly greater: ties go to the lower label, like argmax
+            better = resampled[0] > best_logits
+            segmentation[better] = c
+            best_logits[better] = resampled[0][better]
+        del resampled
+    return segmentation
+
+
+def convert_predicted_logits_to_segmentation_with_correct_shape(predicted_logits: Union[torch.Tensor, np.ndarray,
+                                                                                        OutOfCoreArrayHandle,
+                                                                                        SharedArrayHandle],
                                                                 plans_manager: PlansManager,
                                                                 configuration_manager: ConfigurationManager,
                                                                 label_manager: LabelManager,
                                                                 properties_dict: dict,
                                                                 return_probabilities: bool = False,
                                                                 num_threads_torch: int = default_num_processes):
+    """
+    predicted_logits can also be a handle to a .npy file written by out-of-core inference (see
+    nnunetv2.inference.out_of_core). The file is memory mapped and removed once we are done with it. Or a handle to
+    an array in shared memory (see nnunetv2.inference.shared_arrays), which is owned (and released) by the caller.
+    """
     old_threads = torch.get_num_threads()
     torch.set_num_threads(num_threads_torch)
 
+    logits_file = shm = None
+    if isinstance(predicted_logits, OutOfCoreArrayHandle):
+        logits_file = predicted_logits.fname
+        predicted_logits = load_out_of_core_array(predicted_logits)
+    elif isinstance(predicted_logits, SharedArrayHandle):
+        shm, predicted_logits = open_shared_array(predicted_logits)
+
     # resample to original shape
     spacing_transposed = [properties_dict['spacing'][i] for i in plans_manager.transpose_forward]
     current_spacing = configuration_manager.spacing if \
         len(configuration_manager.spacing) == \
         len(properties_dict['shape_after_cropping_and_before_resampling']) else \
         [spacing_transposed[0], *configuration_manager.spacing]
-    predicted_logits = configuration_manager.resampling_fn_probabilities(predicted_logits,
+    if not return_probabilities:
+        # resample channel by channel, the full resolution logits are never needed
+        segmentation = resample_logits_and_convert_to_segmentation(
+            predicted_logits, label_manager, configuration_manager.resampling_fn_probabilities,
+            properties_dict['shape_after_cropping_and_before_resampling'], current_spacing,
+            [properties_dict['spacing'][i] for i in plans_manager.transpose_forward])
+    else:
+        predicted_logits = configuration_manager.resampling_fn_probabilities(predicted_logits,
                                             properties_dict['shape_after_cropping_and_before_resampling'],
                                             current_spacing,
                                             [properties_dict['spacing'][i] for i in plans_manager.transpose_forward])
-    # return value of resampling_fn_probabilities can be ndarray or Tensor but that does not matter because
-    # apply_inference_nonlin will convert to torch
-    if not return_probabilities:
-        # this has a faster computation path becasue we can skip the softmax in regular (not region based) trainig
-        segmentation = label_manager.convert_logits_to_segmentation(predicted_logits)
-    else:
+        # return value of resampling_fn_probabilities can be ndarray or Tensor but that does not matter because
+        # apply_inference_nonlin will convert to torch
         predicted_probabilities = label_manager.apply_inference_nonlin(predicted_logits)
         segmentation = label_manager.convert_probabilities_to_segmentation(predicted_probabilities)
     del predicted_logits
+    if logits_file is not None:
+        os.remove(logits_file)
+    if shm is not None:
+        close_shared_array(shm)
 
     # put segmentation in bbox (revert cropping)
     segmentation_reverted_cropping = np.zeros(properties_dict['shape_before_cropping'],
@@ -71,12 +134,19 @@ def convert_predicted_logits_to_segmentation_with_correct_shape(predicted_logits
         return segmentation_reverted_cropping
 
 
-def export_prediction_from_logits(predicted_array_or_file: Union[np.ndarray, torch.Tensor], properties_dict: dict,
+def export_prediction_from_logits(predicted_array_or_file: Union[np.ndarray, torch.Tensor, OutOfCoreArrayHandle,
+                                                                  SharedArrayHandle],
+                                  properties_dict: dict,
                                   configuration_manager: ConfigurationManager,
                                   plans_manager: PlansManager,
                                   dataset_json_dict_or_file: Union[dict, str], output_file_truncated: str,
                                   save_probabilities: bool = False,
-                                  num_threads_torch: int = default_num_processes):
+                                  num_threads_torch: int = default_num_processes,
+                                  probabilities_format: str = 'npz'):
+    """
+    probabilities_format: file format of the probabilities if save_probabilities, see
+    nnunetv2.inference.probability_store
+    """
     # if isinstance(predicted_array_or_file, str):
     #     tmp = deepcopy(predicted_array_or_file)
     #     if predicted_array_or_file.endswith('.npy'):
@@ -95,22 +165,34 @@ def export_prediction_from_logits(predicted_array_or_file: Union[np.ndarray, tor
     )
     del predicted_array_or_file
 
-    # save
-    if save_probabilities:
-        segmentation_final, probabilities_final = ret
-        np.savez_compressed(output_file_truncated + '.npz', probabilities=probabilities_final)
-        save_pickle(properties_dict, output_file_truncated + '.pkl')
-        del probabilities_final, ret
-    else:
-        segmentation_final = ret
-        del ret
-
-    rw = plans_manager.image_reader_writer_class()
-    rw.write_seg(segmentation_final, output_file_truncated + dataset_json_dict_or_file['file_ending'],
-                 properties_dict)
-
-
-def resample_and_save(predicted: Union[torch.Tensor, np.ndarray], target_shape: List[int], output_file: str,
+    # save. Everything is written into a temporary folder first and then renamed into place, so an export that is
+    # interrupted (OOM, preempted node) never leaves files behind that look complete. The segmentation comes last
+    output_folder, case = os.path.split(output_file_truncated)
+    tmp_folder = join(output_folder, f'.partial_{os.getpid()}_{case}')
+    maybe_mkdir_p(tmp_folder)
+    try:
+        if save_probabilities:
+            segmentation_final, probabilities_final = ret
+            save_probabilities_to_file(probabilities_final, join(tmp_folder, case), probabilities_format,
+                                       num_threads_torch)
+            save_pickle(properties_dict, join(tmp_folder, case + '.pkl'))
+            del probabilities_final, ret
+        else:
+            segmentation_final = ret
+            del ret
+
+        rw = plans_manager.image_reader_writer_class()
+        segmentation_file = case + dataset_json_dict_or_file['file_ending']
+        rw.write_seg(segmentation_final, join(tmp_folder, segmentation_file), properties_dict)
+        # some writers create additional files next to the segmentation (tif: spacing json)
+        for f in sorted(os.listdir(tmp_folder), key=lambda x: x == segmentation_file):
+            os.replace(join(tmp_folder, f), join(output_folder, f))
+    finally:
+        shutil.rmtree(tmp_folder, ignore_errors=True)
+
+
+def resample_and_save(predicted: Union[torch.Tensor, np.ndarray, SharedArrayHandle], target_shape: List[int],
+                      output_file: str,
                       plans_manager: PlansManager, configuration_manager: ConfigurationManager, properties_dict: dict,
                       dataset_json_dict_or_file: Union[dict, str], num_threads_torch: int = default_num_processes,
                       dataset_class=None) \
@@ -130,17 +212,18 @@ def resample_and_save(predicted: Union[torch.Tensor, np.ndarray], target_shape:
     target_spacing = configuration_manager.spacing if len(configuration_manager.spacing) == \
         len(properties_dict['shape_after_cropping_and_before_resampling']) else \
         [spacing_transposed[0], *configuration_manager.spacing]
-    predicted_array_or_file = configuration_manager.resampling_fn_probabilities(predicted,
-                                                                                target_shape,
-                                                                                current_spacing,
-                                                                                target_spacing)
+    shm = None
+    if isinstance(predicted, SharedArrayHandle):
+        shm, predicted = open_shared_array(predicted)
 
-    # create segmentation (argmax, regions, etc)
+    # resample and create segmentation (argmax, regions, etc) channel by channel
     label_manager = plans_manager.get_label_manager(dataset_json_dict_or_file)
-    segmentation = label_manager.convert_logits_to_segmentation(predicted_array_or_file)
-    # segmentation may be torch.Tensor but we continue with numpy
-    if isinstance(segmentation, torch.Tensor):
-        segmentation = segmentation.cpu().numpy()
+    segmentation = resample_logits_and_convert_to_segmentation(predicted, label_manager,
+                                                               configuration_manager.resampling_fn_probabilities,
+                                                               target_shape, current_spacing, target_spacing)
+    del predicted
+    if shm is not None:
+        close_shared_array(shm)
 
     if dataset_class is None:
         nnUNetDatasetBlosc2.save_seg(segmentation.astype(dtype=np.uint8 if len(label_manager.foreground_labels) < 255 else np.uint16), output_file)
@@ -0,0 +1,201 @@
+"""
+Inference checkpoints hold only what nnUNetPredictor needs from a training checkpoint: the network weights (optionally
+fp16), the trainer name, the configuration and the allowed mirroring axes. Training checkpoints also contain optimizer
+and grad scaler state and the logging history and can only be unpickled with weights_only=False. Inference checkpoints
+are loaded with weights_only=True and mmap=True instead, so loading a model is almost instant and all processes that
+use the same fold share its weights through the page cache.
+
+The inference checkpoint of checkpoint_final.pth is checkpoint_final_inference.pth (see
+get_inference_checkpoint_name). nnUNetTrainer writes it at the end of training, nnUNetv2_export_model_to_zip
+(--inference_checkpoints) adds it to the exported model. For models trained before, use
+nnUNetv2_convert_to_inference_checkpoint. If there is no inference checkpoint, load_checkpoint_for_inference falls back
+to the regular checkpoint.
+
+Inference checkpoints remember size, modification time and sha256 of the checkpoint they were created from. If that
+checkpoint was replaced afterwards (for example by continuing the training), the inference checkpoint is outdated and
+load_checkpoint_for_inference ignores it (with a warning) in favor of the regular checkpoint. If only the modification
+time differs (copied or unzipped models), the checkpoint is hashed once and the new modification time is recorded.
+"""
+
+import argparse
+import hashlib
+import io
+import os
+from typing import Optional
+
+import torch
+from batchgenerators.utilities.file_and_folder_operations import isfile
+
+
+inference_checkpoint_suffix = '_inference.pth'
+
+
+def get_inference_checkpoint_name(checkpoint_name: str) -> str:
+    """
+    checkpoint_final.pth -> checkpoint_final_inference.pth. Works with paths as well
+    """
+    if checkpoint_name.endswith(inference_checkpoint_suffix):
+        return checkpoint_name
+    assert checkpoint_name.endswith('.pth'), f'unexpected checkpoint name {checkpoint_name}, must end with .pth'
+    return checkpoint_name[:-len('.pth')] + inference_checkpoint_suffix
+
+
+def _hash_file(filename: str) -> str:
+    h = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(16 * 1024 ** 2), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def get_checkpoint_file_info(checkpoint_file: str) -> dict:
+    """
+    Identifies the content of checkpoint_file. Stored in the inference checkpoint as 'source_checkpoint'
+    """
+    stat = os.stat(checkpoint_file)
+    return {'size': int(stat.st_size), 'mtime_ns': int(stat.st_mtime_ns), 'sha256': _hash_file(checkpoint_file)}
+
+
+def _is_created_from(source_checkpoint: Optional[dict], checkpoint_file: str) -> bool:
+    """
+    True if source_checkpoint (see get_checkpoint_file_info) describes checkpoint_file as it is now. The file is only
+    hashed if size matches and mtime does not (copying and unzipping do not necessarily preserve mtimes)
+    """
+    if source_checkpoint is None:
+        return False
+    stat = os.stat(checkpoint_file)
+    if stat.st_size != source_checkpoint['size']:
+        return False
+    if stat.st_mtime_ns == source_checkpoint['mtime_ns']:
+        return True
+    return _hash_file(checkpoint_file) == source_checkpoint['sha256']
+
+
+def _is_current(inference_checkpoint_file: str, checkpoint: dict, checkpoint_file: str) -> bool:
+    """
+    _is_created_from for the loaded inference checkpoint. If the content of checkpoint_file only matched by hash
+    (models installed from a zip do not keep mtimes), the new mtime is written back to inference_checkpoint_file so
+    that subsequent loads do not have to hash the training checkpoint again
+    """
+    source_checkpoint = checkpoint.get('source_checkpoint')
+    if not _is_created_from(source_checkpoint, checkpoint_file):
+        return False
+    mtime_ns = int(os.stat(checkpoint_file).st_mtime_ns)
+    if mtime_ns != source_checkpoint['mtime_ns']:
+        checkpoint['source_checkpoint'] = {**source_checkpoint, 'mtime_ns': mtime_ns}
+        tmp = inference_checkpoint_file + f'.tmp_{os.getpid()}'
+        try:
+            # checkpoint may be memory mapped from inference_checkpoint_file, so we must not write into it directly
+            torch.save(checkpoint, tmp)
+            os.replace(tmp, inference_checkpoint_file)
+        except OSError as e:
+            # read-only model folder, or Windows refusing to replace a mapped file. We just hash again next time
+            print(f'Could not update {inference_checkpoint_file}: {e}')
+            if isfile(tmp):
+                os.remove(tmp)
+    return True
+
+
+def convert_to_inference_checkpoint(checkpoint: dict, fp16: bool = False,
+                                    source_checkpoint: Optional[dict] = None) -> dict:
+    """
+    Strips a training checkpoint (see nnUNetTrainer.save_checkpoint) down to what is needed for inference. Everything
+    that is kept can be loaded with weights_only=True. source_checkpoint is the get_checkpoint_file_info of the file
+    checkpoint was loaded from. Without it, the inference checkpoint is only used if the training checkpoint is absent
+    """
+    network_weights = {k: v.half() if fp16 and torch.is_floating_point(v) else v for k, v in
+                       checkpoint['network_weights'].items()}
+    allowed_mirroring_axes = checkpoint.get('inference_allowed_mirroring_axes')
+    return {
+        'network_weights': network_weights,
+        'trainer_name': checkpoint['trainer_name'],
+        'init_args': {'configuration': checkpoint['init_args']['configuration']},
+        'inference_allowed_mirroring_axes': tuple([int(i) for i in allowed_mirroring_axes])
+        if allowed_mirroring_axes is not None else None,
+        'source_checkpoint': source_checkpoint,
+    }
+
+
+def _load_and_convert(checkpoint_file: str, fp16: bool) -> dict:
+    source_checkpoint = get_checkpoint_file_info(checkpoint_file)
+    checkpoint = torch.load(checkpoint_file, map_location=torch.device('cpu'), weights_only=False)
+    return convert_to_inference_checkpoint(checkpoint, fp16, source_checkpoint)
+
+
+def save_inference_checkpoint(checkpoint_file: str, output_file: str = None, fp16: bool = False) -> str:
+    """
+    Writes the inference checkpoint of checkpoint_file to output_file (default: get_inference_checkpoint_name).
+    Returns output_file
+    """
+    if output_file is None:
+        output_file = get_inference_checkpoint_name(checkpoint_file)
+    assert output_file != checkpoint_file, 'the inference checkpoint must not overwrite the training checkpoint'
+    torch.save(_load_and_convert(checkpoint_file, fp16), output_file)
+    return output_file
+
+
+def inference_checkpoint_to_bytes(checkpoint_file: str, fp16: bool = False) -> bytes:
+    """
+    Same as save_inference_checkpoint, but returns the content of the file instead of writing it (used for zip export)
+    """
+    buffer = io.BytesIO()
+    torch.save(_load_and_convert(checkpoint_file, fp16), buffer)
+    return buffer.getvalue()
+
+
+def _load_inference_checkpoint(inference_checkpoint_file: str) -> dict:
+    return torch.load(inference_checkpoint_file, map_location=torch.device('cpu'), weights_only=True, mmap=True)
+
+
+def inference_checkpoint_is_current(checkpoint_file: str) -> bool:
+    """
+    True if the inference checkpoint of checkpoint_file exists and was created from checkpoint_file as it is now
+    """
+    inference_checkpoint_file = get_inference_checkpoint_name(checkpoint_file)
+    if not isfile(inference_checkpoint_file):
+        return False
+    if not isfile(checkpoint_file):
+        return True
+    return _is_current(inference_checkpoint_file, _load_inference_checkpoint(inference_checkpoint_file),
+                       checkpoint_file)
+
+
+def load_checkpoint_for_inference(checkpoint_file: str) -> dict:
+    """
+    Loads the inference checkpoint of checkpoint_file (weights_only, memory mapped) if it exists and is not outdated.
+    Otherwise falls back to checkpoint_file itself. The returned dict has at least the keys of
+    convert_to_inference_checkpoint.
+    """
+    inference_checkpoint_file = get_inference_checkpoint_name(checkpoint_file)
+    if isfile(inference_checkpoint_file):
+        checkpoint = _load_inference_checkpoint(inference_checkpoint_file)
+        if not isfile(checkpoint_file) or _is_current(inference_checkpoint_file, checkpoint, checkpoint_file):
+            return checkpoint
+        print(f'WARNING: {inference_checkpoint_file} was not created from the current {checkpoint_file} (was the '
+              f'model trained again?). Loading {checkpoint_file} instead. Run nnUNetv2_convert_to_inference_checkpoint '
+              f'to update the inference checkpoint')
+    return torch.load(checkpoint_file, map_location=torch.device('cpu'), weights_only=False)
+
+
+def inference_checkpoint_exists(checkpoint_file: str) -> bool:
+    return isfile(checkpoint_file) or isfile(get_inference_checkpoint_name(checkpoint_file))
+
+
+def convert_to_inference_checkpoint_entry_point():
+    parser = argparse.ArgumentParser(description='Creates weights-only inference checkpoints (for example '
+                                                 'checkpoint_final_inference.pth) next to existing training '
+                                                 'checkpoints. nnUNetv2_predict loads them instead of the training '
+                                                 'checkpoints, which is much faster.')
+    parser.add_argument('checkpoints', nargs='+', type=str,
+                        help='Training checkpoints to convert, for example '
+                             '$nnUNet_results/Dataset001_X/nnUNetTrainer__nnUNetPlans__3d_fullres/fold_*/'
+                             'checkpoint_final.pth')
+    parser.add_argument('--fp16', action='store_true', required=False, default=False,
+                        help='Store the weights in fp16. Halves the file size, the predictions may change slightly')
+    args = parser.parse_args()
+    for checkpoint_file in args.checkpoints:
+        print(f'wrote {save_inference_checkpoint(checkpoint_file, fp16=args.fp16)}')
+
+
+if __name__ == '__main__':
+    convert_to_inference_checkpoint_entry_point()
@@ -0,0 +1,301 @@
+import argparse
+import itertools
+import json
+import multiprocessing
+import traceback
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from queue import PriorityQueue
+from threading import Thread, Lock, Condition
+from typing import Union, List, Tuple, Dict
+
+import torch
+
+from nnunetv2.configuration import default_num_processes
+from nnunetv2.inference.data_iterators import preprocess_case_fromfiles
+from nnunetv2.inference.export_prediction import export_prediction_from_logits
+from nnunetv2.inference.predict_from_raw_data import nnUNetPredictor
+from nnunetv2.inference.shared_arrays import SharedArray
+from nnunetv2.utilities.helpers import empty_cache
+
+
+class nnUNetInferenceService(object):
+    """
+    Long running inference service. Models (with the weights of all their folds) are loaded once and the
+    preprocessing and export worker pools are kept alive, so a request only pays for the actual preprocessing,
+    prediction and export and not for interpreter startup, checkpoint loading, network construction and spawning
+    worker processes.
+
+    Jobs are predicted one after the other (one GPU, one predictor at a time) in order of their priority (lower
+    value first) and, within the same priority, in the order in which they were submitted. Preprocessing starts in
+    the background as soon as a job is submitted and export runs in the background as well, so both overlap with the
+    prediction of other jobs.
+
+    Usage:
+        service = nnUNetInferenceService(torch.device('cuda'))
+        service.load_model('liver', model_training_output_dir, use_folds=(0, 1, 2, 3, 4))
+        job_id = service.submit('liver', ['/data/case_0000.nii.gz'], '/out/case')
+        service.serve('127.0.0.1', 8765)  # optional, HTTP API, see make_request_handler
+    """
+    def __init__(self,
+                 device: torch.device = torch.device('cuda'),
+                 num_processes_preprocessing: int = default_num_processes,
+                 num_processes_segmentation_export: int = default_num_processes,
+                 predictor_kwargs: dict = None,
+                 verbose: bool = False):
+        """
+        predictor_kwargs are passed to nnUNetPredictor (tile_step_size, use_mirroring, resident_fold_networks etc).
+        """
+        self.device = device
+        self.predictor_kwargs = predictor_kwargs if predictor_kwargs is not None else {}
+        self.verbose = verbose
+        self.predictors: Dict[str, nnUNetPredictor] = {}
+
+        context = multiprocessing.get_context('spawn')
+        self.preprocessing_pool = context.Pool(num_processes_preprocessing)
+        self.export_pool = context.Pool(num_processes_segmentation_export)
+        # don't let finished predictions pile up in RAM if export cannot keep up
+        self.max_pending_exports = 2 * num_processes_segmentation_export
+
+        self.jobs: Dict[str, dict] = {}
+        self._job_queue = PriorityQueue()
+        self._job_counter = itertools.count()
+        self._lock = Lock()
+        self._export_done = Condition(self._lock)
+        self._num_pending_exports = 0
+
+        self._worker = Thread(target=self._run_jobs, daemon=True)
+        self._worker.start()
+
+    def load_model(self, name: str, model_training_output_dir: str,
+                   use_folds: Union[Tuple[Union[int, str]], None] = None,
+                   checkpoint_name: str = 'checkpoint_final.pth'):
+        predictor = nnUNetPredictor(device=self.device, verbose=self.verbose, allow_tqdm=False,
+                                    **self.predictor_kwargs)
+        predictor.initialize_from_trained_model_folder(model_training_output_dir, use_folds, checkpoint_name)
+        # the predictions are handed to the export workers, see nnUNetPredictor._internal_share_prediction
+        predictor.share_results = True
+        with self._lock:
+            self.predictors[name] = predictor
+        print(f'Loaded model {name} from {model_training_output_dir}, folds {use_folds}')
+
+    def submit(self, model: str, input_files: List[str], output_file_truncated: str, priority: int = 0,
+               save_probabilities: bool = False, seg_from_prev_stage_file: str = None) -> str:
+        """
+        Queues the prediction of one case. input_files are the files of all input channels (_0000, _0001, ...),
+        output_file_truncated is the output file without file ending. Returns the job id.
+        """
+        assert model in self.predictors, f'Unknown model {model}. Loaded models: {list(self.predictors.keys())}'
+        assert isinstance(input_files, (list, tuple)) and len(input_files) > 0, \
+            'input_files must be a non-empty list of files (one per input channel)'
+        # priorities are compared with each other in self._job_queue, anything but int breaks it
+        assert isinstance(priority, int) and not isinstance(priority, bool), \
+            f'priority must be an integer, got {priority!r}'
+        predictor = self.predictors[model]
+        if predictor.configuration_manager.previous_stage_name is not None:
+            assert seg_from_prev_stage_file is not None, \
+                f'Model {model} is a cascade model and requires seg_from_prev_stage_file'
+
+        job_number = next(self._job_counter)
+        job_id = str(job_number)
+        preprocessing = self.preprocessing_pool.apply_async(
+            preprocess_case_fromfiles,
+            (list(input_files), seg_from_prev_stage_file, predictor.plans_manager, predictor.dataset_json,
+             predictor.configuration_manager)
+        )
+        with self._lock:
+            self.jobs[job_id] = {'model': model, 'status': 'queued', 'priority': priority,
+                                 'output_file_truncated': output_file_truncated, 'error': None}
+        self._job_queue.put((priority, job_number, job_id, preprocessing, save_probabilities))
+        return job_id
+
+    def get_job(self, job_id: str) -> Union[dict, None]:
+        with self._lock:
+            job = self.jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+    def _set_job_status(self, job_id: str, status: str, error: str = None):
+        with self._lock:
+            self.jobs[job_id]['status'] = status
+            if error is not None:
+                self.jobs[job_id]['error'] = error
+
+    def _export_finished(self, job_id: str, shared_prediction: Union[SharedArray, None], error: str = None):
+        if shared_prediction is not None:
+            shared_prediction.release()
+        self._set_job_status(job_id, 'done' if error is None else 'failed', error)
+        with self._export_done:
+            self._num_pending_exports -= 1
+            self._export_done.notify_all()
+
+    def _run_jobs(self):
+        while True:
+            job_id = None
+            try:
+                # a bad item must not end this thread, it is the only one that works on the jobs
+                priority, job_number, job_id, preprocessing, save_probabilities = self._job_queue.get()
+                if job_id is None:
+                    break
+                self._set_job_status(job_id, 'preprocessing')
+                data, data_properties = preprocessing.get()
+
+                with self._export_done:
+                    while self._num_pending_exports >= self.max_pending_exports:
+                        self._export_done.wait()
+
+                self._set_job_status(job_id, 'predicting')
+                # self.jobs and self.predictors are shared with the request handler threads
+                with self._lock:
+                    job = self.jobs[job_id]
+                    predictor = self.predictors[job['model']]
+                    output_file_truncated = job['output_file_truncated']
+                prediction, shared_prediction = predictor._internal_share_prediction(
+                    predictor.predict_logits_from_preprocessed_data(torch.from_numpy(data)))
+                del data
+
+                self._set_job_status(job_id, 'exporting')
+                with self._lock:
+                    self._num_pending_exports += 1
+                self.export_pool.apply_async(
+                    export_prediction_from_logits,
+                    (prediction, data_properties, predictor.configuration_manager, predictor.plans_manager,
+                     predictor.dataset_json, output_file_truncated, save_probabilities,
+                     default_num_processes, predictor.probabilities_format),
+                    callback=lambda _, j=job_id, sp=shared_prediction: self._export_finished(j, sp),
+                    error_callback=lambda e, j=job_id, sp=shared_prediction: self._export_finished(j, sp, repr(e))
+                )
+                del prediction, shared_prediction
+            except Exception as e:
+                traceback.print_exc()
+                if job_id is not None:
+                    self._set_job_status(job_id, 'failed', repr(e))
+                empty_cache(self.device)
+
+    def shutdown(self):
+        # the sentinel sorts after all regular jobs, so everything that was queued is still predicted
+        self._job_queue.put((float('inf'), float('inf'), None, None, None))
+        self._worker.join()
+        with self._export_done:
+            while self._num_pending_exports > 0:
+                self._export_done.wait()
+        self.preprocessing_pool.close()
+        self.export_pool.close()
+        self.preprocessing_pool.join()
+        self.export_pool.join()
+
+    def serve(self, host: str = '127.0.0.1', port: int = 8765):
+        """
+        Serves the HTTP API until interrupted. Only bind to something other than localhost if you know what you are
+        doing, there is no authentication whatsoever!
+        """
+        server = ThreadingHTTPServer((host, port), make_request_handler(self))
+        print(f'nnU-Net inference service listening on http://{host}:{port}')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            self.shutdown()
+
+
+def make_request_handler(service: nnUNetInferenceService):
+    """
+    HTTP API (JSON in, JSON out):
+        GET  /models          -> {"models": [names of the loaded models]}
+        POST /predict         -> {"job_id": "..."}. Body: the arguments of nnUNetInferenceService.submit, for example
+                                 {"model": "liver", "input_files": ["/data/case_0000.nii.gz"],
+                                  "output_file_truncated": "/out/case", "priority": 0}
+        GET  /jobs/<job_id>   -> {"model": ..., "status": queued|preprocessing|predicting|exporting|done|failed,
+                                  "priority": ..., "output_file_truncated": ..., "error": ...}
+    """
+    class nnUNetInferenceRequestHandler(BaseHTTPRequestHandler):
+        def _send_json(self, code: int, content: dict):
+            body = json.dumps(content).encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == '/models':
+                self._send_json(200, {'models': list(service.predictors.keys())})
+            elif self.path.startswith('/jobs/'):
+                job = service.get_job(self.path[len('/jobs/'):])
+                if job is None:
+                    self._send_json(404, {'error': 'unknown job id'})
+                else:
+                    self._send_json(200, job)
+            else:
+                self._send_json(404, {'error': f'unknown path {self.path}'})
+
+        def do_POST(self):
+            if self.path != '/predict':
+                self._send_json(404, {'error': f'unknown path {self.path}'})
+                return
+            try:
+                request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                job_id = service.submit(**request)
+            except (AssertionError, TypeError, ValueError) as e:
+                self._send_json(400, {'error': repr(e)})
+                return
+            self._send_json(200, {'job_id': job_id})
+
+    return nnUNetInferenceRequestHandler
+
+
+def inference_service_entry_point():
+    parser = argparse.ArgumentParser(description='Runs nnU-Net as a persistent local inference service with an HTTP '
+                                                 'API. Models stay loaded and worker pools stay alive between '
+                                                 'requests. See nnunetv2.inference.inference_service for the API.')
+    parser.add_argument('-m', nargs=2, action='append', required=True, metavar=('NAME', 'MODEL_FOLDER'),
+                        help='Name under which a model is served and its training output folder (the one '
+                             'containing the fold_X subfolders). Can be given multiple times.')
+    parser.add_argument('-f', nargs='+', type=str, required=False, default=(0, 1, 2, 3, 4),
+                        help='Folds used for all models. Default: (0, 1, 2, 3, 4)')
+    parser.add_argument('-chk', type=str, required=False, default='checkpoint_final.pth',
+                        help='Name of the checkpoint you want to use. Default: checkpoint_final.pth')
+    parser.add_argument('-host', type=str, required=False, default='127.0.0.1',
+                        help='Host to bind to. Default: 127.0.0.1 (local only, there is no authentication!)')
+    parser.add_argument('-port', type=int, required=False, default=8765,
+                        help='Port to listen on. Default: 8765')
+    parser.add_argument('-step_size', type=float, required=False, default=0.5,
+                        help='Step size for sliding window prediction. Default: 0.5')
+    parser.add_argument('--disable_tta', action='store_true', required=False, default=False,
+                        help='Set this flag to disable test time data augmentation in the form of mirroring.')
+    parser.add_argument('--resident_fold_networks', action='store_true', required=False, default=False,
+                        help='Keep one network per fold on the device instead of reloading the weights of each fold '
+                             'for every case.')
+    parser.add_argument('-npp', type=int, required=False, default=3,
+                        help='Number of processes used for preprocessing. Default: 3')
+    parser.add_argument('-nps', type=int, required=False, default=3,
+                        help='Number of processes used for segmentation export. Default: 3')
+    parser.add_argument('-device', type=str, default='cuda', required=False,
+                        help="Use this to set the device the inference should run with. Available options are 'cuda' "
+                             "(GPU), 'cpu' (CPU) and 'mps' (Apple M1/M2).")
+    parser.add_argument('--verbose', action='store_true', required=False, default=False,
+                        help='Set this if you like being talked to.')
+    args = parser.parse_args()
+    args.f = [i if i == 'all' else int(i) for i in args.f]
+
+    assert args.device in ['cpu', 'cuda', 'mps'], \
+        f'-device must be either cpu, mps or cuda. Other devices are not tested/supported. Got: {args.device}.'
+    if args.device == 'cpu':
+        torch.set_num_threads(multiprocessing.cpu_count())
+    elif args.device == 'cuda':
+        # multithreading in torch doesn't help nnU-Net if run on GPU
+        torch.set_num_threads(1)
+        torch.set_num_interop_threads(1)
+
+    service = nnUNetInferenceService(torch.device(args.device), args.npp, args.nps,
+                                     predictor_kwargs={'tile_step_size': args.step_size,
+                                                       'use_mirroring': not args.disable_tta,
+                                                       'resident_fold_networks': args.resident_fold_networks},
+                                     verbose=args.verbose)
+    for name, model_folder in args.m:
+        service.load_model(name, model_folder, args.f, args.chk)
+    service.serve(args.host, args.port)
+
+
+if __name__ == '__main__':
+    inference_service_entry_point()
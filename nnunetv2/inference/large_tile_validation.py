@@ -0,0 +1,134 @@
+import argparse
+from time import time
+from typing import Union, Tuple, List
+
+import torch
+from batchgenerators.utilities.file_and_folder_operations import join, maybe_mkdir_p, save_json
+
+from nnunetv2.configuration import default_num_processes
+from nnunetv2.evaluation.evaluate_predictions import compute_metrics_on_folder
+from nnunetv2.inference.predict_from_raw_data import nnUNetPredictor
+from nnunetv2.utilities.json_export import recursive_fix_for_json_export
+
+
+def validate_large_tile_mode(model_training_output_dir: str,
+                             use_folds: Union[Tuple[Union[int, str], ...], List[Union[int, str]]],
+                             input_folder: str,
+                             output_folder: str,
+                             large_tile_memory_budget_gb: float,
+                             reference_folder: str = None,
+                             checkpoint_name: str = 'checkpoint_final.pth',
+                             device: torch.device = torch.device('cuda'),
+                             tile_step_size: float = 0.5,
+                             use_mirroring: bool = True,
+                             num_processes: int = default_num_processes) -> dict:
+    """
+    Predicts the images in input_folder (a held-out set that was not used for training!) twice, with the default
+    tiling (output_folder/default) and with large tiles (output_folder/large_tiles, see large_tile_memory_budget_gb in
+    nnUNetPredictor), and compares the Dice scores of both.
+
+    If reference_folder (ground truth segmentations) is given, both predictions are evaluated against it and the
+    Dice delta (large tiles - default) is reported. Otherwise the large tile predictions are evaluated against the
+    default predictions, which shows how much large tiles change the result.
+
+    The summary (mean Dice per label/region, foreground mean, deltas and prediction times) is returned and written to
+    output_folder/large_tile_validation.json.
+    """
+    maybe_mkdir_p(output_folder)
+    times = {}
+    predictor = None
+    for mode, budget in (('default', None), ('large_tiles', large_tile_memory_budget_gb)):
+        predictor = nnUNetPredictor(tile_step_size=tile_step_size, use_mirroring=use_mirroring, device=device,
+                                    allow_tqdm=False, large_tile_memory_budget_gb=budget)
+        predictor.initialize_from_trained_model_folder(model_training_output_dir, use_folds, checkpoint_name)
+        st = time()
+        # predict_from_files_sequential so that the time is not distorted by preprocessing and export workers
+        maybe_mkdir_p(join(output_folder, mode))
+        predictor.predict_from_files_sequential(input_folder, join(output_folder, mode))
+        times[mode] = time() - st
+        print(f'{mode}: prediction took {times[mode]:.2f} s')
+
+    file_ending = predictor.dataset_json['file_ending']
+    label_manager = predictor.label_manager
+    regions_or_labels = label_manager.foreground_regions if label_manager.has_regions else \
+        label_manager.foreground_labels
+
+    def evaluate(folder_ref: str, mode: str) -> dict:
+        return compute_metrics_on_folder(folder_ref, join(output_folder, mode),
+                                         join(output_folder, mode, 'summary.json'),
+                                         predictor.plans_manager.image_reader_writer_class(), file_ending,
+                                         regions_or_labels, label_manager.ignore_label, num_processes)
+
+    if reference_folder is not None:
+        metrics = {mode: evaluate(reference_folder, mode) for mode in ('default', 'large_tiles')}
+        result = {
+            'reference': reference_folder,
+            'dice_default': {k: v['Dice'] for k, v in metrics['default']['mean'].items()},
+            'dice_large_tiles': {k: v['Dice'] for k, v in metrics['large_tiles']['mean'].items()},
+            'foreground_mean_dice_default': metrics['default']['foreground_mean']['Dice'],
+            'foreground_mean_dice_large_tiles': metrics['large_tiles']['foreground_mean']['Dice'],
+        }
+        result['dice_delta'] = {k: result['dice_large_tiles'][k] - result['dice_default'][k] for k in
+                                result['dice_default'].keys()}
+        result['foreground_mean_dice_delta'] = result['foreground_mean_dice_large_tiles'] - \
+                                               result['foreground_mean_dice_default']
+    else:
+        metrics = evaluate(join(output_folder, 'default'), 'large_tiles')
+        result = {
+            'reference': 'default',
+            'dice_large_tiles_vs_default': {k: v['Dice'] for k, v in metrics['mean'].items()},
+            'foreground_mean_dice_large_tiles_vs_default': metrics['foreground_mean']['Dice'],
+        }
+    result['time_default'] = times['default']
+    result['time_large_tiles'] = times['large_tiles']
+    result['large_tile_memory_budget_gb'] = large_tile_memory_budget_gb
+    recursive_fix_for_json_export(result)
+    save_json(result, join(output_folder, 'large_tile_validation.json'), sort_keys=False)
+
+    if reference_folder is not None:
+        print(f"Foreground mean Dice: default {result['foreground_mean_dice_default']:.4f}, large tiles "
+              f"{result['foreground_mean_dice_large_tiles']:.4f}, delta {result['foreground_mean_dice_delta']:+.4f}")
+    else:
+        print(f"Foreground mean Dice of large tiles vs default: "
+              f"{result['foreground_mean_dice_large_tiles_vs_default']:.4f}")
+    print(f"Prediction time: default {times['default']:.2f} s, large tiles {times['large_tiles']:.2f} s")
+    return result
+
+
+def validate_large_tile_mode_entry_point():
+    parser = argparse.ArgumentParser(description='Measures the Dice delta of large tile inference '
+                                                 '(-large_tile_memory_gb in nnUNetv2_predict) compared to the default '
+                                                 'tiling on a held-out set.')
+    parser.add_argument('-i', type=str, required=True,
+                        help='Input folder with held-out images (not used for training!)')
+    parser.add_argument('-o', type=str, required=True,
+                        help='Output folder. Predictions of both modes and the summary are written there')
+    parser.add_argument('-m', type=str, required=True,
+                        help='Folder in which the trained model is. Must have subfolders fold_X for the different '
+                             'folds you trained')
+    parser.add_argument('-ref', type=str, required=False, default=None,
+                        help='Folder with the ground truth segmentations of the images in -i. If not given, the large '
+                             'tile predictions are compared with the default predictions')
+    parser.add_argument('-large_tile_memory_gb', type=float, required=True,
+                        help='Memory budget (in GB) for one forward pass, see nnUNetv2_predict')
+    parser.add_argument('-f', nargs='+', type=str, required=False, default=(0, 1, 2, 3, 4),
+                        help='Folds of the trained model that should be used. Default: (0, 1, 2, 3, 4)')
+    parser.add_argument('-chk', type=str, required=False, default='checkpoint_final.pth',
+                        help='Name of the checkpoint you want to use. Default: checkpoint_final.pth')
+    parser.add_argument('-step_size', type=float, required=False, default=0.5,
+                        help='Step size for sliding window prediction. Default: 0.5')
+    parser.add_argument('--disable_tta', action='store_true', required=False, default=False,
+                        help='Set this flag to disable test time data augmentation in the form of mirroring.')
+    parser.add_argument('-np', type=int, required=False, default=default_num_processes,
+                        help=f'Number of processes used for the evaluation. Default: {default_num_processes}')
+    parser.add_argument('-device', type=str, default='cuda', required=False,
+                        help="Use this to set the device the inference should run with. Available options are 'cuda' "
+                             "(GPU), 'cpu' (CPU) and 'mps' (Apple M1/M2).")
+    args = parser.parse_args()
+    args.f = [i if i == 'all' else int(i) for i in args.f]
+    validate_large_tile_mode(args.m, args.f, args.i, args.o, args.large_tile_memory_gb, args.ref, args.chk,
+                             torch.device(args.device), args.step_size, not args.disable_tta, args.np)
+
+
+if __name__ == '__main__':
+    validate_large_tile_mode_entry_point()
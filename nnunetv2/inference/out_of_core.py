@@ -0,0 +1,122 @@
+import atexit
+import gc
+import os
+import weakref
+from tempfile import gettempdir
+from typing import Tuple, Union, Dict, Optional, List
+from uuid import uuid4
+
+import numpy as np
+import torch
+from batchgenerators.utilities.file_and_folder_operations import join, maybe_mkdir_p
+
+from nnunetv2.utilities.helpers import get_crop_of_view
+
+
+class OutOfCoreArrayHandle(object):
+    """
+    Picklable reference to (a crop of) an array written by OutOfCoreArrays. This is what gets sent to the export
+    workers instead of the array itself. Open it with load_out_of_core_array.
+    """
+    def __init__(self, fname: str, slicer: Tuple[slice, ...]):
+        self.fname = fname
+        self.slicer = slicer
+
+
+class OutOfCoreArrays(object):
+    """
+    Creates torch tensors that are backed by memory mapped .npy files instead of RAM. The operating system pages the
+    parts of the file that are currently being worked on in and out, so the resident memory is bounded by the working
+    set (the sliding window processes the image in order along the first spatial axis) and not by the size of the
+    array.
+
+    Tensors created with keep_file=False have their file removed right away. The space on disk is freed once the
+    tensor is garbage collected. Windows does not allow removing files that are still mapped, there the removal is
+    retried on later calls and at exit, once the tensor (and with it the memmap) is gone. Tensors created with
+    keep_file=True are registered so that the file backing them (or a crop of it) can be handed to another process
+    (see get_handle). Their file is removed with release or, if it was not handed over, once the tensor and all of
+    its views are garbage collected.
+    """
+    def __init__(self, folder: Optional[str] = None):
+        self.folder = folder if folder is not None else gettempdir()
+        maybe_mkdir_p(self.folder)
+        # storage data_ptr -> (file, shape) of the registered (keep_file=True) arrays
+        self._files: Dict[int, Tuple[str, Tuple[int, ...]]] = {}
+        # files that could not be removed yet because they were still mapped (Windows)
+        self._pending_removals: List[str] = []
+        atexit.register(self._remove_pending_at_exit)
+
+    def zeros(self, shape: Tuple[int, ...], dtype=np.float16, keep_file: bool = False) -> torch.Tensor:
+        self._retry_pending_removals()
+        fname = join(self.folder, f'nnunet_out_of_core_{uuid4().hex}.npy')
+        # the file is created sparse, so this is zero initialized without writing anything
+        arr = np.lib.format.open_memmap(fname, mode='w+', dtype=dtype, shape=tuple(shape))
+        tensor = torch.from_numpy(arr)
+        if keep_file:
+            data_ptr = tensor.untyped_storage().data_ptr()
+            self._files[data_ptr] = (fname, tuple(shape))
+            # arr lives as long as the tensor or any view of it
+            weakref.finalize(arr, self._remove_if_registered, data_ptr, fname)
+        else:
+            self._remove(fname)
+        return tensor
+
+    def get_file(self, tensor: torch.Tensor) -> Union[str, None]:
+        """
+        Returns the file backing tensor (which may be a view of the registered array) or None if tensor is not a
+        registered out-of-core tensor.
+        """
+        registered = self._files.get(tensor.untyped_storage().data_ptr())
+        return registered[0] if registered is not None else None
+
+    def get_handle(self, tensor: torch.Tensor) -> Union[OutOfCoreArrayHandle, None]:
+        """
+        Handle to the file backing tensor or None if tensor is not a registered out-of-core tensor. tensor may be a
+        crop of the registered array (basic slicing, like the removal of the sliding window padding), the handle then
+        only covers the crop.
+        """
+        registered = self._files.get(tensor.untyped_storage().data_ptr())
+        if registered is None:
+            return None
+        fname, shape = registered
+        return OutOfCoreArrayHandle(fname, get_crop_of_view(tensor, shape))
+
+    def release(self, tensor: torch.Tensor, delete_file: bool = True):
+        registered = self._files.pop(tensor.untyped_storage().data_ptr(), None)
+        if registered is not None and delete_file:
+            self._remove(registered[0])
+        self._retry_pending_removals()
+
+    def _remove_if_registered(self, data_ptr: int, fname: str):
+        # the array was garbage collected without being released or handed over
+        registered = self._files.get(data_ptr)
+        if registered is not None and registered[0] == fname:
+            del self._files[data_ptr]
+            self._remove(fname)
+
+    def _remove(self, fname: str):
+        try:
+            os.remove(fname)
+        except FileNotFoundError:
+            pass
+        except PermissionError:
+            # still mapped (Windows)
+            self._pending_removals.append(fname)
+
+    def _retry_pending_removals(self):
+        pending, self._pending_removals = self._pending_removals, []
+        for fname in pending:
+            self._remove(fname)
+
+    def _remove_pending_at_exit(self):
+        if len(self._pending_removals) > 0:
+            gc.collect()
+            self._retry_pending_removals()
+
+
+def load_out_of_core_array(handle: OutOfCoreArrayHandle) -> np.ndarray:
+    """
+    Opens (the crop of) an array written by OutOfCoreArrays without reading it into memory. Copy on write, so that
+    torch does not complain about non-writable arrays. Nothing is ever written back to the file.
+    """
+    return np.load(handle.fname, mmap_mode='c')[handle.slicer]
@@ -1,11 +1,14 @@
+import hashlib
 import inspect
 import itertools
+import json
 import multiprocessing
 import os
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
 from queue import Queue
 from threading import Thread
-from time import sleep
+from time import sleep, time
 from typing import Tuple, Union, List, Optional
 
 import numpy as np
@@ -21,15 +24,26 @@ from tqdm import tqdm
 
 import nnunetv2
 from nnunetv2.configuration import default_num_processes
-from nnunetv2.inference.data_iterators import PreprocessAdapterFromNpy, preprocessing_iterator_fromfiles, \
-    preprocessing_iterator_fromnpy
+from nnunetv2.inference.buffer_pool import BufferPool
+from nnunetv2.inference.cpu_engine import CPUInferenceEngine, cpu_engine_precisions
+from nnunetv2.inference.cross_case_batching import CrossCaseTileBatcher
+from nnunetv2.inference.data_iterators import preprocessing_iterator_fromfiles, preprocessing_iterator_fromnpy, \
+    preprocess_case_fromnpy
 from nnunetv2.inference.export_prediction import export_prediction_from_logits, \
     convert_predicted_logits_to_segmentation_with_correct_shape
+from nnunetv2.inference.inference_checkpoint import load_checkpoint_for_inference, inference_checkpoint_exists
+from nnunetv2.inference.out_of_core import OutOfCoreArrays, OutOfCoreArrayHandle
+from nnunetv2.inference.prediction_cache import PredictionCache, export_prediction_from_cache
+from nnunetv2.inference.probability_store import probabilities_formats, get_probabilities_file_ending
+from nnunetv2.inference.prediction_journal import PredictionJournal, order_cases_for_work_stealing
+from nnunetv2.inference.shared_arrays import SharedArray, SharedArrayHandle, SharedMemoryArrays, \
+    shared_array_nbytes, shared_memory_available, release_finished_shared_arrays
 from nnunetv2.inference.sliding_window_prediction import compute_gaussian, \
-    compute_steps_for_sliding_window
+    compute_steps_for_sliding_window, compute_normalized_tile_weights
+from nnunetv2.inference.time_budget import build_default_quality_ladder, choose_rung
 from nnunetv2.utilities.file_path_utilities import get_output_folder, check_workers_alive_and_busy
 from nnunetv2.utilities.find_class_by_name import recursive_find_python_class
-from nnunetv2.utilities.helpers import empty_cache, dummy_context
+from nnunetv2.utilities.helpers import empty_cache, dummy_context, get_available_memory
 from nnunetv2.utilities.json_export import recursive_fix_for_json_export
 from nnunetv2.utilities.label_handling.label_handling import determine_num_input_channels
 from nnunetv2.utilities.plans_handling.plans_handler import PlansManager, ConfigurationManager
@@ -45,7 +59,93 @@ class nnUNetPredictor(object):
                  device: torch.device = torch.device('cuda'),
                  verbose: bool = False,
                  verbose_preprocessing: bool = False,
-                 allow_tqdm: bool = True):
+                 allow_tqdm: bool = True,
+                 tile_batch_size: int = 1,
+                 tile_batch_memory_budget_gb: Optional[float] = None,
+                 slice_batch_memory_budget_gb: Optional[float] = None,
+                 mirror_batch_size: int = 1,
+                 tile_skip_threshold: Optional[float] = None,
+                 resident_fold_networks: bool = False,
+                 analytic_weight_normalization: bool = False,
+                 out_of_core_accumulation: bool = False,
+                 out_of_core_folder: Optional[str] = None,
+                 plan_results_memory: bool = True,
+                 prediction_cache_folder: Optional[str] = None,
+                 prediction_cache_size_gb: float = 50,
+                 prediction_cache_logits: bool = False,
+                 cross_case_batching: bool = False,
+                 large_tile_memory_budget_gb: Optional[float] = None,
+                 probabilities_format: str = 'npz',
+                 time_budget_s: Optional[float] = None,
+                 quality_ladder: Optional[List[dict]] = None,
+                 progressive_ensembling_threshold: Optional[float] = None,
+                 cpu_engine: Optional[str] = None,
+                 cpu_engine_tolerance: float = 1e-3):
+        """
+        tile_batch_size: number of sliding window tiles that are stacked into one forward pass of the network.
+        tile_batch_memory_budget_gb: if set, the tile batch size is derived from this budget (in GB) and the estimated
+        feature map size of the network instead. tile_batch_size is ignored in that case.
+        slice_batch_memory_budget_gb: 2d configurations predict 3d images slice by slice, which means many small
+        forward passes. If set (and tile_batch_size and tile_batch_memory_budget_gb are not), their tiles are batched
+        across slices up to this memory budget (in GB). None (default) predicts one tile at a time.
+        mirror_batch_size: number of mirrored copies of a tile (including the original) that are folded into the batch
+        dimension of one forward pass. 1 runs all mirror combinations sequentially.
+        tile_skip_threshold: if set, sliding window tiles in which the fraction of nonzero input voxels is at or below
+        this value are not predicted. Voxels not covered by any predicted tile are filled with background logits.
+        0 skips only tiles that are entirely zero (padding, outside of the nonzero mask). None predicts all tiles.
+        resident_fold_networks: instantiate one network per fold once instead of loading the state dict of each fold
+        into the same network for every case. Each tile is then predicted by all folds back to back and the sliding
+        window runs only once per case. Costs one set of network weights per fold in device memory.
+        analytic_weight_normalization: the sum of the (Gaussian) tile weights only depends on image shape, patch size
+        and step size and is separable along the axes. If set, we use precomputed per-axis weights that are already
+        normalized instead of accumulating the weights in a full-size volume and dividing by it at the end. Saves one
+        image-sized buffer and a scatter-add per tile. Not used for cases in which tiles are skipped.
+        out_of_core_accumulation: accumulate the logits in memory mapped files in out_of_core_folder (default: the
+        temp dir) instead of RAM/VRAM. Meant for images * number of heads that do not fit into RAM. The finalization
+        of the logits is done in slabs along the first axis and the export workers read the logits from the file, so
+        RAM usage is bounded by the working set rather than the image size. Much slower than regular inference,
+        put out_of_core_folder on a fast SSD!
+        plan_results_memory: estimate the memory needed for the results arrays of each case and compare it with the
+        memory that is currently available to decide where they go (device, CPU or, if RAM is not sufficient either,
+        out-of-core in out_of_core_folder). If False, we always try the device first and fall back to the CPU upon
+        OOM (which repeats the tiles that were already predicted).
+        prediction_cache_folder: if set, predict_from_files keeps the results of each case in this folder, keyed by
+        the contents of the input files and the model fingerprint (weights, plans, inference settings). Cases that are
+        found there are not predicted again. The cache is limited to prediction_cache_size_gb (least recently used
+        entries are evicted). If prediction_cache_logits, the logits (fp16) are cached as well so that hits can be
+        exported with different export settings (save_probabilities). See nnunetv2.inference.prediction_cache. Not
+        used with time_budget_s.
+        cross_case_batching: throughput mode for many small images. predict_from_data_iterator pools the tiles of
+        cases that fit into one tile batch (see tile_batch_size, tile_batch_memory_budget_gb and
+        slice_batch_memory_budget_gb) into shared batches instead of predicting each case on its own. See
+        nnunetv2.inference.cross_case_batching.
+        large_tile_memory_budget_gb: if set, the sliding window uses tiles larger than the training patch size (at most
+        the size of the image) as long as the estimated memory of one forward pass stays within this budget (in GB).
+        Tiles remain divisible by the downsampling factors of the network and the Gaussian is computed for the tile
+        size. Fewer, larger tiles compute the overlapping regions fewer times. The network has only seen patches of
+        patch_size during training, so check the effect on your data with
+        nnunetv2.inference.large_tile_validation. Not used for cases pooled by cross_case_batching.
+        probabilities_format: file format of the probabilities exported with save_probabilities. 'npz' (default), or
+        the much faster, chunked blosc2 format 'b2nd' (optionally quantized: 'b2nd_fp16', 'b2nd_uint8'). See
+        nnunetv2.inference.probability_store.
+        time_budget_s: if set, the time (in s) the network may spend on each case. The cost of a case is estimated as
+        the number of tiles x the measured latency of one forward pass, and folds, mirroring and tile_step_size are
+        reduced along quality_ladder (default: nnunetv2.inference.time_budget.build_default_quality_ladder) until the
+        estimate fits. The chosen settings are recorded in the properties of the case ('inference_settings') and, for
+        file outputs, in <output folder>/inference_settings. Preprocessing and export are not part of the budget.
+        quality_ladder: list of dicts with 'num_folds', 'mirror_axes' and 'tile_step_size', best quality first. Only
+        used with time_budget_s.
+        progressive_ensembling_threshold: if set, each tile is first predicted by the first fold without mirroring. Only
+        tiles in which the fraction of uncertain voxels (normalized entropy above 0.5) exceeds this value are predicted
+        again with the full ensemble (all folds, all mirror axes). 0 sends every tile with at least one uncertain voxel
+        to the full ensemble. Implies resident_fold_networks. The number of tiles that got the full ensemble is
+        printed for each case and kept in last_progressive_ensembling_stats.
+        cpu_engine: only for device cpu. 'fp32' runs each network as a frozen, traced graph in channels_last memory
+        format, 'bf16' additionally uses bf16 autocast (if the CPU supports it natively). Before it is used, each
+        variant must predict the first batch with at most cpu_engine_tolerance (fraction of voxels) labels that differ
+        from the regular fp32 network, otherwise we fall back to a more conservative one. Implies
+        resident_fold_networks. See nnunetv2.inference.cpu_engine.
+        """
         self.verbose = verbose
         self.verbose_preprocessing = verbose_preprocessing
         self.allow_tqdm = allow_tqdm
@@ -56,6 +156,62 @@ class nnUNetPredictor(object):
         self.tile_step_size = tile_step_size
         self.use_gaussian = use_gaussian
         self.use_mirroring = use_mirroring
+        assert tile_batch_size >= 1, 'tile_batch_size must be 1 or larger'
+        self.tile_batch_size = tile_batch_size
+        self.tile_batch_memory_budget_gb = tile_batch_memory_budget_gb
+        self.slice_batch_memory_budget_gb = slice_batch_memory_budget_gb
+        assert mirror_batch_size >= 1, 'mirror_batch_size must be 1 or larger'
+        self.mirror_batch_size = mirror_batch_size
+        self.tile_skip_threshold = tile_skip_threshold
+        # progressive ensembling decides per tile which folds to run, so all folds must be resident
+        self.resident_fold_networks = resident_fold_networks or progressive_ensembling_threshold is not None
+        self.fold_networks: Optional[List[nn.Module]] = None
+        self.analytic_weight_normalization = analytic_weight_normalization
+        self.out_of_core_accumulation = out_of_core_accumulation
+        self.out_of_core_arrays = OutOfCoreArrays(out_of_core_folder)
+        self.plan_results_memory = plan_results_memory
+        # CPU results arrays are taken from (and given back to) this pool if it is set, see
+        # predict_from_list_of_npy_arrays_in_process
+        self.buffer_pool: Optional[BufferPool] = None
+        # if share_results, CPU results arrays are created in shared memory so that they can be handed to the export
+        # workers without a copy, see _internal_share_prediction. Set by predict_from_data_iterator
+        self.share_results = False
+        self.shared_memory_arrays = SharedMemoryArrays()
+        if prediction_cache_folder is not None and time_budget_s is not None:
+            print('prediction_cache_folder is not used with time_budget_s: the settings chosen for a case depend on '
+                  'measured latencies, so the same input can give different predictions')
+            prediction_cache_folder = None
+        self.prediction_cache = PredictionCache(prediction_cache_folder, prediction_cache_size_gb,
+                                                prediction_cache_logits) \
+            if prediction_cache_folder is not None else None
+        self.cross_case_batching = cross_case_batching
+        self.large_tile_memory_budget_gb = large_tile_memory_budget_gb
+        assert probabilities_format in probabilities_formats, \
+            f'probabilities_format must be one of {probabilities_formats}'
+        self.probabilities_format = probabilities_format
+        assert time_budget_s is None or time_budget_s > 0, 'time_budget_s must be larger than 0'
+        self.time_budget_s = time_budget_s
+        self.quality_ladder = quality_ladder
+        # settings used for the case that was predicted last, see _internal_predict_logits_within_time_budget
+        self.last_inference_settings: Optional[dict] = None
+        self._tile_latency_s = {}
+        self._time_budget_correction = 1.
+        self.progressive_ensembling_threshold = progressive_ensembling_threshold
+        self.last_progressive_ensembling_stats: Optional[dict] = None
+        # number of tiles predicted and number of tiles that got the full ensemble, see
+        # _internal_predict_tile_batch_progressively
+        self._progressive_num_tiles = [0, 0]
+        if cpu_engine is not None and device.type != 'cpu':
+            print(f'cpu_engine is only used with device cpu, ignoring it for device {device}')
+            cpu_engine = None
+        assert cpu_engine is None or cpu_engine in cpu_engine_precisions, \
+            f'cpu_engine must be None or one of {cpu_engine_precisions}'
+        self.cpu_engine = cpu_engine
+        self.cpu_engine_tolerance = cpu_engine_tolerance
+        # the engine of each network freezes its weights, so every fold needs its own network
+        self.resident_fold_networks = self.resident_fold_networks or cpu_engine is not None
+        # id of the network -> CPUInferenceEngine, see _internal_get_inference_network
+        self._cpu_engines = {}
         if device.type == 'cuda':
             torch.backends.cudnn.benchmark = True
         else:
@@ -83,8 +239,8 @@ class nnUNetPredictor(object):
         parameters = []
         for i, f in enumerate(use_folds):
             f = int(f) if f != 'all' else f
-            checkpoint = torch.load(join(model_training_output_dir, f'fold_{f}', checkpoint_name),
-                                    map_location=torch.device('cpu'), weights_only=False)
+            # weights-only inference checkpoint if there is one, see nnunetv2.inference.inference_checkpoint
+            checkpoint = load_checkpoint_for_inference(join(model_training_output_dir, f'fold_{f}', checkpoint_name))
             if i == 0:
                 trainer_name = checkpoint['trainer_name']
                 configuration_name = checkpoint['init_args']['configuration']
@@ -123,6 +279,7 @@ class nnUNetPredictor(object):
         self.trainer_name = trainer_name
         self.allowed_mirroring_axes = inference_allowed_mirroring_axes
         self.label_manager = plans_manager.get_label_manager(dataset_json)
+        self._internal_build_fold_networks(network)
         if ('nnUNet_compile' in os.environ.keys()) and (os.environ['nnUNet_compile'].lower() in ('true', '1', 't')) \
                 and not isinstance(self.network, OptimizedModule):
             print('Using torch.compile')
@@ -152,13 +309,39 @@ class nnUNetPredictor(object):
         if allow_compile:
             print('Using torch.compile')
             self.network = torch.compile(self.network)
+        base_network = network.module if isinstance(network, DistributedDataParallel) else network
+        self._internal_build_fold_networks(
+            base_network._orig_mod if isinstance(base_network, OptimizedModule) else base_network)
+
+    def _internal_build_fold_networks(self, network: nn.Module):
+        """
+        If resident_fold_networks is set, we instantiate one copy of network per set of parameters and keep them
+        around. Nothing to do if there is only one fold.
+        """
+        self.fold_networks = None
+        self._cpu_engines = {}
+        if not self.resident_fold_networks or self.list_of_parameters is None or len(self.list_of_parameters) < 2:
+            return
+        allow_compile = ('nnUNet_compile' in os.environ.keys()) and (
+                os.environ['nnUNet_compile'].lower() in ('true', '1', 't'))
+        fold_networks = []
+        for params in self.list_of_parameters:
+            fold_network = deepcopy(network)
+            fold_network.load_state_dict(params)
+            fold_network = fold_network.to(self.device)
+            fold_network.eval()
+            if allow_compile:
+                fold_network = torch.compile(fold_network)
+            fold_networks.append(fold_network)
+        self.fold_networks = fold_networks
 
     @staticmethod
     def auto_detect_available_folds(model_training_output_dir, checkpoint_name):
         print('use_folds is None, attempting to auto detect available folds')
         fold_folders = subdirs(model_training_output_dir, prefix='fold_', join=False)
         fold_folders = [i for i in fold_folders if i != 'fold_all']
-        fold_folders = [i for i in fold_folders if isfile(join(model_training_output_dir, i, checkpoint_name))]
+        fold_folders = [i for i in fold_folders if
+                        inference_checkpoint_exists(join(model_training_output_dir, i, checkpoint_name))]
         use_folds = [int(i.split('_')[-1]) for i in fold_folders]
         print(f'found the following folds: {use_folds}')
         return use_folds
@@ -193,7 +376,8 @@ class nnUNetPredictor(object):
         if not overwrite and output_filename_truncated is not None:
             tmp = [isfile(i + self.dataset_json['file_ending']) for i in output_filename_truncated]
             if save_probabilities:
-                tmp2 = [isfile(i + '.npz') for i in output_filename_truncated]
+                probabilities_file_ending = get_probabilities_file_ending(self.probabilities_format)
+                tmp2 = [isfile(i + probabilities_file_ending) for i in output_filename_truncated]
                 tmp = [i and j for i, j in zip(tmp, tmp2)]
             not_existing_indices = [i for i, j in enumerate(tmp) if not j]
 
@@ -213,10 +397,16 @@ class nnUNetPredictor(object):
                            num_processes_segmentation_export: int = default_num_processes,
                            folder_with_segs_from_prev_stage: str = None,
                            num_parts: int = 1,
-                           part_id: int = 0):
+                           part_id: int = 0,
+                           use_journal: bool = False):
         """
         This is nnU-Net's default function for making predictions. It works best for batch predictions
         (predicting many images at once).
+
+        use_journal: keep a PredictionJournal in <output_folder>/.journal. Rerunning an interrupted job with
+        overwrite=False then resumes with the cases that were not completely exported with the same model and settings.
+        overwrite=True resets the journal. The parts (part_id/num_parts) of a job no longer split the cases statically
+        but claim them one by one, so parts that finish early take over the remaining cases of the others.
         """
         assert part_id <= num_parts, ("Part ID must be smaller than num_parts. Remember that we start counting with 0. "
                                       "So if there are 3 parts then valid part IDs are 0, 1, 2")
@@ -245,37 +435,167 @@ class nnUNetPredictor(object):
         #######################
 
         # check if we need a prediction from the previous stage
-        if self.configuration_manager.previous_stage_name is not None:
+        if self._internal_requires_segs_from_prev_stage():
             assert folder_with_segs_from_prev_stage is not None, \
                 f'The requested configuration is a cascaded network. It requires the segmentations of the previous ' \
                 f'stage ({self.configuration_manager.previous_stage_name}) as input. Please provide the folder where' \
                 f' they are located via folder_with_segs_from_prev_stage'
 
-        # sort out input and output filenames
+        journal = None
+        if use_journal:
+            assert output_folder is not None, 'use_journal requires the predictions to be written to files'
+            journal = PredictionJournal(join(output_folder, '.journal'), part_id,
+                                        fingerprint=self._internal_get_model_fingerprint())
+            if overwrite:
+                journal.reset()
+
+        # sort out input and output filenames. With a journal, all parts get all cases (see below)
         list_of_lists_or_source_folder, output_filename_truncated, seg_from_prev_stage_files = \
             self._manage_input_and_output_lists(list_of_lists_or_source_folder,
                                                 output_folder_or_list_of_truncated_output_files,
-                                                folder_with_segs_from_prev_stage, overwrite, part_id, num_parts,
+                                                folder_with_segs_from_prev_stage, overwrite,
+                                                part_id if journal is None else 0,
+                                                num_parts if journal is None else 1,
                                                 save_probabilities)
+        if journal is not None:
+            keep = [i for i in order_cases_for_work_stealing(list(range(len(list_of_lists_or_source_folder))),
+                                                             part_id, num_parts)
+                    if not journal.is_exported(os.path.basename(output_filename_truncated[i]))]
+            list_of_lists_or_source_folder = [list_of_lists_or_source_folder[i] for i in keep]
+            output_filename_truncated = [output_filename_truncated[i] for i in keep]
+            seg_from_prev_stage_files = [seg_from_prev_stage_files[i] for i in keep]
+            print(f'Journal: {len(keep)} cases are not exported yet. They are shared with the other parts')
         if len(list_of_lists_or_source_folder) == 0:
             return
 
+        prediction_cache_keys = None
+        if self.prediction_cache is not None and output_filename_truncated is not None:
+            all_output_files = output_filename_truncated
+            list_of_lists_or_source_folder, output_filename_truncated, seg_from_prev_stage_files, \
+                prediction_cache_keys = self._internal_restore_from_prediction_cache(
+                    list_of_lists_or_source_folder, output_filename_truncated, seg_from_prev_stage_files,
+                    save_probabilities, num_processes_segmentation_export)
+            if journal is not None:
+                for i in all_output_files:
+                    # other parts may be working on the same cases, their claims are not ours to remove
+                    if i not in prediction_cache_keys.keys() and journal.claim(os.path.basename(i)):
+                        journal.mark_exported(os.path.basename(i))
+            if len(list_of_lists_or_source_folder) == 0:
+                return
+
         data_iterator = self._internal_get_data_iterator_from_lists_of_filenames(list_of_lists_or_source_folder,
                                                                                  seg_from_prev_stage_files,
                                                                                  output_filename_truncated,
-                                                                                 num_processes_preprocessing)
+                                                                                 num_processes_preprocessing,
+                                                                                 journal)
+        if journal is None:
+            return self.predict_from_data_iterator(data_iterator, save_probabilities,
+                                                   num_processes_segmentation_export, prediction_cache_keys)
+        journal.start_heartbeat()
+        try:
+            return self.predict_from_data_iterator(data_iterator, save_probabilities,
+                                                   num_processes_segmentation_export, prediction_cache_keys, journal)
+        finally:
+            journal.stop_heartbeat()
+            # cases we claimed but did not finish can be taken over by the other parts right away
+            journal.release_all_claims()
+
+    def _internal_requires_segs_from_prev_stage(self) -> bool:
+        """
+        Cascade configurations need the segmentations of the previous stage as input files, unless a subclass
+        predicts them itself (see nnUNetCascadePredictor)
+        """
+        return self.configuration_manager.previous_stage_name is not None
 
-        return self.predict_from_data_iterator(data_iterator, save_probabilities, num_processes_segmentation_export)
+    def _internal_get_model_fingerprint(self) -> str:
+        """
+        Hash of everything that determines the logits we predict for a given input: weights, plans, dataset.json and
+        the inference settings. Used as part of the prediction cache keys and recorded in the prediction journal
+        """
+        h = hashlib.sha256()
+        settings = {
+            'plans': self.plans_manager.plans,
+            'configuration': self.configuration_manager.configuration,
+            'dataset_json': self.dataset_json,
+            'trainer_name': self.trainer_name,
+            'allowed_mirroring_axes': self.allowed_mirroring_axes,
+            'tile_step_size': self.tile_step_size,
+            'use_gaussian': self.use_gaussian,
+            'use_mirroring': self.use_mirroring,
+            'tile_skip_threshold': self.tile_skip_threshold,
+            'analytic_weight_normalization': self.analytic_weight_normalization,
+            'large_tile_memory_budget_gb': self.large_tile_memory_budget_gb,
+            # the engine variant (bf16/fp32 graph, eager) that passes the tolerance check changes the logits
+            'cpu_engine': self.cpu_engine,
+            'cpu_engine_tolerance': self.cpu_engine_tolerance if self.cpu_engine is not None else None,
+            'progressive_ensembling_threshold': self.progressive_ensembling_threshold,
+        }
+        h.update(json.dumps(settings, sort_keys=True, default=str).encode())
+        list_of_parameters = self.list_of_parameters if self.list_of_parameters is not None else \
+            [self.network.state_dict()]
+        for params in list_of_parameters:
+            for k in sorted(params.keys()):
+                h.update(k.encode())
+                h.update(params[k].detach().cpu().contiguous().reshape(-1).view(torch.uint8).numpy().tobytes())
+        return h.hexdigest()
+
+    def _internal_restore_from_prediction_cache(self, list_of_lists: List[List[str]],
+                                                output_filenames_truncated: List[str],
+                                                seg_from_prev_stage_files: List[Union[str, None]],
+                                                save_probabilities: bool,
+                                                num_processes_segmentation_export: int):
+        """
+        Restores all cases that are in self.prediction_cache. Exported files are copied, cases for which only the
+        logits are cached are exported from them (in the calling process if num_processes_segmentation_export is 0).
+        Returns the lists of the remaining cases together with a dict that maps their output file to their cache key
+        (see predict_from_data_iterator).
+        """
+        model_fingerprint = self._internal_get_model_fingerprint()
+        file_ending = self.dataset_json['file_ending']
+        keys = [self.prediction_cache.get_case_key(i, j, model_fingerprint) for i, j in
+                zip(list_of_lists, seg_from_prev_stage_files)]
+        restored = []
+        from_logits = []
+        remaining = []
+        for i, k in enumerate(keys):
+            if self.prediction_cache.restore_files(k, output_filenames_truncated[i], file_ending, save_probabilities,
+                                                   self.probabilities_format):
+                restored.append(i)
+            elif self.prediction_cache.has_logits(k):
+                from_logits.append(i)
+            else:
+                remaining.append(i)
+        print(f'Prediction cache: {len(restored)} cases restored, {len(from_logits)} cases exported from cached '
+              f'logits, {len(remaining)} cases need to be predicted')
+
+        if len(from_logits) > 0:
+            export_args = [(self.prediction_cache.get_entry(keys[i]), self.configuration_manager, self.plans_manager,
+                            self.dataset_json, output_filenames_truncated[i], save_probabilities,
+                            self.probabilities_format) for i in from_logits]
+            if num_processes_segmentation_export == 0:
+                [export_prediction_from_cache(*i) for i in export_args]
+            else:
+                with multiprocessing.get_context("spawn").Pool(num_processes_segmentation_export) as export_pool:
+                    export_pool.starmap(export_prediction_from_cache, export_args)
+            for i in from_logits:
+                self.prediction_cache.store_files(keys[i], output_filenames_truncated[i], file_ending,
+                                                  save_probabilities, self.probabilities_format)
+            self.prediction_cache.evict()
+
+        return [list_of_lists[i] for i in remaining], [output_filenames_truncated[i] for i in remaining], \
+            [seg_from_prev_stage_files[i] for i in remaining], \
+            {output_filenames_truncated[i]: keys[i] for i in remaining}
 
     def _internal_get_data_iterator_from_lists_of_filenames(self,
                                                             input_list_of_lists: List[List[str]],
                                                             seg_from_prev_stage_files: Union[List[str], None],
                                                             output_filenames_truncated: Union[List[str], None],
-                                                            num_processes: int):
+                                                            num_processes: int,
+                                                            journal: Optional[PredictionJournal] = None):
         return preprocessing_iterator_fromfiles(input_list_of_lists, seg_from_prev_stage_files,
                                                 output_filenames_truncated, self.plans_manager, self.dataset_json,
                                                 self.configuration_manager, num_processes, self.device.type == 'cuda',
-                                                self.verbose_preprocessing)
+                                                self.verbose_preprocessing, journal)
         # preprocessor = self.configuration_manager.preprocessor_class(verbose=self.verbose_preprocessing)
         # # hijack batchgenerators, yo
         # # we use the multiprocessing of the batchgenerators dataloader to handle all the background worker stuff. This
@@ -350,15 +670,100 @@ class nnUNetPredictor(object):
     def predict_from_data_iterator(self,
                                    data_iterator,
                                    save_probabilities: bool = False,
-                                   num_processes_segmentation_export: int = default_num_processes):
+                                   num_processes_segmentation_export: int = default_num_processes,
+                                   prediction_cache_keys: Optional[dict] = None,
+                                   journal: Optional[PredictionJournal] = None):
         """
         each element returned by data_iterator must be a dict with 'data', 'ofile' and 'data_properties' keys!
         If 'ofile' is None, the result will be returned instead of written to a file
+        prediction_cache_keys: maps 'ofile' to the key under which the result is stored in self.prediction_cache
+        journal: if given, the progress of each case is recorded there. data_iterator must claim the cases, see
+        preprocessing_iterator_fromfiles
         """
+        # the predictions go to the export workers, so they are created in shared memory right away
+        previous_share_results = self.share_results
+        self.share_results = True
+        try:
+            return self._internal_predict_from_data_iterator(data_iterator, save_probabilities,
+                                                             num_processes_segmentation_export,
+                                                             prediction_cache_keys, journal)
+        finally:
+            self.share_results = previous_share_results
+
+    def _internal_predict_from_data_iterator(self,
+                                             data_iterator,
+                                             save_probabilities: bool,
+                                             num_processes_segmentation_export: int,
+                                             prediction_cache_keys: Optional[dict],
+                                             journal: Optional[PredictionJournal]):
         with multiprocessing.get_context("spawn").Pool(num_processes_segmentation_export) as export_pool:
             worker_list = [i for i in export_pool._pool]
             r = []
-            for preprocessed in data_iterator:
+            # index of the case (in the order of data_iterator) each element of r belongs to
+            r_case_idx = []
+            # predictions in shared memory that are still being exported
+            shared_predictions = []
+            # output files whose export has finished. With a journal, other parts predict some of the cases in
+            # prediction_cache_keys, so only these go into the prediction cache
+            exported_ofiles = []
+
+            def export_done(ofile: str):
+                # runs in the main process once the export of ofile is done
+                exported_ofiles.append(ofile)
+                if journal is not None:
+                    journal.mark_exported(os.path.basename(ofile))
+
+            def export(prediction: torch.Tensor, case_idx: int, ofile: Optional[str], properties: dict):
+                nonlocal shared_predictions
+                if prediction_cache_keys is not None and ofile in prediction_cache_keys.keys() and \
+                        self.prediction_cache.store_logits:
+                    self.prediction_cache.store_prediction_logits(prediction_cache_keys[ofile], prediction,
+                                                                  properties)
+                prediction, shared_prediction = self._internal_share_prediction(prediction)
+
+                if ofile is not None:
+                    print('sending off prediction to background worker for resampling and export')
+                    # the callbacks run in the main process once the export is done (or has failed)
+                    callbacks = {'callback': lambda _, ofile=ofile: export_done(ofile)}
+                    if journal is not None:
+                        case = os.path.basename(ofile)
+                        journal.set_state(case, 'predicted')
+                        callbacks['error_callback'] = lambda _, case=case: journal.release_claim(case)
+                    r.append(
+                        export_pool.starmap_async(
+                            export_prediction_from_logits,
+                            ((prediction, properties, self.configuration_manager, self.plans_manager,
+                              self.dataset_json, ofile, save_probabilities, default_num_processes,
+                              self.probabilities_format),),
+                            **callbacks
+                        )
+                    )
+                else:
+                    print('sending off prediction to background worker for resampling')
+                    r.append(
+                        export_pool.starmap_async(
+                            convert_predicted_logits_to_segmentation_with_correct_shape, (
+                                (prediction, self.plans_manager,
+                                 self.configuration_manager, self.label_manager,
+                                 properties,
+                                 save_probabilities),)
+                        )
+                    )
+                r_case_idx.append(case_idx)
+                if shared_prediction is not None:
+                    shared_prediction.add_consumer(r[-1])
+                    shared_predictions.append(shared_prediction)
+                shared_predictions = release_finished_shared_arrays(shared_predictions)
+                if ofile is not None:
+                    print(f'done with {os.path.basename(ofile)}')
+                else:
+                    print(f'\nDone with image of shape {prediction.shape}:')
+
+            batcher = self._internal_get_cross_case_batcher() if self.cross_case_batching else None
+
+            num_cases = 0
+            for case_idx, preprocessed in enumerate(data_iterator):
+                num_cases += 1
                 data = preprocessed['data']
                 if isinstance(data, str):
                     delfile = data
@@ -382,40 +787,38 @@ class nnUNetPredictor(object):
                     sleep(0.1)
                     proceed = not check_workers_alive_and_busy(export_pool, worker_list, r, allowed_num_queued=2)
 
-                # convert to numpy to prevent uncatchable memory alignment errors from multiprocessing serialization of torch tensors
-                prediction = self.predict_logits_from_preprocessed_data(data).cpu().detach().numpy()
-
-                if ofile is not None:
-                    print('sending off prediction to background worker for resampling and export')
-                    r.append(
-                        export_pool.starmap_async(
-                            export_prediction_from_logits,
-                            ((prediction, properties, self.configuration_manager, self.plans_manager,
-                              self.dataset_json, ofile, save_probabilities),)
-                        )
-                    )
+                if batcher is not None and batcher.accepts(data):
+                    # the case is exported once all of its tiles went through the network, which may be later
+                    for prediction, context in batcher.add_case(data, (case_idx, ofile, properties)):
+                        export(prediction, *context)
                 else:
-                    print('sending off prediction to background worker for resampling')
-                    r.append(
-                        export_pool.starmap_async(
-                            convert_predicted_logits_to_segmentation_with_correct_shape, (
-                                (prediction, self.plans_manager,
-                                 self.configuration_manager, self.label_manager,
-                                 properties,
-                                 save_probabilities),)
-                        )
-                    )
-                if ofile is not None:
-                    print(f'done with {os.path.basename(ofile)}')
-                else:
-                    print(f'\nDone with image of shape {data.shape}:')
-            ret = [i.get()[0] for i in r]
+                    prediction = self.predict_logits_from_preprocessed_data(data)
+                    self._internal_record_inference_settings(properties, ofile)
+                    export(prediction, case_idx, ofile, properties)
+                    del prediction
+            if batcher is not None:
+                for prediction, context in batcher.flush():
+                    export(prediction, *context)
+
+            ret = [None] * num_cases
+            for case_idx, i in zip(r_case_idx, r):
+                ret[case_idx] = i.get()[0]
+            [i.release() for i in shared_predictions]
+
+        if prediction_cache_keys is not None:
+            for ofile in exported_ofiles:
+                if ofile in prediction_cache_keys.keys():
+                    self.prediction_cache.store_files(prediction_cache_keys[ofile], ofile,
+                                                      self.dataset_json['file_ending'], save_probabilities,
+                                                      self.probabilities_format)
+            self.prediction_cache.evict()
 
         if isinstance(data_iterator, MultiThreadedAugmenter):
             data_iterator._finish()
 
         # clear lru cache
         compute_gaussian.cache_clear()
+        compute_normalized_tile_weights.cache_clear()
         # clear device cache
         empty_cache(self.device)
         return ret
@@ -425,8 +828,8 @@ class nnUNetPredictor(object):
                                  output_file_truncated: str = None,
                                  save_or_return_probabilities: bool = False):
         """
-        WARNING: SLOW. ONLY USE THIS IF YOU CANNOT GIVE NNUNET MULTIPLE IMAGES AT ONCE FOR SOME REASON.
-
+        Predicts a single image in the calling process, see predict_from_list_of_npy_arrays_in_process. If you have
+        many images, predict_from_list_of_npy_arrays or predict_from_files have a higher throughput.
 
         input_image: Make sure to load the image in the way nnU-Net expects! nnU-Net is trained on a certain axis
                      ordering which cannot be disturbed in inference,
@@ -437,35 +840,121 @@ class nnUNetPredictor(object):
                      you need to transpose your axes AND your spacing from [x,y,z] to [z,y,x]!
         image_properties must only have a 'spacing' key!
         """
-        ppa = PreprocessAdapterFromNpy([input_image], [segmentation_previous_stage], [image_properties],
-                                       [output_file_truncated],
-                                       self.plans_manager, self.dataset_json, self.configuration_manager,
-                                       num_threads_in_multithreaded=1, verbose=self.verbose)
-        if self.verbose:
-            print('preprocessing')
-        dct = next(ppa)
+        return self.predict_from_list_of_npy_arrays_in_process([input_image], [segmentation_previous_stage],
+                                                               [image_properties], [output_file_truncated],
+                                                               save_or_return_probabilities)[0]
+
+    def predict_from_list_of_npy_arrays_in_process(self,
+                                                   image_or_list_of_images: Union[np.ndarray, List[np.ndarray]],
+                                                   segs_from_prev_stage_or_list_of_segs_from_prev_stage: Union[
+                                                       None, np.ndarray, List[np.ndarray]],
+                                                   properties_or_list_of_properties: Union[dict, List[dict]],
+                                                   truncated_ofname: Union[str, List[str], None] = None,
+                                                   save_or_return_probabilities: bool = False,
+                                                   num_threads_preprocessing: int = 1):
+        """
+        Latency optimized counterpart of predict_from_list_of_npy_arrays for integrations that call nnU-Net from
+        Python for one (or a few) images at a time. Preprocessing, prediction and export all happen in the calling
+        process: the next image is preprocessed and the previous one is exported in background threads while the
+        network runs. No worker processes are spawned and nothing is pickled.
+        The CPU results arrays of the sliding window are reused for images of the same size within this call and given
+        back at the end. To reuse them across calls as well, set self.buffer_pool = BufferPool() yourself (it is then
+        also used by all other prediction functions) and call self.buffer_pool.clear() once you are done.
+
+        Returns a list with one entry per image: the segmentation (or (segmentation, probabilities) if
+        save_or_return_probabilities) if its truncated_ofname is None, else None (the result is written to
+        truncated_ofname instead).
+        """
+        list_of_images = [image_or_list_of_images] if not isinstance(image_or_list_of_images, list) else \
+            image_or_list_of_images
+        num_cases = len(list_of_images)
+        segs = segs_from_prev_stage_or_list_of_segs_from_prev_stage
+        if segs is None:
+            segs = [None] * num_cases
+        elif isinstance(segs, np.ndarray):
+            segs = [segs]
+        properties = [properties_or_list_of_properties] if isinstance(properties_or_list_of_properties, dict) else \
+            properties_or_list_of_properties
+        if truncated_ofname is None:
+            truncated_ofname = [None] * num_cases
+        elif isinstance(truncated_ofname, str):
+            truncated_ofname = [truncated_ofname]
 
-        if self.verbose:
-            print('predicting')
-        predicted_logits = self.predict_logits_from_preprocessed_data(dct['data']).cpu()
+        previous_buffer_pool = self.buffer_pool
+        if previous_buffer_pool is None:
+            self.buffer_pool = BufferPool()
+        try:
+            ret = self._internal_predict_in_process(list_of_images, segs, properties, truncated_ofname,
+                                                    save_or_return_probabilities, num_threads_preprocessing)
+        finally:
+            # the pool must not outlive this call, predict_from_files etc. would take buffers from it but never give
+            # them back
+            if previous_buffer_pool is None:
+                self.buffer_pool.clear()
+            self.buffer_pool = previous_buffer_pool
 
-        if self.verbose:
-            print('resampling to original shape')
-        if output_file_truncated is not None:
-            export_prediction_from_logits(predicted_logits, dct['data_properties'], self.configuration_manager,
-                                          self.plans_manager, self.dataset_json, output_file_truncated,
-                                          save_or_return_probabilities)
+        compute_gaussian.cache_clear()
+        compute_normalized_tile_weights.cache_clear()
+        empty_cache(self.device)
+        return ret
+
+    def _internal_predict_in_process(self, list_of_images: List[np.ndarray], segs: List[Optional[np.ndarray]],
+                                     properties: List[dict], truncated_ofname: List[Optional[str]],
+                                     save_or_return_probabilities: bool, num_threads_preprocessing: int) -> list:
+        """
+        See predict_from_list_of_npy_arrays_in_process
+        """
+        num_cases = len(list_of_images)
+
+        def preprocess(idx: int):
+            return preprocess_case_fromnpy(list_of_images[idx], segs[idx], properties[idx], self.plans_manager,
+                                           self.dataset_json, self.configuration_manager, self.verbose_preprocessing)
+
+        with ThreadPoolExecutor(num_threads_preprocessing) as preprocessing_pool, ThreadPoolExecutor(1) as export_pool:
+            preprocessing = [preprocessing_pool.submit(preprocess, i) for i in
+                             range(min(num_threads_preprocessing, num_cases))]
+            exports = []
+            for idx in range(num_cases):
+                data, data_properties = preprocessing[idx].result()
+                preprocessing[idx] = None
+                if idx + num_threads_preprocessing < num_cases:
+                    preprocessing.append(preprocessing_pool.submit(preprocess, idx + num_threads_preprocessing))
+
+                # don't let predictions pile up if the export is slower than the network
+                if len(exports) > 1:
+                    exports[-2].result()
+
+                if self.verbose:
+                    print(f'predicting image of shape {data.shape}')
+                prediction = self.predict_logits_from_preprocessed_data(torch.from_numpy(data))
+                self._internal_record_inference_settings(data_properties, truncated_ofname[idx])
+                del data
+                exports.append(export_pool.submit(self._internal_export_in_process, prediction, data_properties,
+                                                  truncated_ofname[idx], save_or_return_probabilities))
+                del prediction
+            return [i.result() for i in exports]
+
+    def _internal_export_in_process(self, prediction: torch.Tensor, properties: dict, ofile: Optional[str],
+                                    save_or_return_probabilities: bool):
+        """
+        Export step of predict_from_list_of_npy_arrays_in_process. Gives the prediction back to self.buffer_pool once
+        it is no longer needed.
+        """
+        reuse_buffer = self.buffer_pool is not None and self.out_of_core_arrays.get_file(prediction) is None
+        payload = self._internal_get_export_payload(prediction)
+        if ofile is not None:
+            export_prediction_from_logits(payload, properties, self.configuration_manager, self.plans_manager,
+                                          self.dataset_json, ofile, save_or_return_probabilities,
+                                          probabilities_format=self.probabilities_format)
+            ret = None
         else:
-            ret = convert_predicted_logits_to_segmentation_with_correct_shape(predicted_logits, self.plans_manager,
-                                                                              self.configuration_manager,
-                                                                              self.label_manager,
-                                                                              dct['data_properties'],
-                                                                              return_probabilities=
-                                                                              save_or_return_probabilities)
-            if save_or_return_probabilities:
-                return ret[0], ret[1]
-            else:
-                return ret
+            ret = convert_predicted_logits_to_segmentation_with_correct_shape(
+                payload, self.plans_manager, self.configuration_manager, self.label_manager, properties,
+                return_probabilities=save_or_return_probabilities)
+        del payload
+        if reuse_buffer:
+            self.buffer_pool.release(prediction)
+        return ret
 
     @torch.inference_mode()
     def predict_logits_from_preprocessed_data(self, data: torch.Tensor) -> torch.Tensor:
@@ -475,10 +964,30 @@ class nnUNetPredictor(object):
 
         RETURNED LOGITS HAVE THE SHAPE OF THE INPUT. THEY MUST BE CONVERTED BACK TO THE ORIGINAL IMAGE SIZE.
         SEE convert_predicted_logits_to_segmentation_with_correct_shape
+
+        If time_budget_s is set, folds, mirroring and tile_step_size may be reduced for this case, see
+        _internal_predict_logits_within_time_budget
         """
+        if self.time_budget_s is not None:
+            return self._internal_predict_logits_within_time_budget(data)
+        return self._internal_predict_logits(data)
+
+    @torch.inference_mode()
+    def _internal_predict_logits(self, data: torch.Tensor) -> torch.Tensor:
+        self._progressive_num_tiles = [0, 0]
         n_threads = torch.get_num_threads()
         torch.set_num_threads(default_num_processes if default_num_processes < n_threads else n_threads)
         prediction = None
+        # decide once per case so that all folds use the same results location
+        results_location = self._internal_plan_results_location(data.shape)
+
+        if self.fold_networks is not None:
+            # all folds are evaluated tile by tile within one sliding window pass, see _internal_predict_tile_batch
+            prediction = self._internal_to_host(self.predict_sliding_window_return_logits(data, results_location))
+            if self.verbose: print('Prediction done')
+            self._internal_report_progressive_ensembling()
+            torch.set_num_threads(n_threads)
+            return prediction
 
         for params in self.list_of_parameters:
 
@@ -492,83 +1001,657 @@ class nnUNetPredictor(object):
             # second iteration to crash due to OOM. Grabbing that with try except cause way more bloated code than
             # this actually saves computation time
             if prediction is None:
-                prediction = self.predict_sliding_window_return_logits(data).to('cpu')
+                prediction = self._internal_to_host(self.predict_sliding_window_return_logits(data,
+                                                                                               results_location))
             else:
-                prediction += self.predict_sliding_window_return_logits(data).to('cpu')
+                fold_prediction = self.predict_sliding_window_return_logits(data, results_location).to('cpu')
+                prediction += fold_prediction
+                if results_location == 'out_of_core':
+                    self.out_of_core_arrays.release(fold_prediction)
+                elif self.buffer_pool is not None:
+                    self.buffer_pool.release(fold_prediction)
+                del fold_prediction
 
         if len(self.list_of_parameters) > 1:
             prediction /= len(self.list_of_parameters)
 
         if self.verbose: print('Prediction done')
+        self._internal_report_progressive_ensembling()
         torch.set_num_threads(n_threads)
         return prediction
 
-    def _internal_get_sliding_window_slicers(self, image_size: Tuple[int, ...]):
+    def _internal_get_cross_case_batcher(self) -> Optional[CrossCaseTileBatcher]:
+        """
+        Returns the CrossCaseTileBatcher for cross_case_batching, or None (with an explanation) if cases must be
+        predicted one at a time
+        """
+        tile_batch_size = self._internal_get_tile_batch_size(np.iinfo(np.int32).max)
+        if tile_batch_size == 1:
+            print('cross_case_batching has no effect with a tile batch size of 1. Set tile_batch_size or '
+                  'tile_batch_memory_budget_gb')
+        elif self.time_budget_s is not None:
+            print('cross_case_batching is not used with a time budget, the budget applies to each case')
+        elif type(self).predict_logits_from_preprocessed_data is not \
+                nnUNetPredictor.predict_logits_from_preprocessed_data:
+            # pooled tiles go through the sliding window directly, whatever a subclass adds (ROI, cascade) would be
+            # skipped
+            print(f'cross_case_batching is not used with {type(self).__name__}, it overrides '
+                  f'predict_logits_from_preprocessed_data. Cases are predicted one at a time')
+        elif not CrossCaseTileBatcher.can_batch_across_cases(self):
+            print('cross_case_batching of several folds requires resident_fold_networks. Cases are predicted one at '
+                  'a time')
+        else:
+            return CrossCaseTileBatcher(self, tile_batch_size)
+        return None
+
+    def _internal_to_host(self, prediction: torch.Tensor) -> torch.Tensor:
+        """
+        Moves prediction to the CPU. If share_results, into shared memory (see _internal_allocate_results_array)
+        """
+        if prediction.device.type == 'cpu' or not self.share_results:
+            return prediction.to('cpu')
+        host_prediction = self._internal_allocate_results_array(prediction.shape, torch.device('cpu'), True)
+        host_prediction.copy_(prediction)
+        return host_prediction
+
+    def _internal_report_progressive_ensembling(self):
+        if self.progressive_ensembling_threshold is None:
+            return
+        num_tiles, num_tiles_full_ensemble = self._progressive_num_tiles
+        self.last_progressive_ensembling_stats = {'num_tiles': num_tiles,
+                                                  'num_tiles_full_ensemble': num_tiles_full_ensemble}
+        print(f'progressive ensembling: {num_tiles_full_ensemble} of {num_tiles} tiles got the full ensemble')
+
+    def _internal_predict_logits_within_time_budget(self, data: torch.Tensor) -> torch.Tensor:
+        """
+        Predicts data with the best rung of the quality ladder (self.quality_ladder or
+        nnunetv2.inference.time_budget.build_default_quality_ladder) whose estimated time fits into time_budget_s. If
+        none fits, the cheapest rung is used. The settings of the rung are only applied for this case. What was chosen
+        (and how long it took) is stored in self.last_inference_settings.
+        """
+        if self.quality_ladder is not None:
+            quality_ladder = self.quality_ladder
+        else:
+            quality_ladder = build_default_quality_ladder(len(self.list_of_parameters),
+                                                          self.allowed_mirroring_axes if self.use_mirroring else None,
+                                                          self.tile_step_size)
+        quality_level, estimated_time = choose_rung(
+            quality_ladder, lambda rung: self._internal_estimate_prediction_time(data.shape, rung), self.time_budget_s)
+        rung = quality_ladder[quality_level]
+        if self.verbose or quality_level > 0:
+            print(f'time budget {self.time_budget_s} s: using quality level {quality_level} (folds: '
+                  f'{rung["num_folds"]}, mirror axes: {tuple(rung["mirror_axes"])}, tile_step_size: '
+                  f'{rung["tile_step_size"]}), estimated time {estimated_time:.2f} s')
+
+        previous_attributes = self._internal_set_attributes(self._internal_get_quality_rung_attributes(rung))
+        st = time()
+        try:
+            prediction = self._internal_predict_logits(data)
+        finally:
+            self._internal_set_attributes(previous_attributes)
+        elapsed = time() - st
+
+        # the per tile latency does not capture the overhead around the network (accumulation, transfers, ...). Learn
+        # the ratio of actual to estimated time across cases and apply it to the next estimates
+        uncorrected_estimate = estimated_time / self._time_budget_correction
+        if uncorrected_estimate > 0:
+            self._time_budget_correction = 0.5 * self._time_budget_correction + 0.5 * elapsed / uncorrected_estimate
+        self.last_inference_settings = {
+            'quality_level': quality_level,
+            'num_folds': rung['num_folds'],
+            'mirror_axes': list(rung['mirror_axes']),
+            'tile_step_size': rung['tile_step_size'],
+            'time_budget_s': self.time_budget_s,
+            'estimated_time_s': estimated_time,
+            'time_s': elapsed
+        }
+        return prediction
+
+    def _internal_get_quality_rung_attributes(self, rung: dict) -> dict:
+        num_folds = rung['num_folds']
+        assert 1 <= num_folds <= len(self.list_of_parameters), \
+            f'quality ladder asks for {num_folds} folds but only {len(self.list_of_parameters)} are loaded'
+        mirror_axes = tuple(rung['mirror_axes'])
+        assert len(mirror_axes) == 0 or (self.allowed_mirroring_axes is not None and
+                                         all([i in self.allowed_mirroring_axes for i in mirror_axes])), \
+            f'quality ladder mirror axes {mirror_axes} are not allowed for this model ({self.allowed_mirroring_axes})'
+        return {
+            'tile_step_size': rung['tile_step_size'],
+            'use_mirroring': len(mirror_axes) > 0,
+            'allowed_mirroring_axes': mirror_axes if len(mirror_axes) > 0 else self.allowed_mirroring_axes,
+            'list_of_parameters': self.list_of_parameters[:num_folds],
+            'fold_networks': self.fold_networks[:num_folds] if self.fold_networks is not None else None
+        }
+
+    def _internal_set_attributes(self, attributes: dict) -> dict:
+        """
+        Sets the given attributes and returns their previous values (so that they can be restored with this function)
+        """
+        previous = {k: getattr(self, k) for k in attributes.keys()}
+        for k, v in attributes.items():
+            setattr(self, k, v)
+        return previous
+
+    def _internal_estimate_prediction_time(self, data_shape: Tuple[int, ...], rung: dict) -> float:
+        """
+        Estimated time (in s) for predicting data of data_shape (c, x, y(, z)) with the settings of rung: number of
+        tiles x forward passes per tile (mirror combinations x folds) x measured latency of one forward pass x the
+        correction factor learned from previous cases
+        """
+        spatial_shape = data_shape[1:]
+        tile_size = self._internal_get_tile_size(spatial_shape)
+        padded_shape = [max(i, j) for i, j in zip(spatial_shape[-len(tile_size):], tile_size)]
+        steps = compute_steps_for_sliding_window(padded_shape, tile_size, rung['tile_step_size'])
+        # 2d configurations run the sliding window in each slice of the first axis
+        num_tiles = int(np.prod([len(i) for i in steps], dtype=np.int64)) * \
+                    int(np.prod(spatial_shape[:len(spatial_shape) - len(tile_size)], dtype=np.int64))
+        forward_passes_per_tile = 2 ** len(rung['mirror_axes']) * rung['num_folds']
+        return num_tiles * forward_passes_per_tile * self._internal_get_tile_latency(tile_size) * \
+            self._time_budget_correction
+
+    @torch.inference_mode()
+    def _internal_get_tile_latency(self, tile_size: Tuple[int, ...], num_warmup: int = 1, num_runs: int = 2) -> float:
+        """
+        Measures (once per tile size) how long one forward pass of a single tile takes on self.device
+        """
+        if tile_size in self._tile_latency_s.keys():
+            return self._tile_latency_s[tile_size]
+        num_input_channels = determine_num_input_channels(self.plans_manager, self.configuration_manager,
+                                                          self.dataset_json)
+        self.network = self.network.to(self.device)
+        self.network.eval()
+        x = torch.zeros((1, num_input_channels, *tile_size), device=self.device)
+        # see predict_sliding_window_return_logits for why autocast is only used with cuda
+        with torch.autocast(self.device.type, enabled=True) if self.device.type == 'cuda' else dummy_context():
+            for i in range(num_warmup + num_runs):
+                if i == num_warmup:
+                    if self.device.type == 'cuda':
+                        torch.cuda.synchronize(self.device)
+                    st = time()
+                self.network(x)
+            if self.device.type == 'cuda':
+                torch.cuda.synchronize(self.device)
+        self._tile_latency_s[tile_size] = (time() - st) / num_runs
+        if self.verbose:
+            print(f'forward pass of a {tile_size} tile takes {self._tile_latency_s[tile_size] * 1000:.1f} ms')
+        return self._tile_latency_s[tile_size]
+
+    def _internal_record_inference_settings(self, properties: dict, ofile: Optional[str]):
+        """
+        With a time budget, the settings chosen for the case that was predicted last are added to its properties (they
+        end up in the .pkl written with save_probabilities) and, if ofile is given, written to
+        <output folder>/inference_settings/<case>.json
+        """
+        if self.time_budget_s is None or self.last_inference_settings is None:
+            return
+        properties['inference_settings'] = deepcopy(self.last_inference_settings)
+        if ofile is not None:
+            settings_folder = join(os.path.dirname(ofile), 'inference_settings')
+            maybe_mkdir_p(settings_folder)
+            save_json(self.last_inference_settings, join(settings_folder, os.path.basename(ofile) + '.json'),
+                      sort_keys=False)
+
+    def _internal_plan_results_location(self, data_shape: Tuple[int, ...]) -> str:
+        """
+        Decides where the sliding window accumulates its results for an input of data_shape (c, x, y(, z)): 'device',
+        'cpu' or 'out_of_core'. Compares an estimate of the peak memory (results arrays, input image, network working
+        set, fold ensembling on the host) with the memory that is available right now, so that large cases do not
+        need a failed attempt on the device first. If available memory cannot be determined we optimistically stay
+        with the device (and the OOM fallback in predict_sliding_window_return_logits).
+        """
+        on_device = self.perform_everything_on_device and self.device.type != 'cpu'
+        if self.out_of_core_accumulation:
+            return 'out_of_core'
+        if not self.plan_results_memory:
+            return 'device' if on_device else 'cpu'
+
+        # the image is padded to at least the tile size (2d configurations leave the first axis untouched)
+        spatial_shape = data_shape[1:]
+        tile_size = self._internal_get_tile_size(spatial_shape)
+        padded_shape = [*spatial_shape[:len(spatial_shape) - len(tile_size)],
+                        *[max(i, j) for i, j in zip(spatial_shape[-len(tile_size):], tile_size)]]
+        num_voxels = int(np.prod(padded_shape, dtype=np.int64))
+        logits_bytes = self.label_manager.num_segmentation_heads * num_voxels * 2
+        weights_bytes = 0 if self.analytic_weight_normalization else num_voxels * 2
+        input_bytes = data_shape[0] * num_voxels * 4
+        results_bytes = logits_bytes + weights_bytes + input_bytes
+        # sequential fold ensembling holds the summed prediction plus the one of the current fold on the host
+        ensemble_bytes = logits_bytes if self.fold_networks is None and self.list_of_parameters is not None and \
+            len(self.list_of_parameters) > 1 else 0
+        copies_per_tile = min(self.mirror_batch_size, len(self._internal_get_mirror_axes_combinations()))
+        tile_bytes = self._internal_estimate_bytes_per_tile(tile_size) * self._internal_get_tile_batch_size(
+            np.iinfo(np.int32).max, tile_size) * copies_per_tile
+
+        # leave some headroom for fragmentation and everything we do not account for
+        safety_factor = 0.9
+        available_ram = get_available_memory(torch.device('cpu'))
+        available_device = get_available_memory(self.device) if on_device else None
+        if on_device and (available_device is None or results_bytes + tile_bytes < safety_factor * available_device):
+            location = 'device'
+            host_bytes = input_bytes + logits_bytes + ensemble_bytes
+        else:
+            location = 'cpu'
+            host_bytes = results_bytes + ensemble_bytes
+        if available_ram is not None and host_bytes > safety_factor * available_ram:
+            location = 'out_of_core'
+
+        # only report if verbose or if we deviate from what we would have done without planning
+        if not self.verbose and location == ('device' if on_device else 'cpu'):
+            return location
+        gb = 1024 ** 3
+        print(f'Results arrays: {location}. Estimated memory: results {results_bytes / gb:.2f} GB, tiles '
+              f'{tile_bytes / gb:.2f} GB, host {host_bytes / gb:.2f} GB. Available: ' +
+              (f'{self.device.type} {available_device / gb:.2f} GB, ' if available_device is not None else '') +
+              (f'RAM {available_ram / gb:.2f} GB' if available_ram is not None else 'RAM unknown'))
+        return location
+
+    def _internal_get_export_payload(self, prediction: torch.Tensor) -> Union[np.ndarray, OutOfCoreArrayHandle]:
+        """
+        Out-of-core predictions are handed to the export as a handle to the file they were accumulated in (cropped to
+        the unpadded image). The export opens (and removes) it, so nothing image-sized needs to be pickled or copied.
+        Everything else is converted to numpy.
+        """
+        handle = self.out_of_core_arrays.get_handle(prediction)
+        if handle is not None:
+            self.out_of_core_arrays.release(prediction, delete_file=False)
+            return handle
+        # convert to numpy to prevent uncatchable memory alignment errors from multiprocessing serialization of torch tensors
+        return prediction.cpu().detach().numpy()
+
+    def _internal_share_prediction(self, prediction: torch.Tensor) \
+            -> Tuple[Union[np.ndarray, OutOfCoreArrayHandle, SharedArrayHandle], Union[SharedArray, None]]:
+        """
+        Like _internal_get_export_payload, but for exports running in worker processes: the workers only receive a
+        handle to predictions in shared memory, so nothing image-sized is pickled. Predictions that were created in
+        shared memory (see share_results) are handed over as they are, other predictions in RAM are copied there. The
+        returned SharedArray (None if shared memory was not used) must be released by the caller once the export is
+        done, see release_finished_shared_arrays.
+        """
+        taken = self.shared_memory_arrays.take(prediction)
+        if taken is not None:
+            return taken
+        if self.out_of_core_arrays.get_file(prediction) is None and \
+                shared_memory_available(shared_array_nbytes(prediction)):
+            shared_prediction = SharedArray(prediction)
+            return shared_prediction.handle, shared_prediction
+        return self._internal_get_export_payload(prediction), None
+
+    def _internal_get_sliding_window_slicers(self, image_size: Tuple[int, ...],
+                                             tile_size: Optional[Tuple[int, ...]] = None):
+        """
+        tile_size defaults to the patch size of the configuration, see _internal_get_tile_size
+        """
+        if tile_size is None:
+            tile_size = self.configuration_manager.patch_size
         slicers = []
-        if len(self.configuration_manager.patch_size) < len(image_size):
-            assert len(self.configuration_manager.patch_size) == len(
+        if len(tile_size) < len(image_size):
+            assert len(tile_size) == len(
                 image_size) - 1, 'if tile_size has less entries than image_size, ' \
                                  'len(tile_size) ' \
                                  'must be one shorter than len(image_size) ' \
                                  '(only dimension ' \
                                  'discrepancy of 1 allowed).'
-            steps = compute_steps_for_sliding_window(image_size[1:], self.configuration_manager.patch_size,
-                                                     self.tile_step_size)
+            steps = compute_steps_for_sliding_window(image_size[1:], tile_size, self.tile_step_size)
             if self.verbose: print(f'n_steps {image_size[0] * len(steps[0]) * len(steps[1])}, image size is'
-                                   f' {image_size}, tile_size {self.configuration_manager.patch_size}, '
+                                   f' {image_size}, tile_size {tile_size}, '
                                    f'tile_step_size {self.tile_step_size}\nsteps:\n{steps}')
             for d in range(image_size[0]):
                 for sx in steps[0]:
                     for sy in steps[1]:
                         slicers.append(
                             tuple([slice(None), d, *[slice(si, si + ti) for si, ti in
-                                                     zip((sx, sy), self.configuration_manager.patch_size)]]))
+                                                     zip((sx, sy), tile_size)]]))
         else:
-            steps = compute_steps_for_sliding_window(image_size, self.configuration_manager.patch_size,
-                                                     self.tile_step_size)
+            steps = compute_steps_for_sliding_window(image_size, tile_size, self.tile_step_size)
             if self.verbose: print(
-                f'n_steps {np.prod([len(i) for i in steps])}, image size is {image_size}, tile_size {self.configuration_manager.patch_size}, '
+                f'n_steps {np.prod([len(i) for i in steps])}, image size is {image_size}, tile_size {tile_size}, '
                 f'tile_step_size {self.tile_step_size}\nsteps:\n{steps}')
             for sx in steps[0]:
                 for sy in steps[1]:
                     for sz in steps[2]:
                         slicers.append(
                             tuple([slice(None), *[slice(si, si + ti) for si, ti in
-                                                  zip((sx, sy, sz), self.configuration_manager.patch_size)]]))
+                                                  zip((sx, sy, sz), tile_size)]]))
         return slicers
 
+    def _internal_estimate_bytes_per_tile(self, tile_size: Optional[Tuple[int, ...]] = None) -> int:
+        """
+        Conservative estimate of the memory one tile (default: of the patch size) occupies during a forward pass. We
+        use the feature map size the experiment planner also uses for determining the patch size. It is an upper bound
+        at inference time because not all feature maps need to be kept around without gradients.
+        """
+        network = self.network
+        if isinstance(network, DistributedDataParallel):
+            network = network.module
+        if isinstance(network, OptimizedModule):
+            network = network._orig_mod
+        patch_size = self.configuration_manager.patch_size if tile_size is None else tile_size
+        bytes_per_element = 2 if self.device.type == 'cuda' else 4  # autocast is only used with cuda
+        if hasattr(network, 'compute_conv_feature_map_size'):
+            num_elements = network.compute_conv_feature_map_size(patch_size)
+        else:
+            # crude fallback for architectures that cannot tell us about their feature maps. The default 3d U-Net has
+            # roughly 270 feature map elements per input voxel
+            num_elements = np.prod(patch_size, dtype=np.int64) * 300
+        # input tile and output logits
+        num_elements += np.prod(patch_size, dtype=np.int64) * (
+                determine_num_input_channels(self.plans_manager, self.configuration_manager, self.dataset_json) +
+                self.label_manager.num_segmentation_heads)
+        return int(num_elements * bytes_per_element)
+
+    def _internal_get_mirror_axes_combinations(self) -> List[Tuple[int, ...]]:
+        """
+        Returns all flip combinations used for test time augmentation, including the empty tuple (no flipping).
+        Axes are given relative to the spatial dimensions (0 is the first spatial axis).
+        """
+        mirror_axes = self.allowed_mirroring_axes if self.use_mirroring else None
+        if mirror_axes is None:
+            return [()]
+        return [()] + [c for i in range(len(mirror_axes)) for c in itertools.combinations(mirror_axes, i + 1)]
+
+    def _internal_get_tile_size(self, image_size: Tuple[int, ...]) -> Tuple[int, ...]:
+        """
+        Size of the sliding window tiles for an image of spatial shape image_size. This is the patch size unless
+        large_tile_memory_budget_gb is set. Then the tile is grown from the patch size in steps of the downsampling
+        factors of the network, always along the axis that is smallest relative to the patch size, until it covers the
+        image or the next step would exceed the budget.
+        """
+        patch_size = tuple(self.configuration_manager.patch_size)
+        if self.large_tile_memory_budget_gb is None:
+            return patch_size
+        # the encoder must be able to downsample the tile just like the patch size
+        divisors = [int(i) for i in np.prod(self.configuration_manager.pool_op_kernel_sizes, axis=0)]
+        max_tile_size = [max(p, int(np.ceil(i / d) * d)) for i, p, d in
+                         zip(image_size[-len(patch_size):], patch_size, divisors)]
+        copies_per_tile = min(self.mirror_batch_size, len(self._internal_get_mirror_axes_combinations()))
+        budget = self.large_tile_memory_budget_gb * 1024 ** 3 / copies_per_tile
+
+        tile_size = list(patch_size)
+        growable = [i < j for i, j in zip(tile_size, max_tile_size)]
+        while any(growable):
+            axis = min([a for a in range(len(tile_size)) if growable[a]], key=lambda a: tile_size[a] / patch_size[a])
+            candidate = deepcopy(tile_size)
+            candidate[axis] = min(candidate[axis] + divisors[axis], max_tile_size[axis])
+            if self._internal_estimate_bytes_per_tile(tuple(candidate)) > budget:
+                growable[axis] = False
+                continue
+            tile_size = candidate
+            growable[axis] = tile_size[axis] < max_tile_size[axis]
+        return tuple(tile_size)
+
+    def _internal_get_tile_batch_size(self, num_tiles: int, tile_size: Optional[Tuple[int, ...]] = None) -> int:
+        memory_budget_gb = self.tile_batch_memory_budget_gb
+        if memory_budget_gb is None and self.tile_batch_size == 1 and \
+                len(self.configuration_manager.patch_size) == 2:
+            # 2d tiles are small, batch them across slices if a budget is set and the user asked for nothing else
+            memory_budget_gb = self.slice_batch_memory_budget_gb
+        if memory_budget_gb is not None:
+            # mirrored copies that are folded into the batch dimension count towards the budget as well
+            copies_per_tile = min(self.mirror_batch_size, len(self._internal_get_mirror_axes_combinations()))
+            batch_size = int(memory_budget_gb * 1024 ** 3 //
+                             (self._internal_estimate_bytes_per_tile(tile_size) * copies_per_tile))
+        else:
+            batch_size = self.tile_batch_size
+        return max(1, min(batch_size, num_tiles))
+
+    @torch.inference_mode()
+    def _internal_select_tiles_to_predict(self, data: torch.Tensor, slicers):
+        """
+        Cheap tile scheduling: scores each tile by the fraction of voxels that are nonzero in any input channel and
+        discards tiles at or below self.tile_skip_threshold. Zeros are what pad_nd_image pads with and what the
+        preprocessing puts outside of the nonzero mask.
+        """
+        if self.tile_skip_threshold is None or len(slicers) == 0:
+            return slicers
+        nonzero = torch.any(data != 0, dim=0)
+        # all tiles have the same size. The counts stay on the device of data until all of them are known, so that
+        # there is only a single synchronization
+        tile_numel = nonzero[slicers[0][1:]].numel()
+        counts = torch.stack([torch.count_nonzero(nonzero[sl[1:]]) for sl in slicers]).cpu()
+        selected = [sl for sl, c in zip(slicers, counts.tolist()) if c / tile_numel > self.tile_skip_threshold]
+        if self.verbose:
+            print(f'Tile skipping: {len(slicers) - len(selected)} of {len(slicers)} tiles are below the nonzero '
+                  f'threshold of {self.tile_skip_threshold} and will not be predicted')
+        return selected
+
+    @staticmethod
+    def _internal_get_normalized_tile_weights(normalized_weights_per_axis: Tuple[dict, ...], sl) -> torch.Tensor:
+        """
+        Outer product of the per-axis weights (see compute_normalized_tile_weights) of the tile given by slicer sl.
+        For 2d configurations the slice index in sl is skipped.
+        """
+        spatial_slicers = [i for i in sl[1:] if isinstance(i, slice)]
+        tile_weights = None
+        for axis, (weights, s) in enumerate(zip(normalized_weights_per_axis, spatial_slicers)):
+            shape = [1] * len(spatial_slicers)
+            shape[axis] = -1
+            weights_here = weights[s.start].view(shape)
+            tile_weights = weights_here if tile_weights is None else tile_weights * weights_here
+        return tile_weights
+
+    def _internal_get_background_logits(self, dtype: torch.dtype, device: torch.device) -> torch.Tensor:
+        """
+        Logits that are converted to a confident background prediction. Used for regions we did not predict.
+        """
+        background_logits = torch.zeros(self.label_manager.num_segmentation_heads, dtype=dtype, device=device)
+        if self.label_manager.has_regions:
+            background_logits.fill_(-10)
+        else:
+            background_logits[0] = 10
+        return background_logits
+
     @torch.inference_mode()
-    def _internal_maybe_mirror_and_predict(self, x: torch.Tensor) -> torch.Tensor:
+    def _internal_predict_tile_batch(self, x: torch.Tensor) -> torch.Tensor:
+        """
+        Predicts a batch of tiles with self.network or, if fold networks are resident, with all folds back to back
+        while the tiles are still on the device.
+        """
+        if self.progressive_ensembling_threshold is not None:
+            return self._internal_predict_tile_batch_progressively(x)
+        return self._internal_predict_tile_batch_full_ensemble(x)
+
+    def _internal_predict_tile_batch_full_ensemble(self, x: torch.Tensor,
+                                                   first_fold_prediction: Optional[torch.Tensor] = None) \
+            -> torch.Tensor:
+        """
+        first_fold_prediction: the logits of the first fold (or self.network) for x without mirroring, if they are
+        already known. That forward pass is then skipped. Modified in place!
+        """
+        if self.fold_networks is None:
+            return self._internal_maybe_mirror_and_predict(x, unmirrored_prediction=first_fold_prediction)
+        prediction = None
+        for network in self.fold_networks:
+            if prediction is None:
+                prediction = self._internal_maybe_mirror_and_predict(x, network, first_fold_prediction)
+            else:
+                prediction += self._internal_maybe_mirror_and_predict(x, network)
+        prediction /= len(self.fold_networks)
+        return prediction
+
+    def _internal_predict_tile_batch_progressively(self, x: torch.Tensor) -> torch.Tensor:
+        """
+        Predicts the batch with the first fold and without mirroring. Tiles that are too uncertain (see
+        progressive_ensembling_threshold) are predicted again with the full ensemble.
+        """
+        num_networks = len(self.fold_networks) if self.fold_networks is not None else 1
+        if num_networks == 1 and len(self._internal_get_mirror_axes_combinations()) == 1:
+            # nothing to add
+            self._progressive_num_tiles[0] += x.shape[0]
+            return self._internal_predict_tile_batch_full_ensemble(x)
+        prediction = self._internal_get_inference_network(
+            self.fold_networks[0] if self.fold_networks is not None else self.network)(x)
+        uncertain = self._internal_get_tile_uncertainty(prediction) > self.progressive_ensembling_threshold
+        num_uncertain = int(uncertain.sum())
+        if num_uncertain > 0:
+            # the first pass is the unmirrored prediction of the first fold, no need to repeat it
+            prediction[uncertain] = self._internal_predict_tile_batch_full_ensemble(
+                x[uncertain], prediction[uncertain]).to(prediction.dtype)
+        self._progressive_num_tiles[0] += x.shape[0]
+        self._progressive_num_tiles[1] += num_uncertain
+        return prediction
+
+    def _internal_get_tile_uncertainty(self, logits: torch.Tensor) -> torch.Tensor:
+        """
+        Fraction of the voxels of each tile (logits: b, c, x, y(, z)) whose normalized entropy (0: certain, 1: uniform)
+        is above 0.5. Regions are treated as independent binary problems and the most uncertain one counts.
+        """
+        logits = logits.float()
+        if self.label_manager.has_regions:
+            probabilities = torch.sigmoid(logits)
+            entropy = -(probabilities * torch.log(probabilities.clamp_min(1e-8)) +
+                        (1 - probabilities) * torch.log((1 - probabilities).clamp_min(1e-8)))
+            entropy = entropy.max(1)[0] / np.log(2)
+        else:
+            log_probabilities = torch.log_softmax(logits, 1)
+            entropy = -(log_probabilities.exp() * log_probabilities).sum(1) / np.log(logits.shape[1])
+        return (entropy > 0.5).flatten(1).float().mean(1)
+
+    def _internal_get_inference_network(self, network: nn.Module) -> Union[nn.Module, CPUInferenceEngine]:
+        """
+        Returns the CPUInferenceEngine of network if cpu_engine is set, else network itself
+        """
+        if self.cpu_engine is None:
+            return network
+        if id(network) not in self._cpu_engines.keys():
+            self._cpu_engines[id(network)] = CPUInferenceEngine(network, self.cpu_engine,
+                                                                self.label_manager.has_regions,
+                                                                self.cpu_engine_tolerance)
+        return self._cpu_engines[id(network)]
+
+    @torch.inference_mode()
+    def _internal_maybe_mirror_and_predict(self, x: torch.Tensor, network: Optional[nn.Module] = None,
+                                           unmirrored_prediction: Optional[torch.Tensor] = None) -> torch.Tensor:
+        """
+        unmirrored_prediction: network(x), if it is already known. It is not predicted again and modified in place!
+        """
+        if network is None:
+            network = self.network
+        network = self._internal_get_inference_network(network)
         mirror_axes = self.allowed_mirroring_axes if self.use_mirroring else None
-        prediction = self.network(x)
-
-        if mirror_axes is not None:
-            # check for invalid numbers in mirror_axes
-            # x should be 5d for 3d images and 4d for 2d. so the max value of mirror_axes cannot exceed len(x.shape) - 3
-            assert max(mirror_axes) <= x.ndim - 3, 'mirror_axes does not match the dimension of the input!'
-
-            mirror_axes = [m + 2 for m in mirror_axes]
-            axes_combinations = [
-                c for i in range(len(mirror_axes)) for c in itertools.combinations(mirror_axes, i + 1)
-            ]
-            for axes in axes_combinations:
-                prediction += torch.flip(self.network(torch.flip(x, axes)), axes)
-            prediction /= (len(axes_combinations) + 1)
+        if mirror_axes is None:
+            return network(x) if unmirrored_prediction is None else unmirrored_prediction
+
+        # check for invalid numbers in mirror_axes
+        # x should be 5d for 3d images and 4d for 2d. so the max value of mirror_axes cannot exceed len(x.shape) - 3
+        assert max(mirror_axes) <= x.ndim - 3, 'mirror_axes does not match the dimension of the input!'
+
+        axes_combinations = [tuple(m + 2 for m in c) for c in self._internal_get_mirror_axes_combinations()]
+        if self.mirror_batch_size == 1:
+            prediction = network(x) if unmirrored_prediction is None else unmirrored_prediction
+            for axes in axes_combinations[1:]:
+                prediction += torch.flip(network(torch.flip(x, axes)), axes)
+        else:
+            # fold the mirrored copies into the batch dimension. Results are summed up in the same order as above
+            prediction = unmirrored_prediction
+            # the first combination is () (no flipping)
+            axes_to_predict = axes_combinations if prediction is None else axes_combinations[1:]
+            n = x.shape[0]
+            for i in range(0, len(axes_to_predict), self.mirror_batch_size):
+                chunk = axes_to_predict[i:i + self.mirror_batch_size]
+                chunk_prediction = network(torch.cat([torch.flip(x, axes) if len(axes) > 0 else x
+                                                           for axes in chunk]))
+                for j, axes in enumerate(chunk):
+                    p = chunk_prediction[j * n:(j + 1) * n]
+                    if len(axes) > 0:
+                        p = torch.flip(p, axes)
+                    if prediction is None:
+                        prediction = p.clone()
+                    else:
+                        prediction += p
+        prediction /= len(axes_combinations)
         return prediction
 
+    @staticmethod
+    def _internal_order_slicers_for_batching(slicers):
+        """
+        2d slicers (slice index, in-plane tile) are reordered so that the slice axis is the innermost loop. Tile
+        batches then consist of the same in-plane tile of consecutive slices, which _internal_gather_tile_batch gets
+        as a view. The sort is stable, so tiles overlapping the same voxels are still accumulated in the same order.
+        3d slicers are returned as they are.
+        """
+        if len(slicers) == 0 or not isinstance(slicers[0][1], int):
+            return slicers
+        return sorted(slicers, key=lambda sl: tuple([s.start for s in sl[2:]]))
+
+    @staticmethod
+    def _internal_gather_tile_batch(data: torch.Tensor, batch_slicers) -> torch.Tensor:
+        """
+        Returns the tiles of batch_slicers stacked along a new first axis. If they are the same 2d tile of consecutive
+        slices, this is a view of data (no copy). Otherwise the tiles are copied into a new tensor.
+        """
+        first = batch_slicers[0]
+        if len(batch_slicers) > 1 and isinstance(first[1], int) and \
+                all([sl[1] == first[1] + i and sl[2:] == first[2:] for i, sl in enumerate(batch_slicers)]):
+            return data[(first[0], slice(first[1], first[1] + len(batch_slicers)), *first[2:])].transpose(0, 1)
+        return torch.stack([data[s] for s in batch_slicers])
+
+    @torch.inference_mode()
+    def _internal_tile_producer(self, data: torch.Tensor, slicers, tile_batch_size: int, q: Queue, timings: dict):
+        """
+        Puts (tile batch, batch slicers, copy_done) into q, followed by 'end'. copy_done is a cuda event the consumer
+        must wait on before using the tile batch, or None. If something goes wrong, the exception is put into q instead
+        of 'end' so that the consumer can raise it rather than wait forever.
+
+        If data is on the CPU and the network on cuda, tiles are gathered into a ring of pinned staging buffers and
+        copied to the device asynchronously on a separate stream. The copy overlaps with the prediction of the
+        previous batch. If data already is on the device of the network (CPU inference, or results on the GPU), single
+        tiles are passed on as views without any copy.
+        """
+        end = 'end'
+        try:
+            if len(slicers) == 0:
+                # all tiles were skipped
+                return
+            use_pinned_memory = data.device.type == 'cpu' and self.device.type == 'cuda'
+            if use_pinned_memory:
+                copy_stream = torch.cuda.Stream(self.device)
+                # q holds q.maxsize batches, one more is being predicted and another one is being gathered
+                staging_buffers = [torch.empty((tile_batch_size, *data[slicers[0]].shape), dtype=data.dtype,
+                                               pin_memory=True) for _ in range(q.maxsize + 2)]
+                copy_done_events = [None] * len(staging_buffers)
+
+            for b, i in enumerate(range(0, len(slicers), tile_batch_size)):
+                batch_slicers = slicers[i:i + tile_batch_size]
+                copy_done = None
+                st = time()
+                if use_pinned_memory:
+                    slot = b % len(staging_buffers)
+                    if copy_done_events[slot] is not None:
+                        # a staging buffer can only be refilled once its previous copy has finished
+                        copy_done_events[slot].synchronize()
+                    staging = staging_buffers[slot][:len(batch_slicers)]
+                    staging.copy_(self._internal_gather_tile_batch(data, batch_slicers))
+                    timings['gather'] += time() - st
+                    st = time()
+                    with torch.cuda.stream(copy_stream):
+                        workon = staging.to(self.device, non_blocking=True)
+                        copy_done = torch.cuda.Event()
+                        copy_done.record(copy_stream)
+                    copy_done_events[slot] = copy_done
+                    timings['transfer'] += time() - st
+                elif len(batch_slicers) == 1 and data.device.type == self.device.type:
+                    workon = data[batch_slicers[0]][None]
+                    timings['gather'] += time() - st
+                else:
+                    # the network gets a contiguous copy, data must not be modified
+                    workon = self._internal_gather_tile_batch(data, batch_slicers).contiguous().to(self.device)
+                    timings['gather'] += time() - st
+                q.put((workon, batch_slicers, copy_done))
+        except Exception as e:
+            end = e
+        finally:
+            q.put(end)
+
     @torch.inference_mode()
     def _internal_predict_sliding_window_return_logits(self,
                                                        data: torch.Tensor,
                                                        slicers,
                                                        do_on_device: bool = True,
+                                                       out_of_core: bool = False,
                                                        ):
         predicted_logits = n_predictions = prediction = gaussian = workon = None
-        results_device = self.device if do_on_device else torch.device('cpu')
-
-        def producer(d, slh, q):
-            for s in slh:
-                q.put((torch.clone(d[s][None], memory_format=torch.contiguous_format).to(self.device), s))
-            q.put('end')
+        results_device = self.device if do_on_device and not out_of_core else torch.device('cpu')
+        timings = {'gather': 0., 'transfer': 0., 'wait': 0., 'predict': 0., 'accumulate': 0.}
 
         try:
             empty_cache(self.device)
@@ -577,65 +1660,152 @@ class nnUNetPredictor(object):
             if self.verbose:
                 print(f'move image to device {results_device}')
             data = data.to(results_device)
+            tile_size = tuple(data[slicers[0]].shape[1:])
+            num_tiles_total = len(slicers)
+            slicers = self._internal_select_tiles_to_predict(data, slicers)
+            tile_batch_size = self._internal_get_tile_batch_size(len(slicers), tile_size)
+            if tile_batch_size > 1:
+                slicers = self._internal_order_slicers_for_batching(slicers)
             queue = Queue(maxsize=2)
-            t = Thread(target=producer, args=(data, slicers, queue))
+            t = Thread(target=self._internal_tile_producer, args=(data, slicers, tile_batch_size, queue, timings))
             t.start()
 
             # preallocate arrays
             if self.verbose:
                 print(f'preallocating results arrays on device {results_device}')
-            predicted_logits = torch.zeros((self.label_manager.num_segmentation_heads, *data.shape[1:]),
-                                           dtype=torch.half,
-                                           device=results_device)
-            n_predictions = torch.zeros(data.shape[1:], dtype=torch.half, device=results_device)
+            if out_of_core:
+                # kept so that (the unpadded part of) it can be handed to the export, see _internal_get_export_payload
+                predicted_logits = self.out_of_core_arrays.zeros((self.label_manager.num_segmentation_heads,
+                                                                  *data.shape[1:]), keep_file=True)
+            else:
+                predicted_logits = self._internal_allocate_results_array(
+                    (self.label_manager.num_segmentation_heads, *data.shape[1:]), results_device, True)
+            # skipped tiles break the normalization, so this only works if all tiles are predicted
+            use_analytic_normalization = self.analytic_weight_normalization and len(slicers) == num_tiles_total
+            if use_analytic_normalization:
+                normalized_weights = compute_normalized_tile_weights(tuple(data.shape[-len(tile_size):]),
+                                                                     tile_size, self.tile_step_size,
+                                                                     self.use_gaussian, 1. / 8, results_device)
+            elif out_of_core:
+                n_predictions = self.out_of_core_arrays.zeros(data.shape[1:])
+            else:
+                n_predictions = self._internal_allocate_results_array(data.shape[1:], results_device)
 
             if self.use_gaussian:
-                gaussian = compute_gaussian(tuple(self.configuration_manager.patch_size), sigma_scale=1. / 8,
+                gaussian = compute_gaussian(tile_size, sigma_scale=1. / 8,
                                             value_scaling_factor=10,
                                             device=results_device)
             else:
                 gaussian = 1
 
             if not self.allow_tqdm and self.verbose:
-                print(f'running prediction: {len(slicers)} steps')
+                print(f'running prediction: {len(slicers)} steps, {tile_batch_size} tiles per forward pass')
 
             with tqdm(desc=None, total=len(slicers), disable=not self.allow_tqdm) as pbar:
                 while True:
+                    st = time()
                     item = queue.get()
+                    timings['wait'] += time() - st
+                    if isinstance(item, Exception):
+                        # the tile producer failed
+                        raise item
                     if item == 'end':
                         queue.task_done()
                         break
-                    workon, sl = item
-                    prediction = self._internal_maybe_mirror_and_predict(workon)[0].to(results_device)
-
-                    if self.use_gaussian:
-                        prediction *= gaussian
-                    predicted_logits[sl] += prediction
-                    n_predictions[sl[1:]] += gaussian
+                    workon, batch_slicers, copy_done = item
+                    st = time()
+                    if copy_done is not None:
+                        # tiles were copied on the producer's stream
+                        torch.cuda.current_stream(self.device).wait_event(copy_done)
+                        workon.record_stream(torch.cuda.current_stream(self.device))
+                    prediction = self._internal_predict_tile_batch(workon).to(results_device)
+                    timings['predict'] += time() - st
+
+                    st = time()
+                    for p, sl in zip(prediction, batch_slicers):
+                        if use_analytic_normalization:
+                            p *= self._internal_get_normalized_tile_weights(normalized_weights, sl)
+                        elif self.use_gaussian:
+                            p *= gaussian
+                        predicted_logits[sl] += p
+                        if not use_analytic_normalization:
+                            n_predictions[sl[1:]] += gaussian
+                    timings['accumulate'] += time() - st
                     queue.task_done()
-                    pbar.update()
+                    pbar.update(len(batch_slicers))
             queue.join()
-
-            # predicted_logits /= n_predictions
-            torch.div(predicted_logits, n_predictions, out=predicted_logits)
-            # check for infs
-            if torch.any(torch.isinf(predicted_logits)):
-                raise RuntimeError('Encountered inf in predicted array. Aborting... If this problem persists, '
-                                   'reduce value_scaling_factor in compute_gaussian or increase the dtype of '
-                                   'predicted_logits to fp32')
+            if self.verbose:
+                # times are measured on the host. On cuda, predict and accumulate only become accurate once the
+                # host has to wait for the device. A large 'wait' means the tile producer cannot keep up
+                print('sliding window timings (s): ' + ', '.join([f'{k}: {v:.2f}' for k, v in timings.items()]))
+
+            # out-of-core arrays are finalized in slabs along the first axis so that the masks created here never
+            # have the size of the entire volume
+            self._internal_normalize_logits(predicted_logits, None if use_analytic_normalization else n_predictions,
+                                            len(slicers) < num_tiles_total,
+                                            tile_size[0] if out_of_core else None)
+            if self.buffer_pool is not None and n_predictions is not None and not out_of_core:
+                self.buffer_pool.release(n_predictions)
         except Exception as e:
+            if out_of_core and predicted_logits is not None:
+                self.out_of_core_arrays.release(predicted_logits)
             del predicted_logits, n_predictions, prediction, gaussian, workon
             empty_cache(self.device)
             empty_cache(results_device)
             raise e
         return predicted_logits
 
+    def _internal_normalize_logits(self, predicted_logits: torch.Tensor, n_predictions: Optional[torch.Tensor],
+                                   fill_not_predicted: bool, slab_size: Optional[int] = None):
+        """
+        Divides the accumulated predicted_logits by the accumulated tile weights n_predictions (None if the tile weights
+        were normalized analytically), in place and in slabs of slab_size along the first spatial axis (None: all at
+        once). If fill_not_predicted, voxels that were not covered by any predicted tile become background.
+        """
+        if slab_size is None:
+            slab_size = predicted_logits.shape[1]
+        for start in range(0, predicted_logits.shape[1], slab_size):
+            logits_slab = predicted_logits[:, start:start + slab_size]
+            if fill_not_predicted:
+                n_predictions_slab = n_predictions[start:start + slab_size]
+                not_predicted = n_predictions_slab == 0
+                n_predictions_slab[not_predicted] = 1
+                logits_slab[:, not_predicted] = \
+                    self._internal_get_background_logits(predicted_logits.dtype, predicted_logits.device)[:, None]
+
+            if n_predictions is not None:
+                # predicted_logits /= n_predictions
+                torch.div(logits_slab, n_predictions[start:start + slab_size], out=logits_slab)
+            # check for infs
+            if torch.any(torch.isinf(logits_slab)):
+                raise RuntimeError('Encountered inf in predicted array. Aborting... If this problem persists, '
+                                   'reduce value_scaling_factor in compute_gaussian or increase the dtype of '
+                                   'predicted_logits to fp32')
+
+    def _internal_allocate_results_array(self, shape: Tuple[int, ...], results_device: torch.device,
+                                         shareable: bool = False) -> torch.Tensor:
+        """
+        shareable: the array may end up being the prediction. If share_results, it is then created in shared memory
+        """
+        if shareable and self.share_results and results_device.type == 'cpu' and \
+                shared_memory_available(int(np.prod(shape, dtype=np.int64)) * 2):
+            return self.shared_memory_arrays.zeros(shape)
+        if self.buffer_pool is not None and results_device.type == 'cpu':
+            return self.buffer_pool.zeros(shape)
+        return torch.zeros(shape, dtype=torch.half, device=results_device)
+
     @torch.inference_mode()
-    def predict_sliding_window_return_logits(self, input_image: torch.Tensor) \
+    def predict_sliding_window_return_logits(self, input_image: torch.Tensor, results_location: Optional[str] = None) \
             -> Union[np.ndarray, torch.Tensor]:
+        """
+        results_location: 'device', 'cpu' or 'out_of_core'. If None, it is determined by
+        _internal_plan_results_location
+        """
         assert isinstance(input_image, torch.Tensor)
         self.network = self.network.to(self.device)
         self.network.eval()
+        if self.fold_networks is not None:
+            self.fold_networks = [i.to(self.device) for i in self.fold_networks]
 
         empty_cache(self.device)
 
@@ -654,25 +1824,33 @@ class nnUNetPredictor(object):
                 print("mirror_axes:", self.allowed_mirroring_axes if self.use_mirroring else None)
 
             # if input_image is smaller than tile_size we need to pad it to tile_size.
-            data, slicer_revert_padding = pad_nd_image(input_image, self.configuration_manager.patch_size,
+            tile_size = self._internal_get_tile_size(input_image.shape[1:])
+            if self.verbose and tile_size != tuple(self.configuration_manager.patch_size):
+                print(f'large tiles: {tile_size} instead of patch size {self.configuration_manager.patch_size}')
+            data, slicer_revert_padding = pad_nd_image(input_image, tile_size,
                                                        'constant', {'value': 0}, True,
                                                        None)
 
-            slicers = self._internal_get_sliding_window_slicers(data.shape[1:])
+            slicers = self._internal_get_sliding_window_slicers(data.shape[1:], tile_size)
+
+            if results_location is None:
+                results_location = self._internal_plan_results_location(input_image.shape)
 
-            if self.perform_everything_on_device and self.device != 'cpu':
-                # we need to try except here because we can run OOM in which case we need to fall back to CPU as a results device
+            if results_location == 'out_of_core':
+                predicted_logits = self._internal_predict_sliding_window_return_logits(data, slicers, False,
+                                                                                       out_of_core=True)
+            elif results_location == 'device':
+                # the memory planner cannot foresee everything (fragmentation, other processes), so we still need to
+                # try except here because we can run OOM in which case we need to fall back to CPU as a results device
                 try:
-                    predicted_logits = self._internal_predict_sliding_window_return_logits(data, slicers,
-                                                                                           self.perform_everything_on_device)
+                    predicted_logits = self._internal_predict_sliding_window_return_logits(data, slicers, True)
                 except RuntimeError:
                     print(
                         'Prediction on device was unsuccessful, probably due to a lack of memory. Moving results arrays to CPU')
                     empty_cache(self.device)
                     predicted_logits = self._internal_predict_sliding_window_return_logits(data, slicers, False)
             else:
-                predicted_logits = self._internal_predict_sliding_window_return_logits(data, slicers,
-                                                                                       self.perform_everything_on_device)
+                predicted_logits = self._internal_predict_sliding_window_return_logits(data, slicers, False)
 
             empty_cache(self.device)
             # revert padding
@@ -714,7 +1892,7 @@ class nnUNetPredictor(object):
         #######################
 
         # check if we need a prediction from the previous stage
-        if self.configuration_manager.previous_stage_name is not None:
+        if self._internal_requires_segs_from_prev_stage():
             assert folder_with_segs_from_prev_stage is not None, \
                 f'The requested configuration is a cascaded network. It requires the segmentations of the previous ' \
                 f'stage ({self.configuration_manager.previous_stage_name}) as input. Please provide the folder where' \
@@ -729,6 +1907,15 @@ class nnUNetPredictor(object):
         if len(list_of_lists_or_source_folder) == 0:
             return
 
+        prediction_cache_keys = {}
+        if self.prediction_cache is not None and output_filename_truncated is not None:
+            list_of_lists_or_source_folder, output_filename_truncated, seg_from_prev_stage_files, \
+                prediction_cache_keys = self._internal_restore_from_prediction_cache(
+                    list_of_lists_or_source_folder, output_filename_truncated, seg_from_prev_stage_files,
+                    save_probabilities, 0)
+            if len(list_of_lists_or_source_folder) == 0:
+                return
+
         label_manager = self.plans_manager.get_label_manager(self.dataset_json)
         preprocessor = self.configuration_manager.preprocessor_class(verbose=self.verbose)
 
@@ -749,19 +1936,30 @@ class nnUNetPredictor(object):
 
             print(f'perform_everything_on_device: {self.perform_everything_on_device}')
 
-            prediction = self.predict_logits_from_preprocessed_data(torch.from_numpy(data)).cpu()
+            prediction = self.predict_logits_from_preprocessed_data(torch.from_numpy(data))
+            self._internal_record_inference_settings(data_properties, of)
+            if of in prediction_cache_keys.keys() and self.prediction_cache.store_logits:
+                self.prediction_cache.store_prediction_logits(prediction_cache_keys[of], prediction, data_properties)
+            prediction = self._internal_get_export_payload(prediction)
 
             if of is not None:
                 export_prediction_from_logits(prediction, data_properties, self.configuration_manager, self.plans_manager,
-                  self.dataset_json, of, save_probabilities)
+                  self.dataset_json, of, save_probabilities, probabilities_format=self.probabilities_format)
+                if of in prediction_cache_keys.keys():
+                    self.prediction_cache.store_files(prediction_cache_keys[of], of, self.dataset_json['file_ending'],
+                                                      save_probabilities, self.probabilities_format)
             else:
                 ret.append(convert_predicted_logits_to_segmentation_with_correct_shape(prediction, self.plans_manager,
                      self.configuration_manager, self.label_manager,
                      data_properties,
                      save_probabilities))
 
+        if self.prediction_cache is not None and len(prediction_cache_keys) > 0:
+            self.prediction_cache.evict()
+
         # clear lru cache
         compute_gaussian.cache_clear()
+        compute_normalized_tile_weights.cache_clear()
         # clear device cache
         empty_cache(self.device)
         return ret
@@ -804,6 +2002,11 @@ def predict_entry_point_modelfolder():
                              'multiple configurations.')
     parser.add_argument('--continue_prediction', '--c', action='store_true',
                         help='Continue an aborted previous prediction (will not overwrite existing files)')
+    parser.add_argument('--journal', action='store_true', required=False, default=False,
+                        help='Keep a journal of the progress of each case in the output folder. Rerunning an '
+                             'interrupted prediction with the same command and --continue_prediction resumes with '
+                             'the cases that were not exported completely. Without --continue_prediction, the journal '
+                             'is reset and all cases are predicted again.')
     parser.add_argument('-chk', type=str, required=False, default='checkpoint_final.pth',
                         help='Name of the checkpoint you want to use. Default: checkpoint_final.pth')
     parser.add_argument('-npp', type=int, required=False, default=3,
@@ -821,6 +2024,74 @@ def predict_entry_point_modelfolder():
     parser.add_argument('--disable_progress_bar', action='store_true', required=False, default=False,
                         help='Set this flag to disable progress bar. Recommended for HPC environments (non interactive '
                              'jobs)')
+    parser.add_argument('-tile_batch_size', type=int, required=False, default=1,
+                        help='Number of sliding window tiles that are predicted together in one forward pass. Larger '
+                             'values make better use of your GPU/CPU but need more memory. Default: 1')
+    parser.add_argument('-tile_batch_memory_gb', type=float, required=False, default=None,
+                        help='If set, the number of tiles per forward pass is derived from this memory budget (in GB) '
+                             'instead of -tile_batch_size. Default: None')
+    parser.add_argument('-slice_batch_memory_gb', type=float, required=False, default=None,
+                        help='2d configurations only: if set (and -tile_batch_size and -tile_batch_memory_gb are not), '
+                             'the tiles of different slices are predicted together in one forward pass, up to this '
+                             'memory budget (in GB). 2 is a good value for most GPUs. Default: None (one tile at a '
+                             'time)')
+    parser.add_argument('--cross_case_batching', action='store_true', required=False, default=False,
+                        help='Throughput mode for many small images: tiles of different cases are predicted together '
+                             'in one forward pass. Needs a tile batch size > 1 (-tile_batch_size, '
+                             '-tile_batch_memory_gb, 2d configurations: -slice_batch_memory_gb).')
+    parser.add_argument('-large_tile_memory_gb', type=float, required=False, default=None,
+                        help='If set, the sliding window uses tiles larger than the training patch size (up to the '
+                             'image size) within this memory budget (in GB) for one forward pass. Fewer, larger tiles '
+                             'need less computation. Check the effect on a validation set first, see '
+                             'nnunetv2/inference/large_tile_validation.py. Default: None')
+    parser.add_argument('-prob_format', type=str, required=False, default='npz', choices=probabilities_formats,
+                        help='File format of the probabilities exported with --save_probabilities. b2nd (blosc2) is '
+                             'much faster to write and read than npz and can be read partially. b2nd_fp16 and '
+                             'b2nd_uint8 quantize the probabilities to make the files smaller. Default: npz')
+    parser.add_argument('-time_budget_s', type=float, required=False, default=None,
+                        help='Time (in s) the network may spend on each case. Mirroring, folds and step size are '
+                             'reduced (in that order) for cases that would take longer. The settings used for each '
+                             'case are written to <output folder>/inference_settings. Default: no budget')
+    parser.add_argument('-progressive_ensembling_threshold', type=float, required=False, default=None,
+                        help='Predict each tile with the first fold and without mirroring first and use the full '
+                             'ensemble (all folds, mirroring) only for tiles in which the fraction of uncertain voxels '
+                             'exceeds this value (0: any uncertain voxel). Implies --resident_fold_networks. '
+                             'Default: off')
+    parser.add_argument('-cpu_engine', type=str, required=False, default=None, choices=cpu_engine_precisions,
+                        help='Only for -device cpu. Run the network as a frozen, traced graph in channels last memory '
+                             'format (fp32) and optionally with bf16 autocast (bf16, needs native bf16 support of the '
+                             'CPU). Each option is checked against the regular fp32 network on the first batch and '
+                             'dropped if the predicted labels differ in more than 0.1%% of the voxels. Default: off')
+    parser.add_argument('-mirror_batch_size', type=int, required=False, default=1,
+                        help='Number of mirrored copies (test time augmentation) of a tile that are predicted together '
+                             'in one forward pass. Set this to 8 to predict all mirror combinations of a 3d tile at '
+                             'once. Default: 1')
+    parser.add_argument('-tile_skip_threshold', type=float, required=False, default=None,
+                        help='If set, sliding window tiles whose fraction of nonzero input voxels is at or below this '
+                             'value are skipped and filled with background. 0 skips only completely empty tiles '
+                             '(padding, regions outside of the nonzero mask). Default: None (predict all tiles)')
+    parser.add_argument('--resident_fold_networks', action='store_true', required=False, default=False,
+                        help='Keep one network per fold in memory instead of reloading the weights of each fold for '
+                             'every case. Each tile is then predicted by all folds in one sliding window pass.')
+    parser.add_argument('--analytic_weight_normalization', action='store_true', required=False, default=False,
+                        help='Use precomputed, separable normalization of the Gaussian tile weights instead of '
+                             'accumulating the weights in an image-sized buffer. Saves memory on large images.')
+    parser.add_argument('--out_of_core', action='store_true', required=False, default=False,
+                        help='Accumulate the logits in memory mapped files on disk instead of RAM/VRAM. For images '
+                             'whose logits do not fit into RAM (many classes, whole body CT). Slow!')
+    parser.add_argument('-out_of_core_folder', type=str, required=False, default=None,
+                        help='Folder for the memory mapped files of --out_of_core. Should be on a fast SSD. '
+                             'Default: the temp directory')
+    parser.add_argument('-cache_folder', type=str, required=False, default=None,
+                        help='Cache predictions in this folder. Cases whose input files, model and inference settings '
+                             'did not change since they were cached are not predicted again. Default: no cache')
+    parser.add_argument('-cache_size_gb', type=float, required=False, default=50,
+                        help='Maximum size of the prediction cache in GB. Least recently used entries are evicted. '
+                             'Default: 50')
+    parser.add_argument('--cache_logits', action='store_true', required=False, default=False,
+                        help='Also cache the logits (fp16) so that cached cases can be exported with different '
+                             'settings (for example --save_probabilities) without running the network. Needs a lot '
+                             'more space!')
 
     print(
         "\n#######################################################################\nPlease cite the following paper "
@@ -857,14 +2128,32 @@ def predict_entry_point_modelfolder():
                                 device=device,
                                 verbose=args.verbose,
                                 allow_tqdm=not args.disable_progress_bar,
-                                verbose_preprocessing=args.verbose)
+                                verbose_preprocessing=args.verbose,
+                                tile_batch_size=args.tile_batch_size,
+                                tile_batch_memory_budget_gb=args.tile_batch_memory_gb,
+                                slice_batch_memory_budget_gb=args.slice_batch_memory_gb,
+                                cross_case_batching=args.cross_case_batching,
+                                large_tile_memory_budget_gb=args.large_tile_memory_gb,
+                                probabilities_format=args.prob_format,
+                                time_budget_s=args.time_budget_s,
+                                progressive_ensembling_threshold=args.progressive_ensembling_threshold,
+                                cpu_engine=args.cpu_engine,
+                                mirror_batch_size=args.mirror_batch_size,
+                                tile_skip_threshold=args.tile_skip_threshold,
+                                resident_fold_networks=args.resident_fold_networks,
+                                analytic_weight_normalization=args.analytic_weight_normalization,
+                                out_of_core_accumulation=args.out_of_core,
+                                out_of_core_folder=args.out_of_core_folder,
+                                prediction_cache_folder=args.cache_folder,
+                                prediction_cache_size_gb=args.cache_size_gb,
+                                prediction_cache_logits=args.cache_logits)
     predictor.initialize_from_trained_model_folder(args.m, args.f, args.chk)
     predictor.predict_from_files(args.i, args.o, save_probabilities=args.save_probabilities,
                                  overwrite=not args.continue_prediction,
                                  num_processes_preprocessing=args.npp,
                                  num_processes_segmentation_export=args.nps,
                                  folder_with_segs_from_prev_stage=args.prev_stage_predictions,
-                                 num_parts=1, part_id=0)
+                                 num_parts=1, part_id=0, use_journal=args.journal)
 
 
 def predict_entry_point():
@@ -923,6 +2212,12 @@ def predict_entry_point():
                              'num_parts - 1. So when you submit 5 nnUNetv2_predict calls you need to set -num_parts '
                              '5 and use -part_id 0, 1, 2, 3 and 4. Simple, right? Note: You are yourself responsible '
                              'to make these run on separate GPUs! Use CUDA_VISIBLE_DEVICES (google, yo!)')
+    parser.add_argument('--journal', action='store_true', required=False, default=False,
+                        help='Keep a journal of the progress of each case in the output folder. Rerunning an '
+                             'interrupted prediction with the same command and --continue_prediction resumes with '
+                             'the cases that were not exported completely. Without --continue_prediction, the journal '
+                             'is reset and all cases are predicted again. With -num_parts, parts that finish early '
+                             'take over the cases of the other parts. All parts must use the same output folder.')
     parser.add_argument('-device', type=str, default='cuda', required=False,
                         help="Use this to set the device the inference should run with. Available options are 'cuda' "
                              "(GPU), 'cpu' (CPU) and 'mps' (Apple M1/M2). Do NOT use this to set which GPU ID! "
@@ -930,6 +2225,74 @@ def predict_entry_point():
     parser.add_argument('--disable_progress_bar', action='store_true', required=False, default=False,
                         help='Set this flag to disable progress bar. Recommended for HPC environments (non interactive '
                              'jobs)')
+    parser.add_argument('-tile_batch_size', type=int, required=False, default=1,
+                        help='Number of sliding window tiles that are predicted together in one forward pass. Larger '
+                             'values make better use of your GPU/CPU but need more memory. Default: 1')
+    parser.add_argument('-tile_batch_memory_gb', type=float, required=False, default=None,
+                        help='If set, the number of tiles per forward pass is derived from this memory budget (in GB) '
+                             'instead of -tile_batch_size. Default: None')
+    parser.add_argument('-slice_batch_memory_gb', type=float, required=False, default=None,
+                        help='2d configurations only: if set (and -tile_batch_size and -tile_batch_memory_gb are not), '
+                             'the tiles of different slices are predicted together in one forward pass, up to this '
+                             'memory budget (in GB). 2 is a good value for most GPUs. Default: None (one tile at a '
+                             'time)')
+    parser.add_argument('--cross_case_batching', action='store_true', required=False, default=False,
+                        help='Throughput mode for many small images: tiles of different cases are predicted together '
+                             'in one forward pass. Needs a tile batch size > 1 (-tile_batch_size, '
+                             '-tile_batch_memory_gb, 2d configurations: -slice_batch_memory_gb).')
+    parser.add_argument('-large_tile_memory_gb', type=float, required=False, default=None,
+                        help='If set, the sliding window uses tiles larger than the training patch size (up to the '
+                             'image size) within this memory budget (in GB) for one forward pass. Fewer, larger tiles '
+                             'need less computation. Check the effect on a validation set first, see '
+                             'nnunetv2/inference/large_tile_validation.py. Default: None')
+    parser.add_argument('-prob_format', type=str, required=False, default='npz', choices=probabilities_formats,
+                        help='File format of the probabilities exported with --save_probabilities. b2nd (blosc2) is '
+                             'much faster to write and read than npz and can be read partially. b2nd_fp16 and '
+                             'b2nd_uint8 quantize the probabilities to make the files smaller. Default: npz')
+    parser.add_argument('-time_budget_s', type=float, required=False, default=None,
+                        help='Time (in s) the network may spend on each case. Mirroring, folds and step size are '
+                             'reduced (in that order) for cases that would take longer. The settings used for each '
+                             'case are written to <output folder>/inference_settings. Default: no budget')
+    parser.add_argument('-progressive_ensembling_threshold', type=float, required=False, default=None,
+                        help='Predict each tile with the first fold and without mirroring first and use the full '
+                             'ensemble (all folds, mirroring) only for tiles in which the fraction of uncertain voxels '
+                             'exceeds this value (0: any uncertain voxel). Implies --resident_fold_networks. '
+                             'Default: off')
+    parser.add_argument('-cpu_engine', type=str, required=False, default=None, choices=cpu_engine_precisions,
+                        help='Only for -device cpu. Run the network as a frozen, traced graph in channels last memory '
+                             'format (fp32) and optionally with bf16 autocast (bf16, needs native bf16 support of the '
+                             'CPU). Each option is checked against the regular fp32 network on the first batch and '
+                             'dropped if the predicted labels differ in more than 0.1%% of the voxels. Default: off')
+    parser.add_argument('-mirror_batch_size', type=int, required=False, default=1,
+                        help='Number of mirrored copies (test time augmentation) of a tile that are predicted together '
+                             'in one forward pass. Set this to 8 to predict all mirror combinations of a 3d tile at '
+                             'once. Default: 1')
+    parser.add_argument('-tile_skip_threshold', type=float, required=False, default=None,
+                        help='If set, sliding window tiles whose fraction of nonzero input voxels is at or below this '
+                             'value are skipped and filled with background. 0 skips only completely empty tiles '
+                             '(padding, regions outside of the nonzero mask). Default: None (predict all tiles)')
+    parser.add_argument('--resident_fold_networks', action='store_true', required=False, default=False,
+                        help='Keep one network per fold in memory instead of reloading the weights of each fold for '
+                             'every case. Each tile is then predicted by all folds in one sliding window pass.')
+    parser.add_argument('--analytic_weight_normalization', action='store_true', required=False, default=False,
+                        help='Use precomputed, separable normalization of the Gaussian tile weights instead of '
+                             'accumulating the weights in an image-sized buffer. Saves memory on large images.')
+    parser.add_argument('--out_of_core', action='store_true', required=False, default=False,
+                        help='Accumulate the logits in memory mapped files on disk instead of RAM/VRAM. For images '
+                             'whose logits do not fit into RAM (many classes, whole body CT). Slow!')
+    parser.add_argument('-out_of_core_folder', type=str, required=False, default=None,
+                        help='Folder for the memory mapped files of --out_of_core. Should be on a fast SSD. '
+                             'Default: the temp directory')
+    parser.add_argument('-cache_folder', type=str, required=False, default=None,
+                        help='Cache predictions in this folder. Cases whose input files, model and inference settings '
+                             'did not change since they were cached are not predicted again. Default: no cache')
+    parser.add_argument('-cache_size_gb', type=float, required=False, default=50,
+                        help='Maximum size of the prediction cache in GB. Least recently used entries are evicted. '
+                             'Default: 50')
+    parser.add_argument('--cache_logits', action='store_true', required=False, default=False,
+                        help='Also cache the logits (fp16) so that cached cases can be exported with different '
+                             'settings (for example --save_probabilities) without running the network. Needs a lot '
+                             'more space!')
 
     print(
         "\n#######################################################################\nPlease cite the following paper "
@@ -971,7 +2334,25 @@ def predict_entry_point():
                                 device=device,
                                 verbose=args.verbose,
                                 verbose_preprocessing=args.verbose,
-                                allow_tqdm=not args.disable_progress_bar)
+                                allow_tqdm=not args.disable_progress_bar,
+                                tile_batch_size=args.tile_batch_size,
+                                tile_batch_memory_budget_gb=args.tile_batch_memory_gb,
+                                slice_batch_memory_budget_gb=args.slice_batch_memory_gb,
+                                cross_case_batching=args.cross_case_batching,
+                                large_tile_memory_budget_gb=args.large_tile_memory_gb,
+                                probabilities_format=args.prob_format,
+                                time_budget_s=args.time_budget_s,
+                                progressive_ensembling_threshold=args.progressive_ensembling_threshold,
+                                cpu_engine=args.cpu_engine,
+                                mirror_batch_size=args.mirror_batch_size,
+                                tile_skip_threshold=args.tile_skip_threshold,
+                                resident_fold_networks=args.resident_fold_networks,
+                                analytic_weight_normalization=args.analytic_weight_normalization,
+                                out_of_core_accumulation=args.out_of_core,
+                                out_of_core_folder=args.out_of_core_folder,
+                                prediction_cache_folder=args.cache_folder,
+                                prediction_cache_size_gb=args.cache_size_gb,
+                                prediction_cache_logits=args.cache_logits)
     predictor.initialize_from_trained_model_folder(
         model_folder,
         args.f,
@@ -982,6 +2363,7 @@ def predict_entry_point():
     
     if run_sequential:
         
+        assert not args.journal, '--journal is not supported in non-multiprocessing mode (-npp 0 -nps 0)'
         print("Running in non-multiprocessing mode")
         predictor.predict_from_files_sequential(args.i, args.o, save_probabilities=args.save_probabilities,
                                                 overwrite=not args.continue_prediction,
@@ -995,7 +2377,8 @@ def predict_entry_point():
                                     num_processes_segmentation_export=args.nps,
                                     folder_with_segs_from_prev_stage=args.prev_stage_predictions,
                                     num_parts=args.num_parts,
-                                    part_id=args.part_id)
+                                    part_id=args.part_id,
+                                    use_journal=args.journal)
     
     # r = predict_from_raw_data(args.i,
     #                           args.o,
@@ -0,0 +1,151 @@
+import hashlib
+import os
+import shutil
+from typing import List, Union
+
+import numpy as np
+import torch
+from batchgenerators.utilities.file_and_folder_operations import join, isfile, isdir, maybe_mkdir_p, subdirs, \
+    load_pickle, save_pickle
+
+from nnunetv2.inference.export_prediction import export_prediction_from_logits
+from nnunetv2.inference.probability_store import get_probabilities_file_ending
+from nnunetv2.utilities.plans_handling.plans_handler import PlansManager, ConfigurationManager
+
+
+class PredictionCache(object):
+    """
+    Content-addressed cache for predictions. The key of a case is a hash of the contents of its input files (plus the
+    segmentation of the previous stage for the cascade) and of the model fingerprint (see
+    nnUNetPredictor._internal_get_model_fingerprint: weights, plans, dataset.json and all inference settings that
+    affect the prediction). So unlike overwrite=False, changed inputs or a different checkpoint are detected.
+
+    Each entry is a folder holding the exported files of the case (segmentation and, if they were saved,
+    probabilities in each probabilities_format that was requested). If store_logits is set, it also holds the logits
+    (fp16, in the preprocessed space) together with the properties needed to export them. Hits with different export
+    settings (for example save_probabilities) are exported from those logits without running preprocessing or the
+    network.
+
+    Once the cache is larger than max_size_gb, entries are evicted in least recently used order. All files are
+    written under a temporary name and then renamed, so concurrent runs never see partial files.
+    """
+    def __init__(self, folder: str, max_size_gb: float = 50, store_logits: bool = False):
+        self.folder = folder
+        self.max_size_gb = max_size_gb
+        self.store_logits = store_logits
+        maybe_mkdir_p(folder)
+
+    @staticmethod
+    def get_case_key(input_files: List[str], seg_from_prev_stage_file: Union[str, None],
+                     model_fingerprint: str) -> str:
+        h = hashlib.sha256()
+        h.update(model_fingerprint.encode())
+        for f in input_files + ([seg_from_prev_stage_file] if seg_from_prev_stage_file is not None else []):
+            h.update(b'\0')
+            with open(f, 'rb') as fh:
+                for chunk in iter(lambda: fh.read(1024 * 1024), b''):
+                    h.update(chunk)
+        return h.hexdigest()
+
+    def get_entry(self, key: str) -> str:
+        return join(self.folder, key)
+
+    def _touch(self, key: str):
+        try:
+            os.utime(self.get_entry(key))
+        except FileNotFoundError:
+            # evicted in the meantime
+            pass
+
+    @staticmethod
+    def _atomic_copy(source: str, target: str):
+        tmp = f'{target}.tmp_{os.getpid()}'
+        shutil.copyfile(source, tmp)
+        os.replace(tmp, target)
+
+    def has_logits(self, key: str) -> bool:
+        entry = self.get_entry(key)
+        return isfile(join(entry, 'logits.npy')) and isfile(join(entry, 'properties.pkl'))
+
+    @staticmethod
+    def _probabilities_file(probabilities_format: str) -> str:
+        return f'probabilities_{probabilities_format}' + get_probabilities_file_ending(probabilities_format)
+
+    def restore_files(self, key: str, output_file_truncated: str, file_ending: str, save_probabilities: bool,
+                      probabilities_format: str = 'npz') -> bool:
+        """
+        Copies the exported files of the entry to output_file_truncated. Returns False (and copies nothing) if the
+        entry does not have all the files that are needed.
+        """
+        entry = self.get_entry(key)
+        files = [('segmentation' + file_ending, file_ending)]
+        if save_probabilities:
+            files += [(self._probabilities_file(probabilities_format),
+                       get_probabilities_file_ending(probabilities_format)),
+                      ('probabilities.pkl', '.pkl')]
+        if not all([isfile(join(entry, i[0])) for i in files]):
+            return False
+        try:
+            for source, ending in files:
+                self._atomic_copy(join(entry, source), output_file_truncated + ending)
+        except FileNotFoundError:
+            # evicted in the meantime
+            return False
+        self._touch(key)
+        return True
+
+    def store_files(self, key: str, output_file_truncated: str, file_ending: str, save_probabilities: bool,
+                    probabilities_format: str = 'npz'):
+        entry = self.get_entry(key)
+        maybe_mkdir_p(entry)
+        if save_probabilities:
+            self._atomic_copy(output_file_truncated + get_probabilities_file_ending(probabilities_format),
+                              join(entry, self._probabilities_file(probabilities_format)))
+            self._atomic_copy(output_file_truncated + '.pkl', join(entry, 'probabilities.pkl'))
+        self._atomic_copy(output_file_truncated + file_ending, join(entry, 'segmentation' + file_ending))
+
+    def store_prediction_logits(self, key: str, logits: Union[np.ndarray, torch.Tensor], properties: dict):
+        entry = self.get_entry(key)
+        maybe_mkdir_p(entry)
+        save_pickle(properties, join(entry, 'properties.pkl'))
+        if isinstance(logits, torch.Tensor):
+            logits = logits.cpu().numpy()
+        # logits.npy is written last, has_logits relies on that
+        tmp = join(entry, f'logits.npy.tmp_{os.getpid()}')
+        with open(tmp, 'wb') as f:
+            np.save(f, logits.astype(np.float16, copy=False))
+        os.replace(tmp, join(entry, 'logits.npy'))
+
+    def evict(self):
+        entries = []
+        for key in subdirs(self.folder, join=False):
+            entry = self.get_entry(key)
+            try:
+                size = sum([os.path.getsize(join(entry, i)) for i in os.listdir(entry)])
+                entries.append((os.path.getmtime(entry), size, key))
+            except FileNotFoundError:
+                continue
+        total_size = sum([i[1] for i in entries])
+        max_size = self.max_size_gb * 1024 ** 3
+        num_evicted = 0
+        for _, size, key in sorted(entries):
+            if total_size <= max_size:
+                break
+            shutil.rmtree(self.get_entry(key), ignore_errors=True)
+            total_size -= size
+            num_evicted += 1
+        if num_evicted > 0:
+            print(f'Prediction cache: evicted {num_evicted} entries, {total_size / 1024 ** 3:.2f} GB remain')
+
+
+def export_prediction_from_cache(entry: str, configuration_manager: ConfigurationManager,
+                                 plans_manager: PlansManager, dataset_json: dict, output_file_truncated: str,
+                                 save_probabilities: bool = False, probabilities_format: str = 'npz'):
+    """
+    Exports the logits of a prediction cache entry. Meant to run in a worker process, only the path is pickled.
+    """
+    assert isdir(entry), f'prediction cache entry {entry} does not exist'
+    logits = np.load(join(entry, 'logits.npy'), mmap_mode='c')
+    properties = load_pickle(join(entry, 'properties.pkl'))
+    export_prediction_from_logits(logits, properties, configuration_manager, plans_manager, dataset_json,
+                                  output_file_truncated, save_probabilities, probabilities_format=probabilities_format)
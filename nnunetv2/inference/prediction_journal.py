@@ -0,0 +1,204 @@
+import json
+import os
+import socket
+from threading import Thread, Event
+from time import time
+from typing import Union, List
+
+from batchgenerators.utilities.file_and_folder_operations import join, maybe_mkdir_p, subfiles
+
+
+class PredictionJournal(object):
+    """
+    Journal for large predict_from_files jobs that may die halfway (OOM, preempted nodes). It lives in a folder
+    (default: <output_folder>/.journal) and holds, per case:
+    - <case>.json: the state of the case, one of PredictionJournal.states. 'exported' means that all output files were
+      written (exports are atomic, see export_prediction_from_logits). Cases in any other state were interrupted and
+      are predicted again from scratch. Rerunning the same command resumes exactly with the cases that are not
+      exported yet. Each state also records the fingerprint of the model and settings it was written with (see
+      nnUNetPredictor._internal_get_model_fingerprint). States with a different fingerprint are ignored, so a rerun
+      with another model or other settings predicts everything again. So does reset.
+    - <case>.claim: the worker (host, pid, part) that currently works on the case. Claims are created atomically
+      (O_EXCL), so all parts (part_id/num_parts) of a job can draw from the same list of cases: a part that is done
+      with its own share continues with the cases of the other parts that nobody has claimed yet (work stealing).
+      Claims are refreshed by a heartbeat (start_heartbeat). Claims that have not been refreshed for
+      claim_timeout_s seconds (or whose process is gone, if it ran on the same host) belong to a worker that died and
+      are taken over. In rare races with such a takeover a case may be predicted twice, which is harmless.
+
+    The journal must be picklable because preprocessing workers claim the cases they preprocess.
+    """
+    states = ('queued', 'preprocessed', 'predicted', 'exported')
+
+    def __init__(self, folder: str, part_id: int = 0, claim_timeout_s: float = 600, fingerprint: str = None):
+        self.folder = folder
+        self.fingerprint = fingerprint
+        self.created = time()
+        self.hostname = socket.gethostname()
+        self.worker_id = f'{self.hostname}_{os.getpid()}_part{part_id}'
+        self.claim_timeout_s = claim_timeout_s
+        self._heartbeat_stop = None
+        maybe_mkdir_p(folder)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_heartbeat_stop'] = None
+        return state
+
+    def _state_file(self, case: str) -> str:
+        return join(self.folder, case + '.json')
+
+    def _claim_file(self, case: str) -> str:
+        return join(self.folder, case + '.claim')
+
+    def set_state(self, case: str, state: str):
+        assert state in self.states, f'unknown state {state}, must be one of {self.states}'
+        tmp = self._state_file(case) + f'.tmp_{os.getpid()}'
+        with open(tmp, 'w') as f:
+            json.dump({'state': state, 'worker': self.worker_id, 'time': time(), 'fingerprint': self.fingerprint}, f)
+        os.replace(tmp, self._state_file(case))
+
+    def get_state(self, case: str) -> Union[str, None]:
+        """
+        None if the case has no state or one that was written with a different fingerprint
+        """
+        try:
+            with open(self._state_file(case), 'r') as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return None
+        if state.get('fingerprint') != self.fingerprint:
+            return None
+        return state['state']
+
+    def reset(self):
+        """
+        Forgets the states of all cases so that everything is predicted again. States written after this journal was
+        created are kept: they belong to parts of the same job that started a little earlier. Claims are not touched.
+        """
+        for s in subfiles(self.folder, suffix='.json', join=True):
+            try:
+                with open(s, 'r') as f:
+                    written = json.load(f)['time']
+                if written < self.created:
+                    os.remove(s)
+            except FileNotFoundError:
+                # removed by another part in the meantime
+                pass
+
+    def is_exported(self, case: str) -> bool:
+        return self.get_state(case) == 'exported'
+
+    def _is_stale(self, claim_file: str) -> bool:
+        if time() - os.path.getmtime(claim_file) > self.claim_timeout_s:
+            return True
+        with open(claim_file, 'r') as f:
+            # hostname, pid, part (see worker_id). Empty if the owner has not written it yet
+            owner = f.read().rsplit('_', 2)
+        if len(owner) != 3 or owner[0] != self.hostname or not owner[1].isdigit():
+            return False
+        try:
+            os.kill(int(owner[1]), 0)
+        except ProcessLookupError:
+            return True
+        except PermissionError:
+            # exists but belongs to somebody else
+            pass
+        return False
+
+    def claim(self, case: str) -> bool:
+        """
+        Returns True if we now own case and need to predict it, False if it is done or somebody else is working on it
+        """
+        if self.is_exported(case):
+            return False
+        claim_file = self._claim_file(case)
+        try:
+            fd = os.open(claim_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            try:
+                stale = self._is_stale(claim_file)
+            except FileNotFoundError:
+                # released in the meantime
+                return self.claim(case)
+            if not stale:
+                return False
+            # the owner stopped sending heartbeats. Only one of the workers that try to take over wins the rename
+            stale_file = claim_file + f'.stale_{os.getpid()}'
+            try:
+                os.rename(claim_file, stale_file)
+            except FileNotFoundError:
+                return False
+            os.remove(stale_file)
+            print(f'Taking over stale claim of case {case}')
+            return self.claim(case)
+        with os.fdopen(fd, 'w') as f:
+            f.write(self.worker_id)
+        # the case may have been exported between our check and the claim
+        if self.is_exported(case):
+            self.release_claim(case)
+            return False
+        self.set_state(case, 'queued')
+        return True
+
+    def mark_exported(self, case: str):
+        self.set_state(case, 'exported')
+        self.release_claim(case)
+
+    def release_claim(self, case: str):
+        try:
+            os.remove(self._claim_file(case))
+        except FileNotFoundError:
+            pass
+
+    def _get_my_claims(self) -> List[str]:
+        claims = []
+        for c in subfiles(self.folder, suffix='.claim', join=True):
+            try:
+                with open(c, 'r') as f:
+                    if f.read() == self.worker_id:
+                        claims.append(c)
+            except FileNotFoundError:
+                pass
+        return claims
+
+    def release_all_claims(self):
+        for c in self._get_my_claims():
+            try:
+                os.remove(c)
+            except FileNotFoundError:
+                pass
+
+    def _heartbeat(self, stop: Event):
+        while not stop.wait(self.claim_timeout_s / 5):
+            for c in self._get_my_claims():
+                try:
+                    os.utime(c)
+                except FileNotFoundError:
+                    pass
+
+    def start_heartbeat(self):
+        """
+        Keeps our claims (including the ones made by our preprocessing workers) alive until stop_heartbeat. If the
+        process dies, so does the heartbeat and other workers take over our cases after claim_timeout_s.
+        """
+        if self._heartbeat_stop is not None:
+            return
+        self._heartbeat_stop = Event()
+        Thread(target=self._heartbeat, args=(self._heartbeat_stop,), daemon=True).start()
+
+    def stop_heartbeat(self):
+        if self._heartbeat_stop is not None:
+            self._heartbeat_stop.set()
+            self._heartbeat_stop = None
+
+
+def order_cases_for_work_stealing(cases: list, part_id: int, num_parts: int) -> list:
+    """
+    The own share of part_id ([part_id::num_parts], just like the static split) comes first. It is followed by the
+    shares of the other parts, each in reverse order so that we steal from the end of their lists while they work
+    on the beginning.
+    """
+    ordered = cases[part_id::num_parts]
+    for p in range(1, num_parts):
+        ordered += cases[(part_id + p) % num_parts::num_parts][::-1]
+    return ordered
@@ -0,0 +1,108 @@
+"""
+Predicted probabilities (--save_probabilities) can be stored in two formats:
+- 'npz': np.savez_compressed, key 'probabilities'. Compression is single threaded zlib and the file can only be read
+  as a whole. The default, because other tools may expect it.
+- 'b2nd': blosc2 NDArray with multi-threaded ZSTD compression, chunked along the first spatial axis so that slabs can
+  be read without decompressing the entire array. 'b2nd_fp16' and 'b2nd_uint8' additionally quantize the
+  probabilities to float16 or to uint8 (probability * 255, at most 1/510 off). load_probabilities returns uint8
+  files as float32 again.
+Readers (load_probabilities, ensembling) detect the format from the file ending. A case must not have files in both
+formats in the same folder, get_probabilities_files_per_case refuses to guess which one is current.
+"""
+
+import os
+from typing import Dict, List, Union, Tuple
+
+import blosc2
+import numpy as np
+from batchgenerators.utilities.file_and_folder_operations import subfiles
+
+from nnunetv2.configuration import default_num_processes
+
+
+probabilities_formats = ('npz', 'b2nd', 'b2nd_fp16', 'b2nd_uint8')
+probabilities_file_endings = ('.npz', '.b2nd')
+
+
+def get_probabilities_file_ending(probabilities_format: str) -> str:
+    assert probabilities_format in probabilities_formats, \
+        f'unknown probabilities_format {probabilities_format}, must be one of {probabilities_formats}'
+    return '.npz' if probabilities_format == 'npz' else '.b2nd'
+
+
+def strip_probabilities_file_ending(filename: str) -> str:
+    for ending in probabilities_file_endings:
+        if filename.endswith(ending):
+            return filename[:-len(ending)]
+    raise ValueError(f'{filename} is not a probabilities file (endings: {probabilities_file_endings})')
+
+
+def subfiles_probabilities(folder: str, join: bool = True) -> List[str]:
+    return [i for ending in probabilities_file_endings for i in subfiles(folder, suffix=ending, join=join)]
+
+
+def get_probabilities_files_per_case(folder: str, join: bool = True) -> Dict[str, str]:
+    """
+    case identifier -> probabilities file in folder. Raises a RuntimeError if a case has more than one probabilities
+    file (for example case.npz and case.b2nd from two runs with different -prob_format) because we cannot know which
+    of them is the right one. Delete the outdated file(s) and try again
+    """
+    files_per_case = {}
+    for f in subfiles_probabilities(folder, join=join):
+        case = strip_probabilities_file_ending(os.path.basename(f))
+        if case in files_per_case.keys():
+            raise RuntimeError(f'Case {case} has more than one probabilities file in {folder}: {files_per_case[case]} '
+                               f'and {f}. Please delete the outdated one')
+        files_per_case[case] = f
+    return files_per_case
+
+
+def save_probabilities(probabilities: np.ndarray, output_file_truncated: str, probabilities_format: str = 'npz',
+                       num_threads: int = default_num_processes, max_chunk_bytes: int = 64 * 1024 ** 2) -> str:
+    """
+    probabilities must have shape (c, x, y(, z)). Returns the name of the file that was written
+    (output_file_truncated + file ending of probabilities_format)
+    """
+    output_file = output_file_truncated + get_probabilities_file_ending(probabilities_format)
+    if probabilities_format == 'npz':
+        np.savez_compressed(output_file, probabilities=probabilities)
+        return output_file
+
+    if probabilities_format == 'b2nd_uint8':
+        probabilities = np.round(probabilities * 255).astype(np.uint8)
+    elif probabilities_format == 'b2nd_fp16':
+        probabilities = probabilities.astype(np.float16, copy=False)
+    probabilities = np.ascontiguousarray(probabilities)
+    # one channel and a slab of the first spatial axis per chunk. blosc2 picks the blocks
+    bytes_per_slice = int(np.prod(probabilities.shape[2:], dtype=np.int64)) * probabilities.itemsize
+    chunks = (1, max(1, min(probabilities.shape[1], max_chunk_bytes // bytes_per_slice)), *probabilities.shape[2:])
+    cparams = {
+        'codec': blosc2.Codec.ZSTD,
+        'clevel': 3,
+        'nthreads': num_threads
+    }
+    if os.path.isfile(output_file):
+        # blosc2 does not overwrite existing files
+        os.remove(output_file)
+    array = blosc2.asarray(probabilities, urlpath=output_file, chunks=chunks, cparams=cparams)
+    array.vlmeta['probabilities_format'] = probabilities_format
+    return output_file
+
+
+def load_probabilities(filename: str, slicer: Union[Tuple[slice, ...], None] = None,
+                       num_threads: int = default_num_processes) -> np.ndarray:
+    """
+    Reads a file written by save_probabilities. slicer (for example (slice(None), slice(10, 20))) selects the part of
+    the array that is read. Only b2nd files are actually read partially. uint8 quantized probabilities are returned as
+    float32 in [0, 1], all other files are returned with the dtype they were stored with.
+    """
+    if slicer is None:
+        slicer = (slice(None),)
+    if filename.endswith('.npz'):
+        return np.load(filename)['probabilities'][slicer]
+    assert filename.endswith('.b2nd'), f'{filename} is not a probabilities file'
+    array = blosc2.open(urlpath=filename, mode='r', dparams={'nthreads': num_threads})
+    probabilities = array[slicer]
+    if array.dtype == np.uint8:
+        probabilities = probabilities.astype(np.float32) / 255
+    return probabilities
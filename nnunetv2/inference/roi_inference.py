@@ -0,0 +1,202 @@
+import argparse
+import hashlib
+from typing import Union, List
+
+import numpy as np
+import torch
+
+from nnunetv2.inference.predict_from_raw_data import nnUNetPredictor
+from nnunetv2.preprocessing.resampling.default_resampling import compute_new_shape
+from nnunetv2.utilities.file_path_utilities import get_output_folder
+
+
+def resample_preprocessed_data_to_configuration(data: torch.Tensor,
+                                                source_predictor: nnUNetPredictor,
+                                                target_predictor: nnUNetPredictor) -> torch.Tensor:
+    """
+    Brings data that was preprocessed for the configuration of source_predictor to the spacing of the configuration
+    of target_predictor. Normalization happens before resampling in our preprocessing, so this is (up to
+    interpolation) the same as preprocessing the image for the target configuration directly. Both configurations
+    must stem from the same plans (same cropping, same normalization).
+    """
+    source_spacing = source_predictor.configuration_manager.spacing
+    target_spacing = target_predictor.configuration_manager.spacing
+    target_shape = compute_new_shape(data.shape[1:], source_spacing, target_spacing)
+    resampled = target_predictor.configuration_manager.resampling_fn_data(data.cpu().numpy(), target_shape,
+                                                                          source_spacing, target_spacing)
+    return torch.from_numpy(np.ascontiguousarray(resampled, dtype=np.float32))
+
+
+class nnUNetROIPredictor(nnUNetPredictor):
+    """
+    Coarse-to-fine inference for datasets that have 3d_lowres and 3d_fullres. The cheap lowres model is run first.
+    The bounding box of its foreground prediction (plus a margin) is then predicted with the fullres model (this
+    predictor) and pasted into an otherwise background volume.
+
+    Usage:
+        predictor = nnUNetROIPredictor(...)
+        predictor.initialize_from_trained_model_folder(fullres_model_folder, use_folds)
+        lowres_predictor = nnUNetPredictor(...)
+        lowres_predictor.initialize_from_trained_model_folder(lowres_model_folder, use_folds)
+        predictor.set_lowres_predictor(lowres_predictor)
+        predictor.predict_from_files(...)
+
+    This is only faster than regular inference if the structures of interest are small relative to the image! If
+    the lowres model does not find any foreground we fall back to predicting the entire image with fullres.
+    """
+    lowres_predictor: nnUNetPredictor = None
+    roi_margin: int = 16
+
+    def set_lowres_predictor(self, lowres_predictor: nnUNetPredictor, roi_margin: int = 16):
+        """
+        lowres_predictor must already be initialized. roi_margin is given in voxels of the fullres configuration and
+        is added on each side of the bounding box of the lowres foreground.
+        """
+        assert self.configuration_manager is not None and lowres_predictor.configuration_manager is not None, \
+            'Both predictors must be initialized before calling set_lowres_predictor'
+        assert len(self.configuration_manager.patch_size) == 3 and \
+               len(lowres_predictor.configuration_manager.patch_size) == 3, \
+            'ROI inference is only supported for 3d configurations'
+        assert self.label_manager.num_segmentation_heads == lowres_predictor.label_manager.num_segmentation_heads, \
+            'lowres and fullres models must predict the same labels/regions'
+        assert self.configuration_manager.previous_stage_name is None, \
+            'ROI inference needs a regular 3d_fullres model, not a cascade model. The cascade requires the lowres ' \
+            'segmentation as input. Use nnUNetv2_predict with the cascade instead.'
+
+        # use the cascade metadata to check that the lowres model belongs to our fullres model
+        next_stage_names = lowres_predictor.configuration_manager.next_stage_names
+        if next_stage_names is None:
+            print(f'WARNING: the configuration of the lowres predictor has no next stage, it may not be a lowres '
+                  f'configuration!')
+        else:
+            next_stage_spacings = [lowres_predictor.plans_manager.get_configuration(i).spacing for i in
+                                   next_stage_names]
+            if not any([np.allclose(i, self.configuration_manager.spacing) for i in next_stage_spacings]):
+                print(f'WARNING: The spacing of the fullres configuration ({self.configuration_manager.spacing}) does '
+                      f'not match any of the next stages of the lowres configuration ({next_stage_names}). Are you '
+                      f'sure these models belong together?')
+        self.lowres_predictor = lowres_predictor
+        self.roi_margin = roi_margin
+
+    def _internal_get_model_fingerprint(self) -> str:
+        # ROI predictions differ from regular fullres predictions, they must not share cache or journal entries
+        h = hashlib.sha256(super()._internal_get_model_fingerprint().encode())
+        h.update(self.lowres_predictor._internal_get_model_fingerprint().encode())
+        h.update(f'roi_margin: {self.roi_margin}'.encode())
+        return h.hexdigest()
+
+    @torch.inference_mode()
+    def get_roi_from_lowres_prediction(self, data: torch.Tensor) -> Union[List[List[int]], None]:
+        """
+        data is preprocessed for the fullres configuration. Returns the ROI bounding box in fullres voxel coordinates
+        ([[x_min, x_max], [y_min, y_max], [z_min, z_max]], max is exclusive) or None if the lowres model did not
+        predict any foreground.
+        """
+        lowres_data = resample_preprocessed_data_to_configuration(data, self, self.lowres_predictor)
+        if self.verbose:
+            print(f'running lowres prediction on shape {lowres_data.shape}')
+        lowres_logits = self.lowres_predictor.predict_logits_from_preprocessed_data(lowres_data)
+        lowres_segmentation = self.lowres_predictor.label_manager.convert_logits_to_segmentation(lowres_logits)
+        del lowres_logits, lowres_data
+
+        foreground_coords = torch.nonzero(lowres_segmentation)
+        if foreground_coords.shape[0] == 0:
+            return None
+        lowres_min = foreground_coords.min(0).values.cpu().numpy()
+        lowres_max = foreground_coords.max(0).values.cpu().numpy() + 1
+
+        scale = np.array(data.shape[1:]) / np.array(lowres_segmentation.shape)
+        bbox = [[max(0, int(np.floor(mi * s)) - self.roi_margin), min(sh, int(np.ceil(ma * s)) + self.roi_margin)]
+                for mi, ma, s, sh in zip(lowres_min, lowres_max, scale, data.shape[1:])]
+        return bbox
+
+    @torch.inference_mode()
+    def predict_logits_from_preprocessed_data(self, data: torch.Tensor) -> torch.Tensor:
+        assert self.lowres_predictor is not None, 'Call set_lowres_predictor first'
+        bbox = self.get_roi_from_lowres_prediction(data)
+        if bbox is None:
+            print('lowres model did not predict any foreground, predicting the entire image with the fullres model')
+            return super().predict_logits_from_preprocessed_data(data)
+
+        roi_slicer = tuple([slice(None), *[slice(i, j) for i, j in bbox]])
+        print(f'ROI inference: predicting region {bbox} (shape {[j - i for i, j in bbox]}) of image with shape '
+              f'{list(data.shape[1:])}')
+        roi_prediction = super().predict_logits_from_preprocessed_data(data[roi_slicer])
+
+        # if the ROI prediction went out-of-core, the full image prediction must as well
+        roi_out_of_core = self.out_of_core_arrays.get_file(roi_prediction) is not None
+        if roi_out_of_core:
+            prediction = self.out_of_core_arrays.zeros((roi_prediction.shape[0], *data.shape[1:]), keep_file=True)
+        else:
+            prediction = torch.empty((roi_prediction.shape[0], *data.shape[1:]), dtype=roi_prediction.dtype,
+                                     device=roi_prediction.device)
+        prediction[:] = self._internal_get_background_logits(roi_prediction.dtype,
+                                                             roi_prediction.device)[:, None, None, None]
+        prediction[roi_slicer] = roi_prediction
+        if roi_out_of_core:
+            self.out_of_core_arrays.release(roi_prediction)
+        return prediction
+
+
+def predict_entry_point_roi():
+    parser = argparse.ArgumentParser(description='Coarse-to-fine inference: the 3d_lowres model localizes the '
+                                                 'foreground, 3d_fullres is then only run within that region.')
+    parser.add_argument('-i', type=str, required=True,
+                        help='input folder. Remember to use the correct channel numberings for your files (_0000 etc). '
+                             'File endings must be the same as the training dataset!')
+    parser.add_argument('-o', type=str, required=True,
+                        help='Output folder. If it does not exist it will be created.')
+    parser.add_argument('-d', type=str, required=True,
+                        help='Dataset with which you would like to predict. You can specify either dataset name or id')
+    parser.add_argument('-p', type=str, required=False, default='nnUNetPlans',
+                        help='Plans identifier. Default: nnUNetPlans')
+    parser.add_argument('-tr', type=str, required=False, default='nnUNetTrainer',
+                        help='What nnU-Net trainer class was used for training? Default: nnUNetTrainer')
+    parser.add_argument('-f', nargs='+', type=str, required=False, default=(0, 1, 2, 3, 4),
+                        help='Folds used for both lowres and fullres. Default: (0, 1, 2, 3, 4)')
+    parser.add_argument('-roi_margin', type=int, required=False, default=16,
+                        help='Margin (in fullres voxels) added around the lowres foreground bounding box. Default: 16')
+    parser.add_argument('-step_size', type=float, required=False, default=0.5,
+                        help='Step size for sliding window prediction. Default: 0.5')
+    parser.add_argument('--disable_tta', action='store_true', required=False, default=False,
+                        help='Set this flag to disable test time data augmentation in the form of mirroring.')
+    parser.add_argument('--save_probabilities', action='store_true',
+                        help='Set this to export predicted class "probabilities".')
+    parser.add_argument('--continue_prediction', action='store_true',
+                        help='Continue an aborted previous prediction (will not overwrite existing files)')
+    parser.add_argument('-chk', type=str, required=False, default='checkpoint_final.pth',
+                        help='Name of the checkpoint you want to use. Default: checkpoint_final.pth')
+    parser.add_argument('-npp', type=int, required=False, default=3,
+                        help='Number of processes used for preprocessing. Default: 3')
+    parser.add_argument('-nps', type=int, required=False, default=3,
+                        help='Number of processes used for segmentation export. Default: 3')
+    parser.add_argument('-device', type=str, default='cuda', required=False,
+                        help="Use this to set the device the inference should run with. Available options are 'cuda' "
+                             "(GPU), 'cpu' (CPU) and 'mps' (Apple M1/M2).")
+    args = parser.parse_args()
+    args.f = [i if i == 'all' else int(i) for i in args.f]
+
+    device = torch.device(args.device)
+    predictors: List[nnUNetPredictor] = []
+    for predictor_class, configuration in ((nnUNetROIPredictor, '3d_fullres'), (nnUNetPredictor, '3d_lowres')):
+        predictor = predictor_class(tile_step_size=args.step_size,
+                                    use_gaussian=True,
+                                    use_mirroring=not args.disable_tta,
+                                    perform_everything_on_device=True,
+                                    device=device,
+                                    verbose=False,
+                                    verbose_preprocessing=False,
+                                    allow_tqdm=True)
+        predictor.initialize_from_trained_model_folder(get_output_folder(args.d, args.tr, args.p, configuration),
+                                                       args.f, checkpoint_name=args.chk)
+        predictors.append(predictor)
+    fullres_predictor, lowres_predictor = predictors
+    fullres_predictor.set_lowres_predictor(lowres_predictor, args.roi_margin)
+    fullres_predictor.predict_from_files(args.i, args.o, save_probabilities=args.save_probabilities,
+                                         overwrite=not args.continue_prediction,
+                                         num_processes_preprocessing=args.npp,
+                                         num_processes_segmentation_export=args.nps)
+
+
+if __name__ == '__main__':
+    predict_entry_point_roi()
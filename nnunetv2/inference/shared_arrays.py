@@ -0,0 +1,226 @@
+import atexit
+import os
+import weakref
+from multiprocessing import shared_memory
+from multiprocessing.pool import AsyncResult
+from typing import Union, Tuple, List, Dict, Optional
+
+import numpy as np
+import torch
+
+from nnunetv2.utilities.helpers import get_crop_of_view
+
+
+# shared memory that could not be closed yet because this process still uses its buffer (see take_shared_array and
+# SharedMemoryArrays). Closing from within the finalizer of the array fails because the array still holds the buffer
+# at that point, so this is retried later
+_shared_memory_to_close: List[shared_memory.SharedMemory] = []
+
+
+def _close_unused_shared_memory():
+    for shm in list(_shared_memory_to_close):
+        try:
+            shm.close()
+            _shared_memory_to_close.remove(shm)
+        except BufferError:
+            pass
+
+
+atexit.register(_close_unused_shared_memory)
+
+
+class SharedArrayHandle(object):
+    """
+    Picklable reference to an array (or, if slicer is given, a crop of it) in shared memory. This is what gets sent to
+    worker processes instead of the array itself. Open it with open_shared_array.
+    """
+    def __init__(self, name: str, shape: Tuple[int, ...], dtype: str, slicer: Optional[Tuple[slice, ...]] = None):
+        self.name = name
+        self.shape = shape
+        self.dtype = dtype
+        self.slicer = slicer
+
+
+class SharedArray(object):
+    """
+    Owner side of an array in shared memory. The owner copies the array in, hands self.handle to its consumers (worker
+    processes) and registers their AsyncResults with add_consumer. Consumers only ever attach to and close the shared
+    memory. The owner unlinks it with release once all consumers are done (see release_finished_shared_arrays), so
+    the lifetime does not depend on the consumers succeeding.
+
+    If array is None, a zero initialized array of shape and dtype (np.dtype) is created instead of copying one in,
+    see SharedMemoryArrays.
+    """
+    def __init__(self, array: Union[np.ndarray, torch.Tensor, None],
+                 shape: Optional[Tuple[int, ...]] = None, dtype: Optional[np.dtype] = None):
+        if array is not None:
+            if isinstance(array, torch.Tensor):
+                dtype = torch.empty(0, dtype=array.dtype).numpy().dtype
+            else:
+                dtype = array.dtype
+            shape = tuple(array.shape)
+        nbytes = int(np.prod(shape, dtype=np.int64)) * np.dtype(dtype).itemsize
+        # new shared memory is zero initialized
+        self.shm = shared_memory.SharedMemory(create=True, size=max(1, nbytes))
+        if array is not None:
+            target = np.ndarray(shape, dtype=dtype, buffer=self.shm.buf)
+            if isinstance(array, torch.Tensor):
+                # copies straight from the device if array is not on the CPU
+                torch.from_numpy(target).copy_(array)
+            else:
+                np.copyto(target, array)
+            del target
+        self.handle = SharedArrayHandle(self.shm.name, shape, np.dtype(dtype).str)
+        self.consumers: List[AsyncResult] = []
+
+    def add_consumer(self, async_result: AsyncResult):
+        self.consumers.append(async_result)
+
+    def consumers_done(self) -> bool:
+        return all([i.ready() for i in self.consumers])
+
+    def transfer(self) -> SharedArrayHandle:
+        """
+        Hands ownership over to whoever receives the returned handle, for example another process. The receiver must
+        call take_shared_array (or discard_shared_array). Only closes our own mapping.
+        """
+        handle = self.handle
+        self._close()
+        return handle
+
+    def release(self):
+        if self.shm is not None:
+            self.shm.unlink()
+            self._close()
+        _close_unused_shared_memory()
+
+    def _close(self):
+        try:
+            self.shm.close()
+        except BufferError:
+            # still used in this process (see SharedMemoryArrays)
+            _shared_memory_to_close.append(self.shm)
+        self.shm = None
+
+
+class SharedMemoryArrays(object):
+    """
+    Creates torch tensors in shared memory, so that a prediction can be handed to the export workers without copying
+    it (see take). Just like OutOfCoreArrays, tensors are registered by their storage. Tensors that are never taken
+    free their shared memory once they (and all of their views) are garbage collected.
+    """
+    def __init__(self):
+        self._arrays: Dict[int, SharedArray] = {}
+
+    def zeros(self, shape: Tuple[int, ...], dtype: torch.dtype = torch.half) -> torch.Tensor:
+        _close_unused_shared_memory()
+        np_dtype = torch.empty(0, dtype=dtype).numpy().dtype
+        shared_array = SharedArray(None, tuple(shape), np_dtype)
+        array = np.ndarray(tuple(shape), dtype=np_dtype, buffer=shared_array.shm.buf)
+        tensor = torch.from_numpy(array)
+        data_ptr = tensor.untyped_storage().data_ptr()
+        self._arrays[data_ptr] = shared_array
+        # array lives as long as the tensor or any view of it
+        weakref.finalize(array, self._release_if_registered, data_ptr, shared_array)
+        return tensor
+
+    def take(self, tensor: torch.Tensor) -> Union[Tuple[SharedArrayHandle, SharedArray], None]:
+        """
+        Hands the shared memory of tensor over. tensor may be a crop of a registered array (like the removal of the
+        sliding window padding), the returned handle then only covers the crop. The returned SharedArray must be
+        released by the caller once its consumers are done. Returns None if tensor is not in shared memory.
+        """
+        shared_array = self._arrays.pop(tensor.untyped_storage().data_ptr(), None)
+        if shared_array is None:
+            return None
+        h = shared_array.handle
+        shared_array.handle = SharedArrayHandle(h.name, h.shape, h.dtype, get_crop_of_view(tensor, h.shape))
+        return shared_array.handle, shared_array
+
+    def _release_if_registered(self, data_ptr: int, shared_array: SharedArray):
+        # the array was garbage collected without being taken
+        if self._arrays.get(data_ptr) is shared_array:
+            del self._arrays[data_ptr]
+            shared_array.release()
+
+
+def shared_array_nbytes(array: Union[np.ndarray, torch.Tensor]) -> int:
+    if isinstance(array, torch.Tensor):
+        return array.numel() * array.element_size()
+    return array.nbytes
+
+
+def shared_memory_available(nbytes: int) -> bool:
+    """
+    Shared memory lives in /dev/shm on Linux, which can be small (64 MB in docker containers by default). Writing
+    beyond its capacity kills the process with SIGBUS instead of raising an error, so we need to check first.
+    """
+    if not os.path.isdir('/dev/shm'):
+        # macOS and others don't have /dev/shm, shared memory is backed by regular memory there
+        return True
+    st = os.statvfs('/dev/shm')
+    return st.f_bavail * st.f_frsize > 1.1 * nbytes
+
+
+def open_shared_array(handle: SharedArrayHandle) -> Tuple[shared_memory.SharedMemory, np.ndarray]:
+    """
+    Consumer side. Attach to the shared memory of handle and return it together with the array. Call
+    close_shared_array with the returned shared memory when done. Never unlink, that is the owner's job!
+    """
+    shm = shared_memory.SharedMemory(name=handle.name)
+    array = np.ndarray(handle.shape, dtype=np.dtype(handle.dtype), buffer=shm.buf)
+    return shm, array[handle.slicer] if handle.slicer is not None else array
+
+
+def close_shared_array(shm: shared_memory.SharedMemory):
+    try:
+        shm.close()
+    except BufferError:
+        # something still references the buffer. The mapping goes away with the last reference (or the process)
+        pass
+
+
+def take_shared_array(handle: SharedArrayHandle, pin_memory: bool = False) -> torch.Tensor:
+    """
+    Receiver side of SharedArray.transfer: returns a torch tensor that uses the shared memory directly, without a
+    copy. The name is unlinked right away, the memory itself is freed once the tensor (and all of its views) is gone.
+    Pinned memory cannot be shared, so if pin_memory the array is copied into a pinned tensor instead.
+    """
+    _close_unused_shared_memory()
+    shm, array = open_shared_array(handle)
+    shm.unlink()
+    if pin_memory:
+        tensor = torch.empty(array.shape, dtype=torch.from_numpy(array).dtype, pin_memory=True)
+        tensor.copy_(torch.from_numpy(array))
+        del array
+        close_shared_array(shm)
+        return tensor
+    # keeps shm alive until array is gone
+    weakref.finalize(array, _shared_memory_to_close.append, shm)
+    return torch.from_numpy(array)
+
+
+def discard_shared_array(handle: SharedArrayHandle):
+    """
+    Unlinks a transferred shared array without reading it
+    """
+    try:
+        shm = shared_memory.SharedMemory(name=handle.name)
+    except FileNotFoundError:
+        # already gone
+        return
+    shm.close()
+    shm.unlink()
+
+
+def release_finished_shared_arrays(shared_arrays: List[SharedArray]) -> List[SharedArray]:
+    """
+    Releases all shared arrays whose consumers are done and returns the ones that are still in use
+    """
+    still_in_use = []
+    for s in shared_arrays:
+        if s.consumers_done():
+            s.release()
+        else:
+            still_in_use.append(s)
+    return still_in_use
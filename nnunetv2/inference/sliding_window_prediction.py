@@ -4,7 +4,7 @@ import numpy as np
 import torch
 from typing import Union, Tuple, List
 from acvl_utils.cropping_and_padding.padding import pad_nd_image
-from scipy.ndimage import gaussian_filter
+from scipy.ndimage import gaussian_filter, gaussian_filter1d
 
 
 @lru_cache(maxsize=2)
@@ -54,6 +54,39 @@ def compute_steps_for_sliding_window(image_size: Tuple[int, ...], tile_size: Tup
     return steps
 
 
+@lru_cache(maxsize=2)
+def compute_normalized_tile_weights(image_size: Tuple[int, ...], tile_size: Tuple[int, ...], tile_step_size: float,
+                                    use_gaussian: bool = True, sigma_scale: float = 1. / 8,
+                                    device=torch.device('cuda', 0)) -> Tuple[dict, ...]:
+    """
+    The Gaussian importance map of compute_gaussian is separable (gaussian_filter filters each axis independently),
+    so the sum of the weights of all sliding window tiles is separable as well: along each axis it is the sum of the
+    1d weights over all steps along that axis. Dividing the 1d weights of each step by this per-axis sum gives tile
+    weights that add up to exactly 1 at every voxel, so we neither need to accumulate the weights in a full-size
+    volume nor divide by them at the end.
+
+    Returns one dict per axis that maps the start coordinate of each step to its normalized 1d weights (float32,
+    length tile_size[axis]). The weights of a tile are the outer product of the 1d weights of its steps.
+    """
+    steps = compute_steps_for_sliding_window(image_size, tile_size, tile_step_size)
+    weights = []
+    for steps_here, image_len, tile_len in zip(steps, image_size, tile_size):
+        if use_gaussian:
+            tmp = np.zeros(tile_len)
+            tmp[tile_len // 2] = 1
+            weights_1d = gaussian_filter1d(tmp, tile_len * sigma_scale, mode='constant', cval=0)
+            weights_1d /= np.max(weights_1d)
+        else:
+            weights_1d = np.ones(tile_len)
+        weight_sum = np.zeros(image_len)
+        for st in steps_here:
+            weight_sum[st:st + tile_len] += weights_1d
+        weights.append({st: torch.from_numpy(weights_1d / weight_sum[st:st + tile_len]).to(device=device,
+                                                                                           dtype=torch.float32)
+                        for st in steps_here})
+    return tuple(weights)
+
+
 if __name__ == '__main__':
     a = torch.rand((4, 2, 32, 23))
     a_npy = a.numpy()
@@ -0,0 +1,46 @@
+from typing import List, Tuple, Callable, Union
+
+
+def build_default_quality_ladder(num_folds: int, mirror_axes: Union[Tuple[int, ...], None],
+                                 tile_step_size: float) -> List[dict]:
+    """
+    The quality ladder used by nnUNetPredictor if a time_budget_s is set and no quality_ladder is given. Each rung is
+    a dict with 'num_folds', 'mirror_axes' and 'tile_step_size'. The first rung are the settings the predictor was
+    configured with. Every following rung makes one more cut, in this order:
+    1) mirror axes (test time augmentation) are dropped one at a time, starting with the last one. Each axis halves
+       the number of forward passes per tile, and mirroring is the cheapest source of accuracy to give up
+    2) tile_step_size is increased to 0.75 (fewer, less overlapping tiles)
+    3) the number of folds is halved until a single fold is left (the first folds are kept)
+    4) tile_step_size is increased to 1 (no overlap between tiles)
+    Cuts are cumulative, so the last rung is the cheapest setting: one fold, no mirroring, step size 1.
+    """
+    mirror_axes = tuple(mirror_axes) if mirror_axes is not None else ()
+    rung = {'num_folds': num_folds, 'mirror_axes': mirror_axes, 'tile_step_size': tile_step_size}
+    ladder = [rung]
+    while len(rung['mirror_axes']) > 0:
+        rung = {**rung, 'mirror_axes': rung['mirror_axes'][:-1]}
+        ladder.append(rung)
+    if rung['tile_step_size'] < 0.75:
+        rung = {**rung, 'tile_step_size': 0.75}
+        ladder.append(rung)
+    while rung['num_folds'] > 1:
+        rung = {**rung, 'num_folds': rung['num_folds'] // 2}
+        ladder.append(rung)
+    if rung['tile_step_size'] < 1:
+        rung = {**rung, 'tile_step_size': 1}
+        ladder.append(rung)
+    return ladder
+
+
+def choose_rung(quality_ladder: List[dict], estimate_time_s: Callable[[dict], float], time_budget_s: float) \
+        -> Tuple[int, float]:
+    """
+    Returns the index of the first (best) rung of quality_ladder whose estimated time fits into time_budget_s,
+    together with that estimate. If none fits, the last (cheapest) rung is returned.
+    """
+    estimate = None
+    for i, rung in enumerate(quality_ladder):
+        estimate = estimate_time_s(rung)
+        if estimate <= time_budget_s:
+            return i, estimate
+    return len(quality_ladder) - 1, estimate
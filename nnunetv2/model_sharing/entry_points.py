@@ -54,8 +54,15 @@ def export_pretrained_model_entry():
                         help='Lis tof checkpoint names to export. Default: checkpoint_final.pth')
     parser.add_argument('--not_strict', action='store_false', default=False, required=False, help='Set this to allow missing folds and/or configurations')
     parser.add_argument('--exp_cv_preds', action='store_true', required=False, help='Set this to export the cross-validation predictions as well')
+    parser.add_argument('--inference_checkpoints', action='store_true', required=False,
+                        help='Also export weights-only inference checkpoints (checkpoint_final_inference.pth), which '
+                             'load much faster. They are created from the checkpoints if necessary')
+    parser.add_argument('--inference_fp16', action='store_true', required=False,
+                        help='Store the weights of the inference checkpoints in fp16 (half the size)')
     args = parser.parse_args()
 
     export_pretrained_model(dataset_name_or_id=args.d, output_file=args.o, configurations=args.c, trainer=args.tr,
                             plans_identifier=args.p, folds=args.f, strict=not args.not_strict, save_checkpoints=args.chk,
-                            export_crossval_predictions=args.exp_cv_preds)
+                            export_crossval_predictions=args.exp_cv_preds,
+                            export_inference_checkpoints=args.inference_checkpoints,
+                            inference_checkpoints_fp16=args.inference_fp16)
@@ -1,5 +1,7 @@
 import zipfile
 
+from nnunetv2.inference.inference_checkpoint import get_inference_checkpoint_name, inference_checkpoint_is_current, \
+    inference_checkpoint_to_bytes
 from nnunetv2.utilities.file_path_utilities import *
 
 
@@ -10,7 +12,15 @@ def export_pretrained_model(dataset_name_or_id: Union[int, str], output_file: st
                             folds: Tuple[int, ...] = (0, 1, 2, 3, 4),
                             strict: bool = True,
                             save_checkpoints: Tuple[str, ...] = ('checkpoint_final.pth',),
-                            export_crossval_predictions: bool = False) -> None:
+                            export_crossval_predictions: bool = False,
+                            export_inference_checkpoints: bool = False,
+                            inference_checkpoints_fp16: bool = False) -> None:
+    """
+    export_inference_checkpoints: also add the weights-only inference checkpoint of each exported checkpoint
+    (checkpoint_final.pth -> checkpoint_final_inference.pth, optionally with fp16 weights). They are created from the
+    training checkpoints if they do not exist yet, are outdated or if fp16 weights are requested. See
+    nnunetv2.inference.inference_checkpoint.
+    """
     dataset_name = maybe_convert_to_dataset_name(dataset_name_or_id)
     with(zipfile.ZipFile(output_file, 'w', zipfile.ZIP_DEFLATED)) as zipf:
         for c in configurations:
@@ -40,6 +50,13 @@ def export_pretrained_model(dataset_name_or_id: Union[int, str], output_file: st
                 for chk in save_checkpoints:
                     source_file = join(trainer_output_dir, fold_folder, chk)
                     zipf.write(source_file, os.path.relpath(source_file, nnUNet_results))
+                    if export_inference_checkpoints:
+                        inference_file = get_inference_checkpoint_name(source_file)
+                        if inference_checkpoint_is_current(source_file) and not inference_checkpoints_fp16:
+                            zipf.write(inference_file, os.path.relpath(inference_file, nnUNet_results))
+                        else:
+                            zipf.writestr(os.path.relpath(inference_file, nnUNet_results),
+                                          inference_checkpoint_to_bytes(source_file, inference_checkpoints_fp16))
 
                 # progress.png
                 source_file = join(trainer_output_dir, fold_folder, "progress.png")
@@ -53,7 +70,8 @@ def export_pretrained_model(dataset_name_or_id: Union[int, str], output_file: st
                 # validation folder with all predicted segmentations etc
                 if export_crossval_predictions:
                     source_folder = join(trainer_output_dir, fold_folder, "validation")
-                    files = [i for i in subfiles(source_folder, join=False) if not i.endswith('.npz') and not i.endswith('.pkl')]
+                    files = [i for i in subfiles(source_folder, join=False) if not i.endswith('.npz') and
+                             not i.endswith('.b2nd') and not i.endswith('.pkl')]
                     for f in files:
                         zipf.write(join(source_folder, f), os.path.relpath(join(source_folder, f), nnUNet_results))
                 # just the summary.json file from the validation
@@ -0,0 +1,119 @@
+import os
+
+import numpy as np
+import torch
+from torch.nn import functional as F
+
+from nnunetv2.inference.predict_from_raw_data import nnUNetPredictor
+from nnunetv2.utilities.label_handling.label_handling import LabelManager
+
+
+def make_network(dim: int = 3, kernel_size: int = 3, seed: int = 0) -> torch.nn.Module:
+    """
+    Small random network with three output channels. With kernel_size=1 it has no spatial context.
+    """
+    torch.manual_seed(seed)
+    conv = torch.nn.Conv3d if dim == 3 else torch.nn.Conv2d
+    return torch.nn.Sequential(conv(1, 4, kernel_size, padding=kernel_size // 2), torch.nn.LeakyReLU(),
+                               conv(4, 3, 1))
+
+
+def resample_nearest(data, new_shape, current_spacing, new_spacing) -> np.ndarray:
+    """
+    Stand-in for the resampling functions of the configuration
+    """
+    return F.interpolate(torch.as_tensor(data)[None].float(), size=tuple(new_shape), mode='nearest')[0].numpy()
+
+
+class StubPreprocessor(object):
+    """
+    Stand-in for the preprocessor of the configuration. Images are used as they are. Files are not read, their image
+    (shape (1, 2, 2, 2)) is filled with the number in the name of the first file.
+    """
+    def __init__(self, verbose: bool = False):
+        pass
+
+    @staticmethod
+    def run_case_npy(data, seg, properties, plans_manager, configuration_manager, dataset_json):
+        shape = tuple(data.shape[1:])
+        properties = {**properties, 'spacing': [1.] * len(shape), 'shape_before_cropping': shape,
+                      'shape_after_cropping_and_before_resampling': shape,
+                      'bbox_used_for_cropping': [[0, i] for i in shape]}
+        return data.astype(np.float32), seg, properties
+
+    def run_case(self, image_files, seg_file, plans_manager, configuration_manager, dataset_json):
+        data = np.full((1, 2, 2, 2), int(os.path.basename(image_files[0])), dtype=np.float32)
+        return self.run_case_npy(data, None, {'case': image_files[0]}, plans_manager, configuration_manager,
+                                 dataset_json)
+
+
+class StubReaderWriter(object):
+    @staticmethod
+    def write_seg(seg: np.ndarray, output_fname: str, properties: dict):
+        np.save(output_fname, seg)
+
+
+class StubPlansManager(object):
+    """
+    Stand-in for PlansManager. Like everything here it can be sent to worker processes
+    """
+    plans = {'plans_name': 'nnUNetPlans'}
+    transpose_forward = [0, 1, 2]
+    transpose_backward = [0, 1, 2]
+    image_reader_writer_class = StubReaderWriter
+
+    @staticmethod
+    def get_label_manager(dataset_json: dict) -> LabelManager:
+        return LabelManager(dataset_json['labels'], None)
+
+
+class StubConfigurationManager(object):
+    """
+    Stand-in for ConfigurationManager. Resampling is nearest neighbor
+    """
+    preprocessor_class = StubPreprocessor
+    previous_stage_name = None
+    next_stage_names = None
+
+    def __init__(self, patch_size=(16, 16, 16), spacing=None):
+        self.patch_size = list(patch_size)
+        self.configuration = {'patch_size': list(patch_size)}
+        self.pool_op_kernel_sizes = [[1] * len(patch_size), [2] * len(patch_size), [2] * len(patch_size)]
+        self.spacing = list(spacing) if spacing is not None else [1.] * len(patch_size)
+        self.resampling_fn_data = resample_nearest
+        self.resampling_fn_probabilities = resample_nearest
+
+
+def make_dataset_json() -> dict:
+    return {'labels': {'background': 0, 'a': 1, 'b': 2}, 'channel_names': {'0': 'CT'}, 'file_ending': '.npy'}
+
+
+def make_predictor(patch_size=(16, 16, 16), network: torch.nn.Module = None, predictor_class=nnUNetPredictor,
+                   seed: int = 0, spacing=None, **kwargs) -> nnUNetPredictor:
+    """
+    nnUNetPredictor (or predictor_class) on the CPU that can run the sliding window without a trained model folder.
+    The plans and configuration managers are replaced with stand-ins that have just what the predictor needs. If no
+    network is given, make_network(seed=seed) is used. spacing defaults to 1 along all axes. kwargs are passed to the
+    predictor.
+    """
+    predictor = predictor_class(device=torch.device('cpu'), allow_tqdm=False, **kwargs)
+    dataset_json = make_dataset_json()
+    predictor.plans_manager = StubPlansManager()
+    predictor.configuration_manager = StubConfigurationManager(patch_size, spacing)
+    label_manager = predictor.plans_manager.get_label_manager(dataset_json)
+    predictor.dataset_json = dataset_json
+    predictor.label_manager = label_manager
+    predictor.trainer_name = 'nnUNetTrainer'
+    predictor.allowed_mirroring_axes = tuple(range(len(patch_size)))
+    predictor.network = network if network is not None else make_network(len(patch_size), seed=seed)
+    predictor.list_of_parameters = [predictor.network.state_dict()]
+    return predictor
+
+
+def predict(predictor: nnUNetPredictor, data: torch.Tensor) -> torch.Tensor:
+    return predictor.predict_sliding_window_return_logits(data).float()
+
+
+def random_image(shape=(1, 40, 36, 28), seed: int = 1) -> torch.Tensor:
+    torch.manual_seed(seed)
+    return torch.rand(shape)
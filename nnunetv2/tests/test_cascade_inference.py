@@ -0,0 +1,49 @@
+import torch
+from torch.nn import functional as F
+
+from nnunetv2.inference.cascade_inference import nnUNetCascadePredictor
+from nnunetv2.tests.predictor_stubs import make_predictor, random_image
+
+
+def _make_cascade():
+    torch.manual_seed(0)
+    # image + one channel per foreground label
+    network = torch.nn.Sequential(torch.nn.Conv3d(3, 4, 3, padding=1), torch.nn.LeakyReLU(), torch.nn.Conv3d(4, 3, 1))
+    cascade = make_predictor(predictor_class=nnUNetCascadePredictor, network=network, use_mirroring=False)
+    cascade.configuration_manager.previous_stage_name = '3d_lowres'
+    lowres = make_predictor(spacing=(2, 2, 2), use_mirroring=False)
+
+    def lowres_logits(data: torch.Tensor) -> torch.Tensor:
+        # label (x // 3) % 3, so that the one-hot channels are easy to tell apart
+        labels = (torch.arange(data.shape[1]) // 3 % 3).view(-1, 1, 1).expand(data.shape[1:])
+        return F.one_hot(labels, 3).permute(3, 0, 1, 2).half()
+
+    lowres.predict_logits_from_preprocessed_data = lowres_logits
+    cascade.set_lowres_predictor(lowres, check_previous_stage=False)
+    return cascade
+
+
+def test_previous_stage_is_not_required_as_input():
+    cascade = _make_cascade()
+    assert not cascade._internal_requires_segs_from_prev_stage()
+    # the regular predictor needs the segmentations of the previous stage for the same configuration
+    regular = make_predictor()
+    regular.configuration_manager = cascade.configuration_manager
+    assert regular._internal_requires_segs_from_prev_stage()
+
+
+def test_previous_stage_is_one_hot_encoded_on_the_fullres_grid():
+    cascade = _make_cascade()
+    data = random_image((1, 36, 20, 16))
+    stacked = cascade.add_previous_stage_prediction(data)
+    assert stacked.shape == (3, *data.shape[1:])
+    assert torch.equal(stacked[0], data[0])
+    # lowres has half the resolution, each lowres voxel covers two fullres voxels along x
+    expected_labels = (torch.arange(data.shape[1]) // 2 // 3 % 3).view(-1, 1, 1).expand(data.shape[1:])
+    assert cascade.label_manager.foreground_labels == [1, 2]
+    for i, label in enumerate(cascade.label_manager.foreground_labels):
+        assert torch.equal(stacked[1 + i], (expected_labels == label).float())
+
+    # the image alone is extended with the previous stage, data that already has it is used as is
+    prediction = cascade.predict_logits_from_preprocessed_data(data)
+    assert torch.equal(prediction, cascade.predict_logits_from_preprocessed_data(stacked))
@@ -0,0 +1,48 @@
+import torch
+from torch import nn
+
+from nnunetv2.inference.cpu_engine import CPUInferenceEngine
+from nnunetv2.tests.predictor_stubs import make_network, make_predictor, predict, random_image
+
+
+def _make_network() -> nn.Module:
+    torch.manual_seed(0)
+    return nn.Sequential(nn.Conv3d(2, 8, 3, padding=1), nn.InstanceNorm3d(8, affine=True), nn.LeakyReLU(),
+                         nn.Conv3d(8, 3, 1)).eval()
+
+
+def test_fp32_graph_matches_eager():
+    network = _make_network()
+    engine = CPUInferenceEngine(network, 'fp32')
+    torch.manual_seed(1)
+    # the first batch selects the variant, 3 is zero padded to a graph for 4
+    for batch_size in (4, 4, 3):
+        x = torch.rand((batch_size, 2, 8, 12, 10))
+        with torch.no_grad():
+            reference = network(x)
+        prediction = engine(x)
+        assert engine.variant == 'fp32'
+        assert prediction.shape == reference.shape
+        assert torch.allclose(prediction, reference, atol=1e-4, rtol=1e-4)
+    assert [k[1][0] for k in engine.graphs.keys()] == [4]
+
+
+def test_failing_gate_falls_back_to_eager():
+    network = _make_network()
+    # no variant can pass a negative tolerance
+    engine = CPUInferenceEngine(network, 'fp32', tolerance=-1)
+    x = torch.rand((3, 2, 8, 12, 10))
+    with torch.no_grad():
+        reference = network(x)
+    assert torch.equal(engine(x), reference)
+    assert engine.variant == 'eager'
+    assert len(engine.graphs) == 0
+    assert torch.equal(engine(x), reference)
+
+
+def test_predictor_with_cpu_engine_matches_eager():
+    data = random_image((1, 24, 20, 16))
+    reference = predict(make_predictor(use_mirroring=False, tile_batch_size=3), data)
+    predictor = make_predictor(use_mirroring=False, tile_batch_size=3, cpu_engine='fp32')
+    predictor.list_of_parameters = [make_network().state_dict()]
+    assert torch.allclose(predict(predictor, data), reference, atol=1e-3, rtol=1e-3)
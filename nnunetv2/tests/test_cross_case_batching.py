@@ -0,0 +1,48 @@
+import torch
+
+from nnunetv2.inference.cross_case_batching import CrossCaseTileBatcher
+from nnunetv2.inference.roi_inference import nnUNetROIPredictor
+from nnunetv2.tests.predictor_stubs import make_network, make_predictor, random_image
+
+
+def _make_predictor(**kwargs):
+    predictor = make_predictor(use_mirroring=False, tile_batch_size=8, cross_case_batching=True, **kwargs)
+    predictor.list_of_parameters = [make_network(seed=i).state_dict() for i in range(2)]
+    predictor._internal_build_fold_networks(predictor.network)
+    return predictor
+
+
+def test_cross_case_batching_matches_per_case_prediction():
+    predictor = _make_predictor(resident_fold_networks=True)
+    # one case smaller than the patch size (padded), the others with a few tiles each
+    cases = [random_image(shape, seed=i) for i, shape in
+             enumerate([(1, 12, 16, 16), (1, 20, 16, 16), (1, 16, 24, 20), (1, 16, 16, 16), (1, 16, 16, 30)])]
+    references = [predictor.predict_logits_from_preprocessed_data(c) for c in cases]
+
+    batcher = predictor._internal_get_cross_case_batcher()
+    assert isinstance(batcher, CrossCaseTileBatcher)
+    finished = []
+    for i, c in enumerate(cases):
+        assert batcher.accepts(c)
+        finished += batcher.add_case(c, i)
+    # the first batch of 8 tiles completes some of the cases before the rest is flushed
+    assert 0 < len(finished) < len(cases)
+    finished += batcher.flush()
+    assert sorted([i for _, i in finished]) == list(range(len(cases)))
+    for prediction, i in finished:
+        assert prediction.shape == references[i].shape
+        assert torch.allclose(prediction.float(), references[i].float(), atol=1e-3, rtol=1e-3)
+
+
+def test_cross_case_batching_is_not_used_where_it_does_not_apply():
+    # several folds that are not resident would have to be loaded for every batch
+    assert _make_predictor()._internal_get_cross_case_batcher() is None
+    # pooled tiles would skip what predict_logits_from_preprocessed_data is overridden for
+    assert _make_predictor(resident_fold_networks=True,
+                           predictor_class=nnUNetROIPredictor)._internal_get_cross_case_batcher() is None
+    # the time budget applies to each case
+    assert _make_predictor(resident_fold_networks=True, time_budget_s=10)._internal_get_cross_case_batcher() is None
+    # nothing to pool with a tile batch size of 1
+    predictor = _make_predictor(resident_fold_networks=True)
+    predictor.tile_batch_size = 1
+    assert predictor._internal_get_cross_case_batcher() is None
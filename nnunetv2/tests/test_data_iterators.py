@@ -0,0 +1,50 @@
+import gc
+import os
+from threading import Thread
+from time import sleep
+
+import pytest
+from batchgenerators.utilities.file_and_folder_operations import join
+
+from nnunetv2.inference.data_iterators import preprocessing_iterator_fromfiles
+from nnunetv2.inference.prediction_journal import PredictionJournal
+from nnunetv2.tests.predictor_stubs import StubConfigurationManager, StubPlansManager, make_dataset_json
+
+
+def test_cases_claimed_by_others_are_skipped(tmp_path):
+    folder = join(str(tmp_path), 'journal')
+    cases = [str(i) for i in range(6)]
+    # another part has all cases of our first worker ([0::2]), so its share is unbalanced with the second one
+    other_part = PredictionJournal(folder, part_id=1)
+    for c in cases[0::2]:
+        assert other_part.claim(c)
+
+    yielded = []
+
+    def consume():
+        for item in preprocessing_iterator_fromfiles([[c] for c in cases], None, cases, StubPlansManager(),
+                                                     make_dataset_json(), StubConfigurationManager(),
+                                                     2, journal=PredictionJournal(folder, part_id=0)):
+            assert item['data'].flatten()[0] == int(item['ofile'])
+            yielded.append(item['ofile'])
+
+    t = Thread(target=consume, daemon=True)
+    t.start()
+    t.join(120)
+    assert not t.is_alive(), 'the preprocessing iterator hangs'
+    assert yielded == cases[1::2]
+
+
+@pytest.mark.skipif(not os.path.isdir('/dev/shm'), reason='needs /dev/shm to check for leaked segments')
+def test_stopping_early_frees_queued_cases():
+    segments = set(os.listdir('/dev/shm'))
+    cases = [str(i) for i in range(6)]
+    iterator = preprocessing_iterator_fromfiles([[c] for c in cases], None, cases, StubPlansManager(),
+                                                make_dataset_json(), StubConfigurationManager(), 2)
+    item = next(iterator)
+    # give the workers time to fill their queues
+    sleep(2)
+    iterator.close()
+    del item
+    gc.collect()
+    assert set(os.listdir('/dev/shm')) == segments
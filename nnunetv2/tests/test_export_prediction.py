@@ -0,0 +1,30 @@
+from functools import partial
+
+import numpy as np
+import torch
+
+from nnunetv2.inference.export_prediction import resample_logits_and_convert_to_segmentation
+from nnunetv2.preprocessing.resampling.default_resampling import resample_data_or_seg_to_shape
+from nnunetv2.preprocessing.resampling.resample_torch import resample_torch_fornnunet
+from nnunetv2.utilities.label_handling.label_handling import LabelManager
+
+
+def test_channelwise_resampling_matches_resampling_all_channels():
+    rng = np.random.RandomState(0)
+    logits = rng.randn(3, 12, 14, 10).astype(np.float32)
+    label_managers = (LabelManager({'background': 0, 'a': 1, 'b': 2}, None),
+                      LabelManager({'background': 0, 'a': [1, 2], 'b': [2], 'c': [3]}, [1, 2, 3]))
+    resampling_fns = (partial(resample_data_or_seg_to_shape, is_seg=False, order=1, order_z=0, force_separate_z=None),
+                      partial(resample_torch_fornnunet, is_seg=False))
+    # with resampling and without (same shape and spacing)
+    shapes_and_spacings = (((20, 14, 15), [1., 1., 1.], [0.6, 1., 0.67]), ((12, 14, 10), [1., 1., 1.], [1., 1., 1.]))
+    for label_manager in label_managers:
+        for resampling_fn in resampling_fns:
+            for new_shape, current_spacing, new_spacing in shapes_and_spacings:
+                reference = label_manager.convert_logits_to_segmentation(
+                    resampling_fn(logits, new_shape, current_spacing, new_spacing))
+                if isinstance(reference, torch.Tensor):
+                    reference = reference.numpy()
+                segmentation = resample_logits_and_convert_to_segmentation(logits, label_manager, resampling_fn,
+                                                                           new_shape, current_spacing, new_spacing)
+                assert np.array_equal(segmentation, reference), (label_manager.has_regions, resampling_fn, new_shape)
@@ -0,0 +1,101 @@
+import io
+import os
+
+import torch
+from batchgenerators.utilities.file_and_folder_operations import join
+
+from nnunetv2.inference.inference_checkpoint import get_inference_checkpoint_name, inference_checkpoint_exists, \
+    inference_checkpoint_is_current, inference_checkpoint_to_bytes, load_checkpoint_for_inference, \
+    save_inference_checkpoint
+
+
+def _save_training_checkpoint(checkpoint_file: str, seed: int = 0) -> dict:
+    torch.manual_seed(seed)
+    network = torch.nn.Conv3d(1, 2, 3)
+    checkpoint = {
+        'network_weights': network.state_dict(),
+        'optimizer_state': torch.optim.SGD(network.parameters(), lr=0.01).state_dict(),
+        'logging': {'train_losses': [1., 0.5]},
+        'trainer_name': 'nnUNetTrainer',
+        'init_args': {'plans': {}, 'configuration': '3d_fullres', 'fold': 0},
+        'inference_allowed_mirroring_axes': (0, 1, 2),
+    }
+    torch.save(checkpoint, checkpoint_file)
+    return checkpoint
+
+
+def _assert_weights_equal(a: dict, b: dict):
+    assert a.keys() == b.keys()
+    for k in a.keys():
+        assert torch.equal(a[k], b[k]), k
+
+
+def test_round_trip(tmp_path):
+    checkpoint_file = join(str(tmp_path), 'checkpoint_final.pth')
+    checkpoint = _save_training_checkpoint(checkpoint_file)
+    assert get_inference_checkpoint_name(checkpoint_file) == join(str(tmp_path), 'checkpoint_final_inference.pth')
+    assert not inference_checkpoint_is_current(checkpoint_file)
+
+    inference_checkpoint_file = save_inference_checkpoint(checkpoint_file)
+    assert inference_checkpoint_file == get_inference_checkpoint_name(checkpoint_file)
+    assert inference_checkpoint_is_current(checkpoint_file)
+    inference_checkpoint = torch.load(inference_checkpoint_file, weights_only=True)
+    assert 'optimizer_state' not in inference_checkpoint.keys()
+    assert inference_checkpoint['source_checkpoint']['size'] == os.path.getsize(checkpoint_file)
+
+    loaded = load_checkpoint_for_inference(checkpoint_file)
+    _assert_weights_equal(loaded['network_weights'], checkpoint['network_weights'])
+    assert loaded['trainer_name'] == 'nnUNetTrainer'
+    assert loaded['init_args'] == {'configuration': '3d_fullres'}
+    assert loaded['inference_allowed_mirroring_axes'] == (0, 1, 2)
+
+    # without the training checkpoint, the inference checkpoint is used as is
+    os.remove(checkpoint_file)
+    assert inference_checkpoint_exists(checkpoint_file)
+    _assert_weights_equal(load_checkpoint_for_inference(checkpoint_file)['network_weights'],
+                          checkpoint['network_weights'])
+
+
+def test_fp16_and_bytes(tmp_path):
+    checkpoint_file = join(str(tmp_path), 'checkpoint_final.pth')
+    checkpoint = _save_training_checkpoint(checkpoint_file)
+    inference_checkpoint = torch.load(io.BytesIO(inference_checkpoint_to_bytes(checkpoint_file, fp16=True)),
+                                      weights_only=True)
+    for k, v in inference_checkpoint['network_weights'].items():
+        assert v.dtype == torch.float16
+        torch.testing.assert_close(v.float(), checkpoint['network_weights'][k], atol=1e-3, rtol=1e-3)
+
+
+def test_outdated_inference_checkpoint_is_ignored(tmp_path):
+    checkpoint_file = join(str(tmp_path), 'checkpoint_final.pth')
+    _save_training_checkpoint(checkpoint_file)
+    save_inference_checkpoint(checkpoint_file)
+
+    # same content with a different mtime (copied or unzipped) is fine
+    os.utime(checkpoint_file, (0, 0))
+    assert inference_checkpoint_is_current(checkpoint_file)
+
+    # the training checkpoint is replaced (same size, different weights)
+    retrained = _save_training_checkpoint(checkpoint_file, seed=1)
+    # the mtime (0) was recorded by the previous check, so it must differ here for the hash to be compared
+    os.utime(checkpoint_file, (1, 1))
+    assert not inference_checkpoint_is_current(checkpoint_file)
+    loaded = load_checkpoint_for_inference(checkpoint_file)
+    _assert_weights_equal(loaded['network_weights'], retrained['network_weights'])
+    assert 'optimizer_state' in loaded.keys()
+
+    save_inference_checkpoint(checkpoint_file)
+    assert inference_checkpoint_is_current(checkpoint_file)
+
+
+def test_mtime_is_updated_after_hash_match(tmp_path):
+    checkpoint_file = join(str(tmp_path), 'checkpoint_final.pth')
+    _save_training_checkpoint(checkpoint_file)
+    inference_checkpoint_file = save_inference_checkpoint(checkpoint_file)
+
+    # installing from a zip does not keep mtimes. The first load hashes and records the new mtime
+    os.utime(checkpoint_file, (0, 0))
+    load_checkpoint_for_inference(checkpoint_file)
+    source_checkpoint = torch.load(inference_checkpoint_file, weights_only=True)['source_checkpoint']
+    assert source_checkpoint['mtime_ns'] == os.stat(checkpoint_file).st_mtime_ns
+    assert inference_checkpoint_is_current(checkpoint_file)
@@ -0,0 +1,79 @@
+import multiprocessing
+import os
+from time import sleep, time
+
+import numpy as np
+import pytest
+import torch
+
+from nnunetv2.inference.inference_service import nnUNetInferenceService
+from nnunetv2.tests.predictor_stubs import make_predictor
+
+
+class _RecordingService(nnUNetInferenceService):
+    """
+    Records the order in which jobs are predicted
+    """
+    def __init__(self, *args, **kwargs):
+        self.predicted = []
+        super().__init__(*args, **kwargs)
+
+    def _set_job_status(self, job_id: str, status: str, error: str = None):
+        if status == 'predicting':
+            self.predicted.append(job_id)
+        super()._set_job_status(job_id, status, error)
+
+
+def _make_service() -> _RecordingService:
+    service = _RecordingService(torch.device('cpu'), 1, 1)
+    predictor = make_predictor(use_mirroring=False)
+    predictor.share_results = True
+    service.predictors['model'] = predictor
+    return service
+
+
+def _wait_for_status(service: nnUNetInferenceService, job_id: str, status: str, timeout: float = 60):
+    st = time()
+    while service.get_job(job_id)['status'] != status:
+        assert time() - st < timeout, f'job {job_id} did not reach status {status}'
+        sleep(0.05)
+
+
+def test_jobs_are_predicted_in_order_of_priority(tmp_path):
+    service = _make_service()
+    pool_processes = service.preprocessing_pool._pool + service.export_pool._pool
+    try:
+        # the worker takes the first job right away and is then held back until all other jobs are queued
+        with service._export_done:
+            service._num_pending_exports = service.max_pending_exports
+        first = service.submit('model', ['1'], os.path.join(str(tmp_path), 'first'), priority=5)
+        _wait_for_status(service, first, 'preprocessing')
+        jobs = {name: service.submit('model', [str(i + 2)], os.path.join(str(tmp_path), name), priority=priority)
+                for i, (name, priority) in enumerate([('p2', 2), ('p0_a', 0), ('p1', 1), ('p0_b', 0)])}
+        with service._export_done:
+            service._num_pending_exports = 0
+            service._export_done.notify_all()
+    finally:
+        service.shutdown()
+
+    assert service.predicted == [first, jobs['p0_a'], jobs['p0_b'], jobs['p1'], jobs['p2']]
+    jobs['first'] = first
+    for name, job_id in jobs.items():
+        assert service.get_job(job_id)['status'] == 'done', service.get_job(job_id)['error']
+        assert np.load(os.path.join(str(tmp_path), name + '.npy')).shape == (2, 2, 2)
+    # shutdown waits for all exports and ends the worker pools
+    assert not any([p.is_alive() for p in pool_processes])
+    assert not any([p in multiprocessing.active_children() for p in pool_processes])
+
+
+def test_invalid_priorities_are_rejected(tmp_path):
+    service = _make_service()
+    try:
+        for priority in (1.5, '1', None, True):
+            with pytest.raises(AssertionError):
+                service.submit('model', ['1'], os.path.join(str(tmp_path), 'case'), priority=priority)
+        with pytest.raises(AssertionError):
+            service.submit('unknown model', ['1'], os.path.join(str(tmp_path), 'case'))
+        assert len(service.jobs) == 0
+    finally:
+        service.shutdown()
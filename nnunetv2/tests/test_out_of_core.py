@@ -0,0 +1,51 @@
+import gc
+import os
+
+import numpy as np
+import torch
+
+from nnunetv2.inference.out_of_core import OutOfCoreArrays, load_out_of_core_array
+from nnunetv2.tests.predictor_stubs import make_network, make_predictor, random_image
+
+
+def test_out_of_core_matches_in_memory(tmp_path):
+    # the last axis is smaller than the patch size and gets padded
+    data = random_image((1, 40, 36, 12))
+    fold_parameters = [make_network(seed=i).state_dict() for i in range(2)]
+    reference_predictor = make_predictor(use_mirroring=False)
+    reference_predictor.list_of_parameters = fold_parameters
+    reference = reference_predictor.predict_logits_from_preprocessed_data(data).float()
+
+    predictor = make_predictor(use_mirroring=False, out_of_core_accumulation=True, out_of_core_folder=str(tmp_path))
+    predictor.list_of_parameters = fold_parameters
+    prediction = predictor.predict_logits_from_preprocessed_data(data)
+    assert predictor.out_of_core_arrays.get_file(prediction) is not None
+    assert torch.allclose(prediction.float(), reference, atol=1e-3, rtol=1e-3)
+    # the folds are summed up in the file the sliding window accumulated the first fold in. Nothing else is left
+    assert len(os.listdir(tmp_path)) == 1
+
+    # the export gets the accumulation file itself, cropped to the unpadded image
+    handle = predictor._internal_get_export_payload(prediction)
+    assert handle.fname == os.path.join(str(tmp_path), os.listdir(tmp_path)[0])
+    exported = load_out_of_core_array(handle)
+    assert exported.shape == tuple(reference.shape)
+    assert np.allclose(exported.astype(np.float32), reference.numpy(), atol=1e-3, rtol=1e-3)
+    del exported, prediction
+    gc.collect()
+    # it now belongs to the export, which removes it when done
+    assert os.path.isfile(handle.fname)
+    os.remove(handle.fname)
+
+
+def test_files_of_collected_arrays_are_removed(tmp_path):
+    arrays = OutOfCoreArrays(str(tmp_path))
+    kept = arrays.zeros((2, 4, 4), keep_file=True)
+    crop = kept[:, 1:3]
+    del kept
+    gc.collect()
+    # a view keeps the file alive
+    assert len(os.listdir(tmp_path)) == 1
+    assert arrays.get_handle(crop).slicer == (slice(0, 2), slice(1, 3), slice(0, 4))
+    del crop
+    gc.collect()
+    assert len(os.listdir(tmp_path)) == 0
@@ -0,0 +1,53 @@
+import numpy as np
+
+from nnunetv2.inference.buffer_pool import BufferPool
+from nnunetv2.tests.predictor_stubs import make_predictor, random_image
+
+
+def _make_cases():
+    # the first and the last image have the same shape, so the last one reuses buffers of the first
+    images = [random_image(shape, seed=i).numpy() for i, shape in
+              enumerate([(1, 20, 24, 18), (1, 16, 30, 20), (1, 20, 24, 18)])]
+    return images, [{} for _ in images]
+
+
+def test_in_process_matches_worker_processes():
+    predictor = make_predictor()
+    images, properties = _make_cases()
+    reference = predictor.predict_from_list_of_npy_arrays(images, None, properties, None, 1,
+                                                          save_probabilities=True, num_processes_segmentation_export=1)
+    results = predictor.predict_from_list_of_npy_arrays_in_process(images, None, properties, None, True)
+    assert len(results) == len(reference)
+    for (segmentation, probabilities), (ref_segmentation, ref_probabilities) in zip(results, reference):
+        assert np.array_equal(segmentation, ref_segmentation)
+        assert np.array_equal(probabilities, ref_probabilities)
+
+
+def test_calls_do_not_share_buffers():
+    predictor = make_predictor()
+    images, properties = _make_cases()
+    pools = []
+    allocate = predictor._internal_allocate_results_array
+
+    def recording_allocate(*args, **kwargs):
+        pools.append(predictor.buffer_pool)
+        return allocate(*args, **kwargs)
+
+    predictor._internal_allocate_results_array = recording_allocate
+    first = predictor.predict_from_list_of_npy_arrays_in_process(images, None, properties)
+    first_copy = [np.copy(i) for i in first]
+    num_allocations = len(pools)
+    assert predictor.buffer_pool is None
+    second = predictor.predict_from_list_of_npy_arrays_in_process(images, None, properties)
+    assert predictor.buffer_pool is None
+
+    # each call has a pool of its own that is not kept around
+    first_pools, second_pools = pools[:num_allocations], pools[num_allocations:]
+    assert all([isinstance(i, BufferPool) for i in pools])
+    assert len(set([id(i) for i in first_pools])) == 1 and len(set([id(i) for i in second_pools])) == 1
+    assert first_pools[0] is not second_pools[0]
+    assert len(first_pools[0]._free) == 0
+    # results of the first call are not touched by the second one
+    for a, b, c in zip(first, first_copy, second):
+        assert np.array_equal(a, b)
+        assert np.array_equal(a, c)
@@ -0,0 +1,88 @@
+import os
+
+from batchgenerators.utilities.file_and_folder_operations import join, isfile
+
+from nnunetv2.inference.prediction_cache import PredictionCache
+from nnunetv2.inference.roi_inference import nnUNetROIPredictor
+from nnunetv2.tests.predictor_stubs import make_predictor
+
+
+def _write(fname: str, content: bytes) -> str:
+    with open(fname, 'wb') as f:
+        f.write(content)
+    return fname
+
+
+def test_case_key_depends_on_file_contents_and_fingerprint(tmp_path):
+    f = _write(join(str(tmp_path), 'case_0000.nii.gz'), b'image')
+    key = PredictionCache.get_case_key([f], None, 'model')
+    assert key == PredictionCache.get_case_key([f], None, 'model')
+    assert key != PredictionCache.get_case_key([f], None, 'other model')
+    seg = _write(join(str(tmp_path), 'seg.nii.gz'), b'seg')
+    assert key != PredictionCache.get_case_key([f], seg, 'model')
+    _write(f, b'changed image')
+    assert key != PredictionCache.get_case_key([f], None, 'model')
+
+
+def test_store_and_restore_files(tmp_path):
+    cache = PredictionCache(join(str(tmp_path), 'cache'))
+    out_trunc = join(str(tmp_path), 'case')
+    _write(out_trunc + '.nii.gz', b'segmentation')
+    cache.store_files('key', out_trunc, '.nii.gz', False)
+    os.remove(out_trunc + '.nii.gz')
+
+    # probabilities were not stored, so they cannot be restored
+    assert not cache.restore_files('key', out_trunc, '.nii.gz', True)
+    assert not isfile(out_trunc + '.nii.gz')
+    assert cache.restore_files('key', out_trunc, '.nii.gz', False)
+    with open(out_trunc + '.nii.gz', 'rb') as f:
+        assert f.read() == b'segmentation'
+    assert not cache.restore_files('unknown key', out_trunc, '.nii.gz', False)
+
+
+def test_evict_removes_least_recently_used(tmp_path):
+    cache = PredictionCache(join(str(tmp_path), 'cache'), max_size_gb=1.5 * 1024 / 1024 ** 3)
+    out_trunc = join(str(tmp_path), 'case')
+    _write(out_trunc + '.nii.gz', b'x' * 1024)
+    for i, key in enumerate(('old', 'new')):
+        cache.store_files(key, out_trunc, '.nii.gz', False)
+        os.utime(cache.get_entry(key), (i, i))
+    cache.evict()
+    assert not os.path.isdir(cache.get_entry('old'))
+    assert os.path.isdir(cache.get_entry('new'))
+
+
+def test_model_fingerprint():
+    reference = make_predictor()._internal_get_model_fingerprint()
+    assert reference == make_predictor()._internal_get_model_fingerprint()
+    # different weights
+    assert reference != make_predictor(seed=1)._internal_get_model_fingerprint()
+    # different settings
+    for kwargs in ({'tile_step_size': 0.75}, {'use_mirroring': False}, {'use_gaussian': False},
+                   {'tile_skip_threshold': 0.}, {'analytic_weight_normalization': True},
+                   {'large_tile_memory_budget_gb': 4}, {'cpu_engine': 'fp32'}, {'cpu_engine': 'bf16'}):
+        assert reference != make_predictor(**kwargs)._internal_get_model_fingerprint(), kwargs
+    cpu_engine_reference = make_predictor(cpu_engine='fp32')._internal_get_model_fingerprint()
+    assert cpu_engine_reference != \
+        make_predictor(cpu_engine='fp32', cpu_engine_tolerance=0.01)._internal_get_model_fingerprint()
+    # settings that do not change the logits must not change the fingerprint
+    for kwargs in ({'tile_batch_size': 4}, {'verbose': True}, {'plan_results_memory': False},
+                   {'cpu_engine_tolerance': 0.01}):
+        assert reference == make_predictor(**kwargs)._internal_get_model_fingerprint(), kwargs
+
+
+def test_no_cache_with_time_budget(tmp_path):
+    # predictions within a time budget depend on measured latencies and must not be served from the cache
+    cache_folder = join(str(tmp_path), 'cache')
+    assert make_predictor(prediction_cache_folder=cache_folder).prediction_cache is not None
+    assert make_predictor(prediction_cache_folder=cache_folder, time_budget_s=1).prediction_cache is None
+
+
+def test_roi_fingerprint_differs_from_fullres():
+    reference = make_predictor()._internal_get_model_fingerprint()
+    roi_predictor = make_predictor(predictor_class=nnUNetROIPredictor)
+    roi_predictor.lowres_predictor = make_predictor(seed=1)
+    roi_fingerprint = roi_predictor._internal_get_model_fingerprint()
+    assert roi_fingerprint != reference
+    roi_predictor.roi_margin = 32
+    assert roi_predictor._internal_get_model_fingerprint() != roi_fingerprint
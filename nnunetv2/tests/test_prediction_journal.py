@@ -0,0 +1,92 @@
+import os
+import time
+
+from batchgenerators.utilities.file_and_folder_operations import join
+
+from nnunetv2.inference.prediction_journal import PredictionJournal, order_cases_for_work_stealing
+
+
+def test_claims_are_exclusive(tmp_path):
+    folder = join(str(tmp_path), 'journal')
+    part0 = PredictionJournal(folder, part_id=0)
+    part1 = PredictionJournal(folder, part_id=1)
+    assert part0.claim('case0')
+    assert part0.get_state('case0') == 'queued'
+    assert not part1.claim('case0')
+    assert part1.claim('case1')
+
+    part0.release_claim('case0')
+    assert part1.claim('case0')
+
+
+def test_exported_cases_are_not_claimed_again(tmp_path):
+    folder = join(str(tmp_path), 'journal')
+    journal = PredictionJournal(folder)
+    assert journal.claim('case0')
+    journal.set_state('case0', 'predicted')
+    assert not journal.is_exported('case0')
+    journal.mark_exported('case0')
+    assert journal.is_exported('case0')
+    assert not os.path.isfile(join(folder, 'case0.claim'))
+    assert not PredictionJournal(folder, part_id=1).claim('case0')
+
+
+def test_stale_claims_are_taken_over(tmp_path):
+    folder = join(str(tmp_path), 'journal')
+    part0 = PredictionJournal(folder, part_id=0, claim_timeout_s=60)
+    part1 = PredictionJournal(folder, part_id=1, claim_timeout_s=60)
+    assert part0.claim('case0')
+    # no heartbeat for longer than the timeout
+    old = time.time() - 120
+    os.utime(join(folder, 'case0.claim'), (old, old))
+    assert part1.claim('case0')
+    assert not part0.claim('case0')
+
+
+def test_release_all_claims_only_releases_own_claims(tmp_path):
+    folder = join(str(tmp_path), 'journal')
+    part0 = PredictionJournal(folder, part_id=0)
+    part1 = PredictionJournal(folder, part_id=1)
+    assert part0.claim('case0')
+    assert part1.claim('case1')
+    part0.release_all_claims()
+    assert not os.path.isfile(join(folder, 'case0.claim'))
+    assert os.path.isfile(join(folder, 'case1.claim'))
+
+
+def test_states_of_other_models_are_ignored(tmp_path):
+    folder = join(str(tmp_path), 'journal')
+    journal = PredictionJournal(folder, fingerprint='model')
+    assert journal.claim('case0')
+    journal.mark_exported('case0')
+    assert journal.is_exported('case0')
+    # another model or other settings must predict the case again
+    other_model = PredictionJournal(folder, fingerprint='other model')
+    assert not other_model.is_exported('case0')
+    assert other_model.claim('case0')
+    other_model.mark_exported('case0')
+    assert other_model.is_exported('case0')
+    assert not journal.is_exported('case0')
+
+
+def test_reset_forgets_earlier_states(tmp_path):
+    folder = join(str(tmp_path), 'journal')
+    journal = PredictionJournal(folder, fingerprint='model')
+    assert journal.claim('case0')
+    journal.mark_exported('case0')
+    rerun = PredictionJournal(folder, fingerprint='model')
+    # exported by a part of the rerun that started a little earlier than this one
+    assert journal.claim('case1')
+    journal.mark_exported('case1')
+    rerun.reset()
+    assert not rerun.is_exported('case0')
+    assert rerun.is_exported('case1')
+
+
+def test_order_cases_for_work_stealing():
+    cases = list(range(7))
+    assert order_cases_for_work_stealing(cases, 0, 1) == cases
+    assert order_cases_for_work_stealing(cases, 0, 2) == [0, 2, 4, 6, 5, 3, 1]
+    assert order_cases_for_work_stealing(cases, 1, 2) == [1, 3, 5, 6, 4, 2, 0]
+    for part_id in range(3):
+        assert sorted(order_cases_for_work_stealing(cases, part_id, 3)) == cases
@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+from batchgenerators.utilities.file_and_folder_operations import join
+
+from nnunetv2.inference.probability_store import get_probabilities_file_ending, \
+    get_probabilities_files_per_case, load_probabilities, probabilities_formats, save_probabilities, \
+    strip_probabilities_file_ending
+
+
+def _random_probabilities(shape=(3, 12, 10, 8)) -> np.ndarray:
+    logits = np.random.RandomState(0).randn(*shape).astype(np.float32)
+    probabilities = np.exp(logits)
+    return probabilities / probabilities.sum(0, keepdims=True)
+
+
+@pytest.mark.parametrize('probabilities_format', probabilities_formats)
+def test_round_trip(tmp_path, probabilities_format):
+    probabilities = _random_probabilities()
+    output_file = save_probabilities(probabilities, join(str(tmp_path), 'case'), probabilities_format,
+                                     num_threads=1, max_chunk_bytes=10 * 8 * 4 * 5)
+    assert output_file == join(str(tmp_path), 'case') + get_probabilities_file_ending(probabilities_format)
+    loaded = load_probabilities(output_file, num_threads=1)
+    assert loaded.shape == probabilities.shape
+    if probabilities_format in ('npz', 'b2nd'):
+        assert loaded.dtype == np.float32
+        np.testing.assert_array_equal(loaded, probabilities)
+    elif probabilities_format == 'b2nd_fp16':
+        assert loaded.dtype == np.float16
+        np.testing.assert_allclose(loaded, probabilities, atol=1e-3)
+    else:
+        assert loaded.dtype == np.float32
+        np.testing.assert_allclose(loaded, probabilities, atol=1 / 510 + 1e-6)
+
+    # partial reads return the same as slicing the full array
+    slicer = (slice(1, 3), slice(4, 11))
+    np.testing.assert_array_equal(load_probabilities(output_file, slicer, num_threads=1), loaded[slicer])
+
+    # existing files are overwritten
+    save_probabilities(probabilities[:, :6], join(str(tmp_path), 'case'), probabilities_format, num_threads=1)
+    assert load_probabilities(output_file, num_threads=1).shape == (3, 6, 10, 8)
+
+
+def test_file_endings():
+    assert strip_probabilities_file_ending('a/case_001.npz') == 'a/case_001'
+    assert strip_probabilities_file_ending('case_001.b2nd') == 'case_001'
+    with pytest.raises(ValueError):
+        strip_probabilities_file_ending('case_001.nii.gz')
+    with pytest.raises(AssertionError):
+        get_probabilities_file_ending('npy')
+
+
+def test_files_per_case(tmp_path):
+    folder = str(tmp_path)
+    probabilities = _random_probabilities()
+    save_probabilities(probabilities, join(folder, 'a'), 'npz')
+    save_probabilities(probabilities, join(folder, 'b'), 'b2nd_uint8', num_threads=1)
+    assert get_probabilities_files_per_case(folder, join=False) == {'a': 'a.npz', 'b': 'b.b2nd'}
+    assert get_probabilities_files_per_case(folder)['a'] == join(folder, 'a.npz')
+
+    # a second file of the same case (written with another probabilities_format) is ambiguous
+    save_probabilities(probabilities, join(folder, 'a'), 'b2nd', num_threads=1)
+    with pytest.raises(RuntimeError):
+        get_probabilities_files_per_case(folder)
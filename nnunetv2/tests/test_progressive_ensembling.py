@@ -0,0 +1,48 @@
+import torch
+
+from nnunetv2.tests.predictor_stubs import make_network, make_predictor, predict, random_image
+
+
+def _make_predictor(fold_networks, **kwargs):
+    predictor = make_predictor(network=fold_networks[0], tile_batch_size=4, **kwargs)
+    predictor.list_of_parameters = [n.state_dict() for n in fold_networks]
+    predictor._internal_build_fold_networks(predictor.network)
+    return predictor
+
+
+def test_threshold_0_reproduces_the_full_ensemble():
+    data = random_image((1, 32, 28, 24))
+    fold_networks = [make_network(seed=i) for i in range(3)]
+    reference = predict(_make_predictor(fold_networks, resident_fold_networks=True), data)
+    predictor = _make_predictor(fold_networks, progressive_ensembling_threshold=0)
+    prediction = predictor.predict_logits_from_preprocessed_data(data).float()
+    # the small random networks are uncertain everywhere, so every tile goes to the full ensemble
+    stats = predictor.last_progressive_ensembling_stats
+    assert stats['num_tiles'] > 0 and stats['num_tiles_full_ensemble'] == stats['num_tiles']
+    assert torch.equal(prediction, reference)
+
+
+def _make_intensity_network(scale: float, bias: float) -> torch.nn.Module:
+    # logits (scale * x, bias, 0): certain where x is large, close to uniform where x is 0
+    network = torch.nn.Conv3d(1, 3, 1)
+    with torch.no_grad():
+        network.weight.copy_(torch.tensor([scale, 0, 0]).view(3, 1, 1, 1, 1))
+        network.bias.copy_(torch.tensor([0, bias, 0]))
+    return network
+
+
+def test_certain_tiles_reuse_the_first_fold():
+    fold_networks = [_make_intensity_network(20, 0.1), _make_intensity_network(10, -0.1)]
+    predictor = _make_predictor(fold_networks, progressive_ensembling_threshold=0.1)
+    torch.manual_seed(0)
+    x = torch.rand((4, 1, 16, 16, 16)) * 0.01
+    # tiles 0 and 2 are bright (certain), 1 and 3 are dark (uncertain)
+    x[0::2] += 1
+    with torch.inference_mode():
+        first_fold = predictor.fold_networks[0](x)
+        full_ensemble = predictor._internal_predict_tile_batch_full_ensemble(x)
+        prediction = predictor._internal_predict_tile_batch_progressively(x)
+    assert torch.equal(prediction[0::2], first_fold[0::2])
+    assert not torch.allclose(prediction[0::2], full_ensemble[0::2])
+    assert torch.allclose(prediction[1::2], full_ensemble[1::2], atol=1e-6)
+    assert predictor._progressive_num_tiles == [4, 2]
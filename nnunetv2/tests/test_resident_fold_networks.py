@@ -0,0 +1,23 @@
+import torch
+
+from nnunetv2.tests.predictor_stubs import make_network, make_predictor, random_image
+
+
+def test_resident_fold_networks_match_loading_folds_one_after_the_other():
+    data = random_image((1, 32, 28, 20))
+    fold_parameters = [make_network(seed=i).state_dict() for i in range(3)]
+    predictions = []
+    for resident_fold_networks in (False, True):
+        predictor = make_predictor(tile_batch_size=2, resident_fold_networks=resident_fold_networks)
+        predictor.list_of_parameters = fold_parameters
+        predictor._internal_build_fold_networks(predictor.network)
+        assert (predictor.fold_networks is not None) == resident_fold_networks
+        predictions.append(predictor.predict_logits_from_preprocessed_data(data).float())
+    # the folds are summed up per tile instead of per image, which only changes the fp16 rounding. At the image
+    # borders the Gaussian weights underflow in fp16, so only the interior is compared
+    inner = (slice(None), *[slice(3, -3)] * 3)
+    assert torch.allclose(predictions[1][inner], predictions[0][inner], atol=1e-3, rtol=1e-3)
+    # the resident networks are copies, the weights of the network of the predictor are not touched
+    for fold_network, parameters in zip(predictor.fold_networks, fold_parameters):
+        for k, v in fold_network.state_dict().items():
+            assert torch.equal(v, parameters[k])
@@ -0,0 +1,71 @@
+import pytest
+import torch
+
+from nnunetv2.inference import predict_from_raw_data
+from nnunetv2.tests.predictor_stubs import make_predictor
+
+GB = 1024 ** 3
+# results arrays of this shape need a few MB
+DATA_SHAPE = (1, 64, 64, 64)
+
+
+def _plan(monkeypatch, predictor, available_device, available_ram) -> str:
+    def get_available_memory(device: torch.device):
+        return available_ram if device.type == 'cpu' else available_device
+
+    monkeypatch.setattr(predict_from_raw_data, 'get_available_memory', get_available_memory)
+    return predictor._internal_plan_results_location(DATA_SHAPE)
+
+
+def _make_gpu_predictor(**kwargs):
+    # the device is never used, available memory is mocked
+    predictor = make_predictor(plan_results_memory=True, **kwargs)
+    predictor.device = torch.device('cuda')
+    predictor.perform_everything_on_device = True
+    return predictor
+
+
+@pytest.mark.parametrize('available_device, available_ram, expected', [
+    (16 * GB, 64 * GB, 'device'),
+    # device memory cannot be determined, stay optimistic
+    (None, 64 * GB, 'device'),
+    (1024 ** 2, 64 * GB, 'cpu'),
+    (1024 ** 2, None, 'cpu'),
+    (1024 ** 2, 1024 ** 2, 'out_of_core'),
+    # the prediction is moved to the host in the end, it must fit there as well
+    (16 * GB, 1024 ** 2, 'out_of_core'),
+])
+def test_gpu_results_location(monkeypatch, available_device, available_ram, expected):
+    assert _plan(monkeypatch, _make_gpu_predictor(), available_device, available_ram) == expected
+
+
+@pytest.mark.parametrize('available_ram, expected', [
+    (64 * GB, 'cpu'),
+    (None, 'cpu'),
+    (1024 ** 2, 'out_of_core'),
+])
+def test_cpu_results_location(monkeypatch, available_ram, expected):
+    predictor = make_predictor(plan_results_memory=True)
+    assert _plan(monkeypatch, predictor, 16 * GB, available_ram) == expected
+
+
+def test_sequential_fold_ensembling_needs_more_host_memory(monkeypatch):
+    predictor = make_predictor(plan_results_memory=True)
+    assert _plan(monkeypatch, predictor, None, 64 * GB) == 'cpu'
+    # find the smallest amount of RAM that still works for a single fold
+    low, high = 0, 64 * GB
+    while high - low > 1024:
+        mid = (low + high) // 2
+        if _plan(monkeypatch, predictor, None, mid) == 'cpu':
+            high = mid
+        else:
+            low = mid
+    predictor.list_of_parameters = predictor.list_of_parameters * 3
+    assert _plan(monkeypatch, predictor, None, high) == 'out_of_core'
+
+
+def test_planning_can_be_bypassed(monkeypatch):
+    assert _plan(monkeypatch, _make_gpu_predictor(out_of_core_accumulation=True), 16 * GB, 64 * GB) == 'out_of_core'
+    predictor = _make_gpu_predictor()
+    predictor.plan_results_memory = False
+    assert _plan(monkeypatch, predictor, 1024, 1024) == 'device'
@@ -0,0 +1,58 @@
+import torch
+
+from nnunetv2.inference.predict_from_raw_data import nnUNetPredictor
+from nnunetv2.inference.roi_inference import nnUNetROIPredictor
+from nnunetv2.tests.predictor_stubs import make_predictor, random_image
+
+
+def _make_roi_predictor(lowres_foreground=None, roi_margin: int = 3) -> nnUNetROIPredictor:
+    """
+    lowres_foreground: slicer of the lowres grid (half the fullres resolution) in which the lowres stand-in predicts
+    label 1. None for no foreground
+    """
+    predictor = make_predictor(predictor_class=nnUNetROIPredictor, use_mirroring=False)
+    lowres = make_predictor(spacing=(2, 2, 2), use_mirroring=False)
+
+    def lowres_logits(data: torch.Tensor) -> torch.Tensor:
+        logits = torch.zeros((3, *data.shape[1:]), dtype=torch.half)
+        logits[0] = 1
+        if lowres_foreground is not None:
+            logits[(1, *lowres_foreground)] = 2
+        return logits
+
+    lowres.predict_logits_from_preprocessed_data = lowres_logits
+    predictor.set_lowres_predictor(lowres, roi_margin)
+    return predictor
+
+
+def test_roi_is_clamped_to_the_volume():
+    data = random_image((1, 40, 36, 28))
+    # the lowres grid is (20, 18, 14). The margin reaches beyond the volume along y (upper end) and z (lower end)
+    predictor = _make_roi_predictor((slice(2, 4), slice(16, 18), slice(0, 2)))
+    assert predictor.get_roi_from_lowres_prediction(data) == [[1, 11], [29, 36], [0, 7]]
+
+
+def test_empty_lowres_prediction_falls_back_to_the_full_volume():
+    data = random_image((1, 40, 36, 28))
+    predictor = _make_roi_predictor()
+    assert predictor.get_roi_from_lowres_prediction(data) is None
+    reference = nnUNetPredictor.predict_logits_from_preprocessed_data(predictor, data)
+    assert torch.equal(predictor.predict_logits_from_preprocessed_data(data), reference)
+
+
+def test_outside_of_the_roi_is_background():
+    data = random_image((1, 40, 36, 28))
+    predictor = _make_roi_predictor((slice(6, 10), slice(5, 9), slice(4, 8)))
+    bbox = predictor.get_roi_from_lowres_prediction(data)
+    assert bbox == [[9, 23], [7, 21], [5, 19]]
+    prediction = predictor.predict_logits_from_preprocessed_data(data)
+    assert prediction.shape == (3, *data.shape[1:])
+
+    roi_slicer = tuple([slice(None), *[slice(i, j) for i, j in bbox]])
+    roi_prediction = nnUNetPredictor.predict_logits_from_preprocessed_data(predictor, data[roi_slicer])
+    assert torch.equal(prediction[roi_slicer], roi_prediction)
+    outside = torch.ones(data.shape[1:], dtype=torch.bool)
+    outside[roi_slicer[1:]] = False
+    background = predictor._internal_get_background_logits(prediction.dtype, prediction.device)
+    assert torch.equal(prediction[:, outside], background[:, None].expand(-1, int(outside.sum())))
+    assert (predictor.label_manager.convert_logits_to_segmentation(prediction)[outside] == 0).all()
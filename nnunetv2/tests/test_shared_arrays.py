@@ -0,0 +1,92 @@
+import gc
+import os
+
+import numpy as np
+import pytest
+import torch
+
+from nnunetv2.inference.shared_arrays import SharedArray, SharedMemoryArrays, close_shared_array, \
+    open_shared_array, take_shared_array
+from nnunetv2.tests.predictor_stubs import make_network, make_predictor, random_image
+
+
+def _shared_memory_segments() -> set:
+    return set(os.listdir('/dev/shm'))
+
+
+@pytest.mark.skipif(not os.path.isdir('/dev/shm'), reason='needs /dev/shm to check for leaked segments')
+def test_take_shared_array_does_not_copy():
+    segments = _shared_memory_segments()
+    array = torch.rand((2, 5, 6, 7))
+    handle = SharedArray(array).transfer()
+    tensor = take_shared_array(handle)
+    assert torch.equal(tensor, array)
+    # the name is gone right away, the memory stays mapped until the tensor is gone
+    assert _shared_memory_segments() == segments
+    del tensor
+    gc.collect()
+
+    pinned = take_shared_array(SharedArray(array).transfer(), pin_memory=torch.cuda.is_available())
+    assert torch.equal(pinned, array)
+    assert _shared_memory_segments() == segments
+
+
+@pytest.mark.skipif(not os.path.isdir('/dev/shm'), reason='needs /dev/shm to check for leaked segments')
+def test_shared_memory_arrays_round_trip():
+    segments = _shared_memory_segments()
+    arrays = SharedMemoryArrays()
+    tensor = arrays.zeros((3, 6, 5))
+    assert len(_shared_memory_segments() - segments) == 1
+    tensor += torch.rand(tensor.shape).half()
+    # like the removal of the sliding window padding
+    crop = tensor[:, 1:5, :4]
+    handle, shared_array = arrays.take(crop)
+    assert arrays.take(crop) is None
+    assert handle.slicer == (slice(0, 3), slice(1, 5), slice(0, 4))
+
+    received = take_shared_array(shared_array.transfer())
+    assert torch.equal(received, crop)
+    # the receiver unlinked it, the memory is freed once both sides are done with it
+    assert _shared_memory_segments() == segments
+    del tensor, crop, received
+    gc.collect()
+    shared_array.release()
+
+
+@pytest.mark.skipif(not os.path.isdir('/dev/shm'), reason='needs /dev/shm to check for leaked segments')
+def test_shared_memory_arrays_that_are_not_taken_are_freed():
+    segments = _shared_memory_segments()
+    arrays = SharedMemoryArrays()
+    crop = arrays.zeros((2, 4, 4))[:, 1:3]
+    gc.collect()
+    # a view keeps it alive
+    assert len(_shared_memory_segments() - segments) == 1
+    del crop
+    gc.collect()
+    assert _shared_memory_segments() == segments
+
+
+@pytest.mark.skipif(not os.path.isdir('/dev/shm'), reason='needs /dev/shm to check for leaked segments')
+def test_predictions_are_shared_without_a_copy():
+    segments = _shared_memory_segments()
+    data = random_image((1, 40, 36, 12))
+    predictor = make_predictor(use_mirroring=False)
+    predictor.list_of_parameters = [make_network(seed=i).state_dict() for i in range(2)]
+    reference = predictor.predict_logits_from_preprocessed_data(data)
+
+    predictor.share_results = True
+    prediction = predictor.predict_logits_from_preprocessed_data(data)
+    assert torch.equal(prediction, reference)
+    # the second fold was accumulated into the first one, only the prediction itself is in shared memory
+    assert len(_shared_memory_segments() - segments) == 1
+    handle, shared_array = predictor._internal_share_prediction(prediction)
+    assert len(_shared_memory_segments() - segments) == 1
+
+    shm, exported = open_shared_array(handle)
+    assert np.array_equal(exported, reference.numpy())
+    del exported
+    close_shared_array(shm)
+    del prediction
+    gc.collect()
+    shared_array.release()
+    assert _shared_memory_segments() == segments
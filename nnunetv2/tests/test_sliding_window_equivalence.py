@@ -0,0 +1,104 @@
+import torch
+
+from nnunetv2.tests.predictor_stubs import make_network, make_predictor, predict, random_image
+
+
+def test_tile_batching_matches_single_tiles():
+    data = random_image()
+    reference = predict(make_predictor(use_mirroring=False), data)
+    for kwargs in ({'tile_batch_size': 4}, {'tile_batch_size': 5}, {'tile_batch_memory_budget_gb': 1}):
+        predictor = make_predictor(use_mirroring=False, **kwargs)
+        assert predictor._internal_get_tile_batch_size(100) > 1, kwargs
+        assert torch.allclose(predict(predictor, data), reference, atol=1e-3, rtol=1e-3), kwargs
+
+
+def test_batched_mirroring_matches_sequential_mirroring():
+    data = random_image()
+    reference = predict(make_predictor(tile_batch_size=2), data)
+    # 8 mirror combinations: chunks that divide them, chunks that don't and all at once
+    for mirror_batch_size in (2, 3, 8):
+        predictor = make_predictor(tile_batch_size=2, mirror_batch_size=mirror_batch_size)
+        assert torch.allclose(predict(predictor, data), reference, atol=1e-3, rtol=1e-3), mirror_batch_size
+
+
+def test_analytic_weight_normalization_matches_accumulated_weights():
+    data = random_image()
+    for use_gaussian in (True, False):
+        reference = predict(make_predictor(use_mirroring=False, use_gaussian=use_gaussian), data)
+        predictor = make_predictor(use_mirroring=False, use_gaussian=use_gaussian, analytic_weight_normalization=True)
+        # the accumulated weights are fp16, so both are only equal up to its precision. At the border of the image, the
+        # Gaussian weights of the corner tiles underflow in fp16 and only the analytic weights are accurate
+        inner = (slice(None), *[slice(2, -2)] * 3)
+        assert torch.allclose(predict(predictor, data)[inner], reference[inner], atol=1e-2, rtol=1e-2), use_gaussian
+
+
+def test_slice_batching_matches_single_slices():
+    data = random_image((1, 6, 40, 36))
+    predictor = make_predictor((16, 16), use_mirroring=False)
+    # opt-in: without a budget, 2d tiles are predicted one at a time
+    assert predictor._internal_get_tile_batch_size(100) == 1
+    reference = predict(predictor, data)
+    predictor = make_predictor((16, 16), use_mirroring=False, slice_batch_memory_budget_gb=1)
+    assert predictor._internal_get_tile_batch_size(100) > 1
+    assert torch.allclose(predict(predictor, data), reference, atol=1e-3, rtol=1e-3)
+
+
+def test_slicer_order_only_changes_when_batching_slices():
+    predictor = make_predictor((16, 16))
+    slicers = predictor._internal_get_sliding_window_slicers((3, 20, 20))
+    # the order of upstream nnU-Net: slice by slice
+    assert [sl[1] for sl in slicers] == [0] * 4 + [1] * 4 + [2] * 4
+    ordered = predictor._internal_order_slicers_for_batching(slicers)
+    assert sorted(ordered) == sorted(slicers)
+    assert [sl[1] for sl in ordered] == [0, 1, 2] * 4
+    data = torch.zeros((1, 3, 20, 20))
+    assert predictor._internal_gather_tile_batch(data, ordered[:3])._base is not None
+
+
+def test_large_tiles():
+    data = random_image()
+    # without a budget, the tiles are the patch size
+    assert make_predictor()._internal_get_tile_size(data.shape[1:]) == (16, 16, 16)
+    # a network without spatial context predicts each voxel the same no matter how the image is tiled, so larger tiles
+    # must not change its logits. This checks that the tile size is applied consistently (padding, slicers, Gaussian)
+    for use_gaussian in (False, True):
+        reference = predict(make_predictor(network=make_network(kernel_size=1), use_mirroring=False,
+                                           use_gaussian=use_gaussian), data)
+        predictor = make_predictor(network=make_network(kernel_size=1), use_mirroring=False,
+                                   use_gaussian=use_gaussian, large_tile_memory_budget_gb=1)
+        tile_size = predictor._internal_get_tile_size(data.shape[1:])
+        assert tile_size != (16, 16, 16)
+        # tiles must remain divisible by the downsampling factors (4) of the network
+        assert all([i % 4 == 0 for i in tile_size])
+        # the Gaussian of a large tile underflows in fp16 towards the border of the tile
+        inner = (slice(None), *[slice(4, -4) if use_gaussian else slice(None)] * 3)
+        for analytic_weight_normalization in (False, True):
+            predictor.analytic_weight_normalization = analytic_weight_normalization
+            assert torch.allclose(predict(predictor, data)[inner], reference[inner], atol=1e-2, rtol=1e-2), \
+                (use_gaussian, analytic_weight_normalization)
+
+
+def test_tile_skipping():
+    data = random_image()
+    # only a block in the corner has nonzero input
+    data[:, 12:] = 0
+    data[:, :, 12:] = 0
+    reference = predict(make_predictor(use_mirroring=False), data)
+    predictor = make_predictor(use_mirroring=False, tile_skip_threshold=0.)
+    slicers = predictor._internal_get_sliding_window_slicers(data.shape[1:], (16, 16, 16))
+    selected = predictor._internal_select_tiles_to_predict(data, slicers)
+    assert 0 < len(selected) < len(slicers)
+    predicted = torch.zeros(data.shape[1:], dtype=torch.bool)
+    for sl in selected:
+        predicted[sl[1:]] = True
+    # voxels that are also covered by skipped tiles get less weight than in the reference
+    only_predicted = torch.ones(data.shape[1:], dtype=torch.bool)
+    for sl in slicers:
+        if sl not in selected:
+            only_predicted[sl[1:]] = False
+    assert only_predicted.any() and not predicted.all()
+
+    prediction = predict(predictor, data)
+    assert torch.allclose(prediction[:, only_predicted], reference[:, only_predicted], atol=1e-3, rtol=1e-3)
+    background = predictor._internal_get_background_logits(torch.float32, torch.device('cpu'))
+    assert torch.equal(prediction[:, ~predicted], background[:, None].expand(-1, int((~predicted).sum())))
@@ -0,0 +1,81 @@
+from queue import Queue
+from threading import Thread
+from time import sleep
+
+import pytest
+import torch
+
+from nnunetv2.tests.predictor_stubs import make_predictor, random_image
+
+
+def _failing_gather(predictor, fail_at: int):
+    gather = predictor._internal_gather_tile_batch
+    calls = []
+
+    def gather_tile_batch(data, batch_slicers):
+        calls.append(batch_slicers)
+        if len(calls) == fail_at:
+            raise RuntimeError('gathering failed')
+        return gather(data, batch_slicers)
+
+    return gather_tile_batch
+
+
+def test_producer_exception_reaches_the_consumer():
+    data = random_image((1, 40, 36, 28))
+    predictor = make_predictor(use_mirroring=False, tile_batch_size=2)
+    predictor._internal_gather_tile_batch = _failing_gather(predictor, 3)
+    raised = []
+
+    def consume():
+        try:
+            predictor.predict_sliding_window_return_logits(data)
+        except RuntimeError as e:
+            raised.append(e)
+
+    t = Thread(target=consume, daemon=True)
+    t.start()
+    t.join(120)
+    assert not t.is_alive(), 'the consumer waits for tiles that never come'
+    assert len(raised) == 1 and str(raised[0]) == 'gathering failed'
+
+
+def test_producer_puts_the_exception_instead_of_end():
+    data = random_image((1, 40, 36, 28))
+    predictor = make_predictor(tile_batch_size=2)
+    predictor._internal_gather_tile_batch = _failing_gather(predictor, 2)
+    slicers = predictor._internal_get_sliding_window_slicers(data.shape[1:])
+    q = Queue()
+    predictor._internal_tile_producer(data, slicers, 2, q, {'gather': 0, 'transfer': 0})
+    items = [q.get() for _ in range(q.qsize())]
+    assert len(items) == 2
+    assert items[0][1] == slicers[:2]
+    assert isinstance(items[1], RuntimeError)
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason='pinned staging buffers are only used with cuda')
+def test_staging_buffers_are_not_refilled_before_their_copy_is_done():
+    torch.manual_seed(0)
+    # large tiles, so that the asynchronous copies take a while
+    data = torch.rand((1, 64, 256, 256))
+    predictor = make_predictor((32, 128, 128), tile_batch_size=2)
+    predictor.device = torch.device('cuda')
+    slicers = predictor._internal_get_sliding_window_slicers(data.shape[1:])
+    q = Queue(maxsize=2)
+    t = Thread(target=predictor._internal_tile_producer, args=(data, slicers, 2, q, {'gather': 0, 'transfer': 0}))
+    t.start()
+    num_batches = 0
+    while True:
+        # a slow consumer, so that the producer runs through its staging buffers
+        sleep(0.05)
+        item = q.get()
+        if item == 'end':
+            break
+        workon, batch_slicers, copy_done = item
+        torch.cuda.current_stream().wait_event(copy_done)
+        expected = torch.stack([data[sl] for sl in batch_slicers])
+        assert torch.equal(workon.cpu(), expected)
+        num_batches += 1
+    t.join()
+    # more batches than staging buffers
+    assert num_batches == (len(slicers) + 1) // 2 > q.maxsize + 2
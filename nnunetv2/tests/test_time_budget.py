@@ -0,0 +1,34 @@
+from nnunetv2.inference.time_budget import build_default_quality_ladder, choose_rung
+
+
+def test_default_quality_ladder():
+    ladder = build_default_quality_ladder(5, (0, 1, 2), 0.5)
+    assert ladder == [
+        {'num_folds': 5, 'mirror_axes': (0, 1, 2), 'tile_step_size': 0.5},
+        {'num_folds': 5, 'mirror_axes': (0, 1), 'tile_step_size': 0.5},
+        {'num_folds': 5, 'mirror_axes': (0,), 'tile_step_size': 0.5},
+        {'num_folds': 5, 'mirror_axes': (), 'tile_step_size': 0.5},
+        {'num_folds': 5, 'mirror_axes': (), 'tile_step_size': 0.75},
+        {'num_folds': 2, 'mirror_axes': (), 'tile_step_size': 0.75},
+        {'num_folds': 1, 'mirror_axes': (), 'tile_step_size': 0.75},
+        {'num_folds': 1, 'mirror_axes': (), 'tile_step_size': 1},
+    ]
+    # nothing left to cut
+    assert build_default_quality_ladder(1, None, 1) == [{'num_folds': 1, 'mirror_axes': (), 'tile_step_size': 1}]
+
+
+def _estimate_time_s(rung: dict) -> float:
+    # proportional to the number of forward passes: folds * mirrorings * tiles
+    return rung['num_folds'] * 2 ** len(rung['mirror_axes']) / rung['tile_step_size'] ** 3
+
+
+def test_choose_rung():
+    ladder = build_default_quality_ladder(5, (0, 1, 2), 0.5)
+    estimates = [_estimate_time_s(r) for r in ladder]
+    # everything fits: the best rung
+    assert choose_rung(ladder, _estimate_time_s, 1e6) == (0, estimates[0])
+    # the first rung that fits, even if later ones would fit as well
+    assert choose_rung(ladder, _estimate_time_s, estimates[3]) == (3, estimates[3])
+    assert choose_rung(ladder, _estimate_time_s, estimates[3] - 1) == (4, estimates[4])
+    # nothing fits: the cheapest rung
+    assert choose_rung(ladder, _estimate_time_s, 0.1) == (len(ladder) - 1, estimates[-1])
@@ -46,7 +46,10 @@ from torch.nn.parallel import DistributedDataParallel as DDP
 from nnunetv2.configuration import ANISO_THRESHOLD, default_num_processes
 from nnunetv2.evaluation.evaluate_predictions import compute_metrics_on_folder
 from nnunetv2.inference.export_prediction import export_prediction_from_logits, resample_and_save
+from nnunetv2.inference.inference_checkpoint import save_inference_checkpoint
 from nnunetv2.inference.predict_from_raw_data import nnUNetPredictor
+from nnunetv2.inference.shared_arrays import SharedArray, shared_array_nbytes, shared_memory_available, \
+    release_finished_shared_arrays
 from nnunetv2.inference.sliding_window_prediction import compute_gaussian
 from nnunetv2.paths import nnUNet_preprocessed, nnUNet_results
 from nnunetv2.training.data_augmentation.compute_initial_patch_size import get_patch_size
@@ -940,6 +943,9 @@ class nnUNetTrainer(object):
         self.current_epoch -= 1
         self.save_checkpoint(join(self.output_folder, "checkpoint_final.pth"))
         self.current_epoch += 1
+        # weights-only copy for fast loading in nnUNetPredictor
+        if self.local_rank == 0 and isfile(join(self.output_folder, "checkpoint_final.pth")):
+            save_inference_checkpoint(join(self.output_folder, "checkpoint_final.pth"))
 
         # now we can delete latest
         if self.local_rank == 0 and isfile(join(self.output_folder, "checkpoint_latest.pth")):
@@ -1254,6 +1260,8 @@ class nnUNetTrainer(object):
                 _ = [maybe_mkdir_p(join(self.output_folder_base, 'predicted_next_stage', n)) for n in next_stages]
 
             results = []
+            # predictions in shared memory that are still being exported
+            shared_predictions = []
 
             for i, k in enumerate(dataset_val.identifiers):
                 proceed = not check_workers_alive_and_busy(segmentation_export_pool, worker_list, results,
@@ -1282,7 +1290,14 @@ class nnUNetTrainer(object):
                 output_filename_truncated = join(validation_output_folder, k)
 
                 prediction = predictor.predict_sliding_window_return_logits(data)
-                prediction = prediction.cpu()
+                if shared_memory_available(shared_array_nbytes(prediction)):
+                    # the export workers only get a handle, the logits are not pickled
+                    shared_prediction = SharedArray(prediction)
+                    del prediction
+                    prediction = shared_prediction.handle
+                else:
+                    shared_prediction = None
+                    prediction = prediction.cpu()
 
                 # this needs to go into background processes
                 results.append(
@@ -1293,6 +1308,8 @@ class nnUNetTrainer(object):
                         )
                     )
                 )
+                if shared_prediction is not None:
+                    shared_prediction.add_consumer(results[-1])
                 # for debug purposes
                 # export_prediction_from_logits(prediction, properties, self.configuration_manager, self.plans_manager,
                 #      self.dataset_json, output_filename_truncated, save_probabilities)
@@ -1332,11 +1349,17 @@ class nnUNetTrainer(object):
                                  dataset_class),
                             )
                         ))
+                        if shared_prediction is not None:
+                            shared_prediction.add_consumer(results[-1])
+                if shared_prediction is not None:
+                    shared_predictions.append(shared_prediction)
+                shared_predictions = release_finished_shared_arrays(shared_predictions)
                 # if we don't barrier from time to time we will get nccl timeouts for large datasets. Yuck.
                 if self.is_ddp and i < last_barrier_at_idx and (i + 1) % 20 == 0:
                     dist.barrier()
 
             _ = [r.get() for r in results]
+            [i.release() for i in shared_predictions]
 
         if self.is_ddp:
             dist.barrier()
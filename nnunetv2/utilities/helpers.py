@@ -1,3 +1,8 @@
+import os
+from typing import Union, Tuple
+
+import numpy as np
+
 import torch
 
 
@@ -19,6 +24,37 @@ def empty_cache(device: torch.device):
         pass
 
 
+def get_available_memory(device: torch.device) -> Union[int, None]:
+    """
+    Returns the memory (in bytes) that is currently available on device or None if we cannot tell. For the CPU this
+    is MemAvailable from /proc/meminfo (which includes reclaimable caches), falling back to free physical pages.
+    """
+    if device.type == 'cuda':
+        return torch.cuda.mem_get_info(device)[0]
+    elif device.type == 'cpu':
+        if os.path.isfile('/proc/meminfo'):
+            with open('/proc/meminfo', 'r') as f:
+                for line in f:
+                    if line.startswith('MemAvailable:'):
+                        return int(line.split()[1]) * 1024
+        try:
+            return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+        except (ValueError, OSError, AttributeError):
+            return None
+    else:
+        return None
+
+
+def get_crop_of_view(view: torch.Tensor, shape: Tuple[int, ...]) -> Tuple[slice, ...]:
+    """
+    view is a crop (basic slicing without steps) of a contiguous array of shape. Returns the slicer of that crop, so
+    that another process can reconstruct it from the array.
+    """
+    assert tuple(view.stride()) == torch.empty(shape, device='meta').stride(), 'view must be a crop of the array'
+    start = np.unravel_index(view.storage_offset(), shape)
+    return tuple([slice(int(s), int(s) + n) for s, n in zip(start, view.shape)])
+
+
 class dummy_context(object):
     def __enter__(self):
         pass